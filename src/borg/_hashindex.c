@@ -69,6 +69,8 @@ typedef struct {
     /* buckets may be backed by a Python buffer. If buckets_buffer.buf is NULL then this is not used. */
     Py_buffer buckets_buffer;
 #endif
+    /* buckets are a read-only mapping of the index file, see hashindex_promote */
+    int readonly;
 } HashIndex;
 
 /* prime (or w/ big prime factors) hash table sizes
@@ -102,6 +104,7 @@ static int hash_sizes[] = {
 #define HASH_MAX_EFF_LOAD .93
 
 #define MAX(x, y) ((x) > (y) ? (x): (y))
+#define READ_SIZE (4 * 1024 * 1024)  /* read mapped buckets in parts of that size, see hashindex_read */
 #define NELEMS(x) (sizeof(x) / sizeof((x)[0]))
 
 #define EMPTY _htole32(0xffffffff)
@@ -124,7 +127,7 @@ static int hash_sizes[] = {
 #define EPRINTF_PATH(path, msg, ...) fprintf(stderr, "hashindex: %s: " msg " (%s)\n", path, ##__VA_ARGS__, strerror(errno))
 
 #ifndef BORG_NO_PYTHON
-static HashIndex *hashindex_read(PyObject *file_py, int permit_compact, int legacy);
+static HashIndex *hashindex_read(PyObject *file_py, int permit_compact, int legacy, PyObject *mapping_py);
 static void hashindex_write(HashIndex *index, PyObject *file_py, int legacy);
 #endif
 
@@ -132,6 +135,7 @@ static uint64_t hashindex_compact(HashIndex *index);
 static HashIndex *hashindex_init(int capacity, int key_size, int value_size);
 static const unsigned char *hashindex_get(HashIndex *index, const unsigned char *key);
 static int hashindex_set(HashIndex *index, const unsigned char *key, const void *value);
+static int hashindex_promote(HashIndex *index);
 static int hashindex_delete(HashIndex *index, const unsigned char *key);
 static unsigned char *hashindex_next_key(HashIndex *index, const unsigned char *key);
 
@@ -144,11 +148,13 @@ hashindex_free_buckets(HashIndex *index)
 #ifndef BORG_NO_PYTHON
     if(index->buckets_buffer.buf) {
         PyBuffer_Release(&index->buckets_buffer);
+        index->buckets_buffer.buf = NULL;
     } else
 #endif
     {
         free(index->buckets);
     }
+    index->readonly = 0;
 }
 
 static int
@@ -175,7 +181,7 @@ hashindex_lookup(HashIndex *index, const unsigned char *key, int *start_idx)
         }
         else if(BUCKET_MATCHES_KEY(index, idx, key)) {
             /* we found the bucket with the key we are looking for! */
-            if (didx != -1) {
+            if (didx != -1 && !index->readonly) {
                 // note: although lookup is logically a read-only operation,
                 // we optimize (change) the hashindex here "on the fly":
                 // swap this full bucket with a previous deleted/tombstone bucket.
@@ -521,10 +527,10 @@ fail:
 
 #ifndef BORG_NO_PYTHON
 static HashIndex *
-hashindex_read(PyObject *file_py, int permit_compact, int legacy)
+hashindex_read(PyObject *file_py, int permit_compact, int legacy, PyObject *mapping_py)
 {
-    Py_ssize_t buckets_length, bytes_read;
-    PyObject *bucket_bytes;
+    Py_ssize_t buckets_length, bytes_read, remaining, header_size;
+    PyObject *bucket_bytes = NULL;
     HashIndex *index = NULL;
 
     if (legacy)
@@ -538,43 +544,85 @@ hashindex_read(PyObject *file_py, int permit_compact, int legacy)
     index->bucket_size = index->key_size + index->value_size;
     index->lower_limit = get_lower_limit(index->num_buckets);
     index->upper_limit = get_upper_limit(index->num_buckets);
+    index->readonly = 0;
 
-    /*
-     * For indices read from disk we don't malloc() the buckets ourselves,
-     * we have them backed by a Python bytes() object instead, and go through
-     * Python I/O.
-     *
-     * Note: Issuing read(buckets_length) is okay here, because buffered readers
-     * will issue multiple underlying reads if necessary. This supports indices
-     * >2 GB on Linux. We also compare lengths later.
-     */
     buckets_length = (Py_ssize_t)(index->num_buckets) * (index->key_size + index->value_size);
-    bucket_bytes = PyObject_CallMethod(file_py, "read", "n", buckets_length);
-    if(!bucket_bytes) {
-        assert(PyErr_Occurred());
-        goto fail_free_index;
-    }
-    bytes_read = PyBytes_Size(bucket_bytes);
-    if(PyErr_Occurred()) {
-        /* TypeError, not a bytes() object */
-        goto fail_decref_buckets;
-    }
-    if(bytes_read != buckets_length) {
-        PyErr_Format(PyExc_ValueError, "Could not read buckets (expected %zd, got %zd)", buckets_length, bytes_read);
-        goto fail_decref_buckets;
-    }
+    if(mapping_py != Py_None) {
+        /*
+         * The buckets are used right from mapping_py, a read-only mapping of the whole file,
+         * until they get changed (see hashindex_promote).
+         *
+         * The buckets are still read through file_py (in parts, which are not kept), so a
+         * file_py which verifies the integrity of the file gets to see them.
+         */
+        header_size = legacy ? (Py_ssize_t)sizeof(HashHeader1) : (Py_ssize_t)sizeof(HashHeader);
+        PyObject_GetBuffer(mapping_py, &index->buckets_buffer, PyBUF_SIMPLE);
+        if(PyErr_Occurred()) {
+            goto fail_free_index;
+        }
+        index->buckets = (unsigned char *)index->buckets_buffer.buf + header_size;
+        index->readonly = 1;
+        if(index->buckets_buffer.len != header_size + buckets_length) {
+            PyErr_Format(PyExc_ValueError, "Incorrect mapping length (expected %zd, got %zd)",
+                         header_size + buckets_length, index->buckets_buffer.len);
+            goto fail_free_buckets;
+        }
+        for(remaining = buckets_length; remaining > 0; remaining -= bytes_read) {
+            bucket_bytes = PyObject_CallMethod(file_py, "read", "n", remaining < READ_SIZE ? remaining : READ_SIZE);
+            if(!bucket_bytes) {
+                assert(PyErr_Occurred());
+                goto fail_free_buckets;
+            }
+            bytes_read = PyBytes_Size(bucket_bytes);
+            Py_CLEAR(bucket_bytes);
+            if(PyErr_Occurred()) {
+                /* TypeError, not a bytes() object */
+                goto fail_free_buckets;
+            }
+            if(!bytes_read) {
+                PyErr_Format(PyExc_ValueError, "Could not read buckets (expected %zd, got %zd)",
+                             buckets_length, buckets_length - remaining);
+                goto fail_free_buckets;
+            }
+        }
+    } else {
+        /*
+         * For indices read from disk we don't malloc() the buckets ourselves,
+         * we have them backed by a Python bytes() object instead, and go through
+         * Python I/O.
+         *
+         * Note: Issuing read(buckets_length) is okay here, because buffered readers
+         * will issue multiple underlying reads if necessary. This supports indices
+         * >2 GB on Linux. We also compare lengths later.
+         */
+        bucket_bytes = PyObject_CallMethod(file_py, "read", "n", buckets_length);
+        if(!bucket_bytes) {
+            assert(PyErr_Occurred());
+            goto fail_free_index;
+        }
+        bytes_read = PyBytes_Size(bucket_bytes);
+        if(PyErr_Occurred()) {
+            /* TypeError, not a bytes() object */
+            goto fail_decref_buckets;
+        }
+        if(bytes_read != buckets_length) {
+            PyErr_Format(PyExc_ValueError, "Could not read buckets (expected %zd, got %zd)", buckets_length, bytes_read);
+            goto fail_decref_buckets;
+        }
 
-    PyObject_GetBuffer(bucket_bytes, &index->buckets_buffer, PyBUF_SIMPLE);
-    if(PyErr_Occurred()) {
-        goto fail_decref_buckets;
+        PyObject_GetBuffer(bucket_bytes, &index->buckets_buffer, PyBUF_SIMPLE);
+        if(PyErr_Occurred()) {
+            goto fail_decref_buckets;
+        }
+        index->buckets = index->buckets_buffer.buf;
     }
-    index->buckets = index->buckets_buffer.buf;
 
     index->min_empty = get_min_empty(index->num_buckets);
     if (index->num_empty == -1)  // we read a legacy index without num_empty value
         index->num_empty = count_empty(index);
 
-    if(!permit_compact) {
+    /* a mapped index is left as it is, hashindex_set rebuilds it once it gets changed */
+    if(!permit_compact && !index->readonly) {
         if(index->num_empty < index->min_empty) {
             /* too many tombstones here / not enough empty buckets, do a same-size rebuild */
             if(!hashindex_resize(index, index->num_buckets)) {
@@ -594,7 +642,7 @@ fail_free_buckets:
         hashindex_free_buckets(index);
     }
 fail_decref_buckets:
-    Py_DECREF(bucket_bytes);
+    Py_XDECREF(bucket_bytes);
 fail_free_index:
     if(PyErr_Occurred()) {
         free(index);
@@ -633,6 +681,7 @@ hashindex_init(int capacity, int key_size, int value_size)
 #ifndef BORG_NO_PYTHON
     index->buckets_buffer.buf = NULL;
 #endif
+    index->readonly = 0;
     for(i = 0; i < capacity; i++) {
         BUCKET_MARK_EMPTY(index, i);
     }
@@ -741,12 +790,36 @@ hashindex_get(HashIndex *index, const unsigned char *key)
     return BUCKET_ADDR(index, idx) + index->key_size;
 }
 
+static int
+hashindex_promote(HashIndex *index)
+{
+    /* copy mapped buckets to memory of our own before they get changed, the mapping is released */
+    unsigned char *buckets;
+    size_t buckets_length = (size_t)index->num_buckets * index->bucket_size;
+
+    if(!index->readonly) {
+        return 1;
+    }
+    if(!(buckets = malloc(MAX(buckets_length, 1)))) {
+        EPRINTF("malloc buckets failed");
+        return 0;
+    }
+    memcpy(buckets, index->buckets, buckets_length);
+    hashindex_free_buckets(index);
+    index->buckets = buckets;
+    return 1;
+}
+
 static int
 hashindex_set(HashIndex *index, const unsigned char *key, const void *value)
 {
     int start_idx;
-    int idx = hashindex_lookup(index, key, &start_idx);  /* if idx < 0: start_idx -> EMPTY or DELETED */
+    int idx;
     uint8_t *ptr;
+    if(!hashindex_promote(index)) {
+        return 0;
+    }
+    idx = hashindex_lookup(index, key, &start_idx);  /* if idx < 0: start_idx -> EMPTY or DELETED */
     if(idx < 0)
     {
         if(index->num_entries >= index->upper_limit || idx == -2) {
@@ -800,6 +873,9 @@ hashindex_delete(HashIndex *index, const unsigned char *key)
     if (idx < 0) {
         return -1;
     }
+    if(!hashindex_promote(index)) {
+        return 0;
+    }
     BUCKET_MARK_DELETED(index, idx);
     index->num_entries -= 1;
     if(index->num_entries < index->lower_limit) {
@@ -1,17 +1,19 @@
 import base64
 import json
 import os
-import re
+import queue
 import stat
-import subprocess
 import sys
+import threading
 import time
-from collections import OrderedDict, defaultdict, namedtuple
-from contextlib import contextmanager
+from array import array
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from contextlib import closing, contextmanager, ExitStack
 from datetime import datetime, timedelta
 from functools import partial
 from getpass import getuser
-from io import BytesIO
+from io import BytesIO, UnsupportedOperation
 from itertools import groupby, zip_longest
 from shutil import get_terminal_size
 
@@ -21,7 +23,9 @@
 logger = create_logger()
 
 from . import xattr
-from .chunker import get_chunker, Chunk
+from .cbt import LvmCbt, CbtError
+from .checksums import xxh64
+from .chunker import get_chunker, Chunk, ChunkerAligned
 from .cache import ChunkListEntry
 from .crypto.key import key_factory, UnsupportedPayloadError, AEADKeyBase
 from .compress import Compressor, CompressionSpec
@@ -40,7 +44,7 @@
 from .helpers import safe_ns
 from .helpers import ellipsis_truncate, ProgressIndicatorPercent, log_multi
 from .helpers import os_open, flags_normal, flags_dir, flags_special_follow
-from .helpers import os_stat
+from .helpers import os_stat, blkdiscard
 from .helpers import msgpack
 from .helpers import sig_int
 from .helpers.lrucache import LRUCache
@@ -48,7 +52,7 @@
 from .manifest import Manifest
 from .patterns import PathPrefixPattern, FnmatchPattern, IECommand
 from .item import Item, ArchiveItem, ItemDiff
-from .platform import acl_get, acl_set, set_flags, get_flags, swidth, hostname
+from .platform import acl_get, acl_set, set_flags, get_flags, swidth, hostname, safe_fadvise
 from .remote import cache_if_remote
 from .repository import Repository, LIST_SCAN_LIMIT
 from .repoobj import RepoObj
@@ -65,6 +69,9 @@ def __init__(self, output_json=False, iec=False):
         self.files_stats = defaultdict(int)
         self.chunking_time = 0.0
         self.hashing_time = 0.0
+        # time and bytes per stage of processing (see add_stage)
+        self.stage_times = defaultdict(float)
+        self.stage_sizes = defaultdict(int)
         self.rx_bytes = 0
         self.tx_bytes = 0
 
@@ -73,6 +80,34 @@ def update(self, size, unique):
         if unique:
             self.usize += size
 
+    def add_stage(self, stage, seconds, size=0):
+        """Account *seconds* spent and *size* bytes processed in *stage* (e.g. "read", "put")"""
+        self.stage_times[stage] += seconds
+        self.stage_sizes[stage] += size
+
+    def stage_rate(self, stage):
+        """Throughput of *stage* in bytes per second (0 if it took no measurable time)"""
+        seconds = self.stage_times.get(stage)
+        return self.stage_sizes.get(stage, 0) / seconds if seconds else 0
+
+    def stages_as_dict(self):
+        return {
+            stage: {"time": seconds, "size": self.stage_sizes[stage], "throughput": self.stage_rate(stage)}
+            for stage, seconds in self.stage_times.items()
+        }
+
+    def stages_lines(self):
+        """Lines describing the stages, like 'Time spent in read: 1.50 seconds (10.00 MB at 6.67 MB/s)'"""
+        lines = []
+        for stage, seconds in self.stage_times.items():
+            line = f"Time spent in {stage}: {format_timedelta(timedelta(seconds=seconds))}"
+            if self.stage_sizes[stage]:
+                size = format_file_size(self.stage_sizes[stage], iec=self.iec)
+                rate = format_file_size(self.stage_rate(stage), iec=self.iec)
+                line += f" ({size} at {rate}/s)"
+            lines.append(line)
+        return lines
+
     def __add__(self, other):
         if not isinstance(other, Statistics):
             raise TypeError("can only add Statistics objects")
@@ -84,6 +119,10 @@ def __add__(self, other):
         stats.hashing_time = self.hashing_time + other.hashing_time
         for key in other.files_stats:
             stats.files_stats[key] = self.files_stats[key] + other.files_stats[key]
+        for source in (self, other):
+            # stages may get added by another thread (e.g. the worker of an LV), take a copy
+            for stage, seconds in list(source.stage_times.items()):
+                stats.add_stage(stage, seconds, source.stage_sizes[stage])
 
         return stats
 
@@ -102,7 +141,7 @@ def __str__(self):
 Error files: {error_files}
 Bytes read from remote: {stats.rx_bytes}
 Bytes sent to remote: {stats.tx_bytes}
-""".format(
+{stages}""".format(
             stats=self,
             hashing_time=hashing_time,
             chunking_time=chunking_time,
@@ -110,6 +149,7 @@ def __str__(self):
             unchanged_files=self.files_stats["U"],
             modified_files=self.files_stats["M"],
             error_files=self.files_stats["E"],
+            stages="".join(line + "\n" for line in self.stages_lines()),
         )
 
     def __repr__(self):
@@ -118,7 +158,7 @@ def __repr__(self):
         )
 
     def as_dict(self):
-        return {
+        d = {
             "original_size": FileSize(self.osize, iec=self.iec),
             "deduplicated_size": FileSize(self.usize, iec=self.iec),
             "nfiles": self.nfiles,
@@ -126,6 +166,9 @@ def as_dict(self):
             "chunking_time": self.chunking_time,
             "files_stats": self.files_stats,
         }
+        if self.stage_times:
+            d["stages"] = self.stages_as_dict()
+        return d
 
     def as_raw_dict(self):
         return {"size": self.osize, "nfiles": self.nfiles}
@@ -163,6 +206,9 @@ def show_progress(self, item=None, final=False, stream=None, dt=None):
                 columns, lines = get_terminal_size()
                 if not final:
                     msg = "{0.osize_fmt} O {0.usize_fmt} U {0.nfiles} N ".format(self)
+                    for stage in self.stage_times:
+                        if self.stage_sizes[stage]:
+                            msg += "{} {}/s ".format(stage, format_file_size(self.stage_rate(stage), iec=self.iec))
                     path = remove_surrogates(item.path) if item else ""
                     space = columns - swidth(msg)
                     if space < 12:
@@ -212,7 +258,8 @@ def __str__(self):
             return str(self.os_error)
 
 
-class BackupIO:
+class BackupIO(threading.local):
+    # the op is per thread, metadata may get looked up on other threads (see MetadataPrefetcher)
     op = ""
 
     def __call__(self, op=""):
@@ -241,6 +288,17 @@ def backup_io_iter(iterator):
         yield item
 
 
+def locked_iter(lock, iterator):
+    """Yield from *iterator*, holding *lock* only while advancing it."""
+    while True:
+        with lock:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
 def stat_update_check(st_old, st_curr):
     """
     this checks for some race conditions between the first filename-based stat()
@@ -330,6 +388,26 @@ def fetch_many(self, ids, is_preloaded=False):
             _, data = self.repo_objs.parse(id_, cdata)
             yield data
 
+    def fetch_item(self, item, is_preloaded=False, sparse=False):
+        """
+        Return iterator over the contents of *item*, chunk by chunk, including its holes (see Item.holes).
+
+        Holes are given as their size (int) if *sparse* is True, otherwise as (pieces of) zeros.
+        """
+        return self.fetch_chunks(item.chunks_with_holes(), is_preloaded=is_preloaded, sparse=sparse)
+
+    def fetch_chunks(self, chunks, is_preloaded=False, sparse=False):
+        """Like fetch_item, for a chunk list as returned by Item.chunks_with_holes"""
+        data_iter = self.fetch_many([c.id for c in chunks if c.id is not None], is_preloaded=is_preloaded)
+        for chunk in chunks:
+            if chunk.id is not None:
+                yield next(data_iter)
+            elif sparse:
+                yield chunk.size
+            else:
+                for offset in range(0, chunk.size, len(zeros)):
+                    yield memoryview(zeros)[: min(len(zeros), chunk.size - offset)]
+
 
 class ChunkBuffer:
     BUFFER_SIZE = 8 * 1024 * 1024
@@ -816,17 +894,18 @@ def extract_item(
                     if "chunks" in item:
                         fd = sys.stdout.fileno()
                         item_chunks_size = 0
-                        for data in self.pipeline.fetch_many([c.id for c in item.chunks], is_preloaded=True):
+                        for data in self.pipeline.fetch_item(item, is_preloaded=True, sparse=sparse):
+                            size = data if isinstance(data, int) else len(data)
                             if pi:
-                                pi.show(increase=len(data), info=[remove_surrogates(item.path)])
+                                pi.show(increase=size, info=[remove_surrogates(item.path)])
                             if stdout:
                                 with backup_io("write"):
-                                    if sparse and zeros.startswith(data):
-                                        # all-zero chunk: create a hole in a sparse file
-                                        os.lseek(fd, len(data), os.SEEK_CUR)
+                                    if isinstance(data, int) or sparse and zeros.startswith(data):
+                                        # hole or all-zero chunk: create a hole in a sparse file
+                                        os.lseek(fd, size, os.SEEK_CUR)
                                     else:
                                         os.write(fd, data)
-                            item_chunks_size += len(data)
+                            item_chunks_size += size
                         if "size" in item:
                             item_size = item.size
                             if item_size != item_chunks_size:
@@ -871,14 +950,14 @@ def make_parent(path):
                 with backup_io("open"):
                     fd = open(path, "wb")
                 with fd:
-                    ids = [c.id for c in item.chunks]
-                    for data in self.pipeline.fetch_many(ids, is_preloaded=True):
+                    for data in self.pipeline.fetch_item(item, is_preloaded=True, sparse=sparse):
+                        size = data if isinstance(data, int) else len(data)
                         if pi:
-                            pi.show(increase=len(data), info=[remove_surrogates(item.path)])
+                            pi.show(increase=size, info=[remove_surrogates(item.path)])
                         with backup_io("write"):
-                            if sparse and zeros.startswith(data):
-                                # all-zero chunk: create a hole in a sparse file
-                                fd.seek(len(data), 1)
+                            if isinstance(data, int) or sparse and zeros.startswith(data):
+                                # hole or all-zero chunk: create a hole in a sparse file
+                                fd.seek(size, 1)
                             else:
                                 fd.write(data)
                     with backup_io("truncate_and_attrs"):
@@ -1113,8 +1192,8 @@ def compare_items(item1, item2):
             return ItemDiff(
                 item1,
                 item2,
-                archive1.pipeline.fetch_many([c.id for c in item1.get("chunks", [])]),
-                archive2.pipeline.fetch_many([c.id for c in item2.get("chunks", [])]),
+                archive1.pipeline.fetch_item(item1),
+                archive2.pipeline.fetch_item(item2),
                 can_compare_chunk_ids=can_compare_chunk_ids,
             )
 
@@ -1160,6 +1239,8 @@ def __init__(self, *, noatime, noctime, nobirthtime, numeric_ids, noflags, noacl
         self.noacls = noacls
         self.noxattrs = noxattrs
         self.nobirthtime = nobirthtime
+        # xattrs and ACLs looked up in advance, path -> (st, attrs), see MetadataPrefetcher
+        self.prefetched = {}
 
     def stat_simple_attrs(self, st):
         attrs = {}
@@ -1192,6 +1273,16 @@ def stat_ext_attrs(self, st, path, fd=None):
             with backup_io("extended stat (flags)"):
                 flags = get_flags(path, st, fd=fd)
             attrs["bsdflags"] = flags
+        pst, prefetched_attrs = self.prefetched.pop(path, (None, None))
+        if pst is not None and (pst.st_ino, pst.st_ctime_ns) == (st.st_ino, st.st_ctime_ns):
+            # changing xattrs or ACLs changes the ctime, so the prefetched ones are still current
+            attrs.update(prefetched_attrs)
+        else:
+            attrs.update(self.stat_xattrs_acls(st, path, fd=fd))
+        return attrs
+
+    def stat_xattrs_acls(self, st, path, fd=None):
+        attrs = {}
         if not self.noxattrs:
             with backup_io("extended stat (xattrs)"):
                 xattrs = xattr.get_all(fd or path, follow_symlinks=False)
@@ -1214,6 +1305,90 @@ def stat_attrs(self, st, path, fd=None):
 zero_chunk_ids = LRUCache(10, dispose=lambda _: None)
 
 
+class MetadataPrefetcher:
+    """
+    Looks up the metadata of upcoming directory entries on worker threads, see CreateMixIn._rec_walk.
+
+    Walking a tree of many, mostly unchanged files is latency bound on metadata syscalls, especially on
+    network filesystems. While the main thread processes a directory entry, the workers already lstat()
+    the next ones and get their xattrs and ACLs (used by MetadataCollector.stat_ext_attrs if the entry
+    did not change meanwhile). The entries are still processed one after the other, in the given order.
+    """
+
+    # what is known about an entry in advance: whether the matcher included it (if not, whether to recurse
+    # into it) and its lstat() result (None if it was not looked up or that failed, the caller has to do it).
+    Prefetched = namedtuple("Prefetched", "included recurse_dir st")
+
+    # how many entries each worker may look up in advance
+    queue_depth = 4
+
+    def __init__(self, *, workers, matcher, metadata_collector=None):
+        self.workers = workers
+        self.matcher = matcher
+        self.metadata_collector = metadata_collector
+        self.executor = None
+
+    def _lookup(self, path, parent_fd, name, included):
+        try:
+            with backup_io("stat"):
+                st = os_stat(path=path, parent_fd=parent_fd, name=name, follow_symlinks=False)
+            attrs = None
+            if included and self.metadata_collector is not None:
+                attrs = self.metadata_collector.stat_xattrs_acls(st, path)
+        except (BackupOSError, BackupError):
+            # the main thread will try again and deal with the error
+            return None, None
+        return st, attrs
+
+    def _submit(self, path, parent_fd, name):
+        # matching is done here on the main thread, in order: recurse_dir is only valid right after match()
+        path = os.path.normpath(os.path.join(path, name))
+        included = self.matcher.match(path)
+        recurse_dir = self.matcher.recurse_dir
+        future = None
+        if included or recurse_dir:
+            # like _rec_walk, don't even lstat() excluded entries we don't recurse into
+            future = self.executor.submit(self._lookup, path, parent_fd, name, included)
+        return name, path, included, recurse_dir, future
+
+    def _take(self, in_flight):
+        name, path, included, recurse_dir, future = in_flight.popleft()
+        st, attrs = future.result() if future is not None else (None, None)
+        if attrs is not None:
+            self.metadata_collector.prefetched[path] = st, attrs
+        try:
+            yield name, path, self.Prefetched(included, recurse_dir, st)
+        finally:
+            if attrs is not None:
+                self.metadata_collector.prefetched.pop(path, None)
+
+    def entries(self, path, parent_fd, dirents):
+        """
+        Yield (name, path, prefetched) for the *dirents* of the directory *path* (open as *parent_fd*) in order.
+
+        Without workers, prefetched is None: the caller has to match and lstat() the entry itself.
+        """
+        if self.workers < 1:
+            for dirent in dirents:
+                yield dirent.name, os.path.normpath(os.path.join(path, dirent.name)), None
+            return
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="borg-prefetch")
+        in_flight = deque()
+        try:
+            for dirent in dirents:
+                in_flight.append(self._submit(path, parent_fd, dirent.name))
+                while len(in_flight) > self.workers * self.queue_depth:
+                    yield from self._take(in_flight)
+            while in_flight:
+                yield from self._take(in_flight)
+        finally:
+            # parent_fd gets closed after we are done, so the workers must be done with it.
+            futures = [entry[-1] for entry in in_flight if entry[-1] is not None and not entry[-1].cancel()]
+            wait_futures(futures)
+
+
 def cached_hash(chunk, id_hash):
     allocation = chunk.meta["allocation"]
     if allocation == CH_DATA:
@@ -1236,6 +1411,12 @@ def cached_hash(chunk, id_hash):
 class ChunksProcessor:
     # Processes an iterator of chunks for an Item
 
+    # chunk (hashed, compressed and encrypted) as it comes from the workers, see pack_chunk
+    Packed = namedtuple("Packed", "id size data cdata hashing_time packing_time")
+
+    # how many chunks each worker may have in flight, bounds the memory used when the repository is slower
+    queue_depth = 4
+
     def __init__(
         self,
         *,
@@ -1247,6 +1428,7 @@ def __init__(
         checkpoint_interval,
         checkpoint_volume,
         rechunkify,
+        workers=1,
     ):
         self.key = key
         self.cache = cache
@@ -1261,18 +1443,27 @@ def __init__(
         self.checkpoint_volume = checkpoint_volume
         self.current_volume = 0
         self.last_volume_checkpoint = 0
-
-    def write_part_file(self, item):
+        # number of checkpoint archives written so far
+        self.checkpoints = 0
+        # threads hashing, compressing and encrypting chunks (no extra threads with one worker)
+        self.workers = workers
+        self.executor = None
+        # serializes the chunk lookups of the workers with the stores
+        self.cache_lock = threading.RLock()
+
+    def write_part_file(self, *items):
         self.prepare_checkpoint()
-        item = Item(internal_dict=item.as_dict())
-        # for borg recreate, we already have a size member in the source item (giving the total file size),
-        # but we consider only a part of the file here, thus we must recompute the size from the chunks:
-        item.get_size(memorize=True, from_chunks=True)
-        item.path += ".borg_part"
-        self.add_item(item, show_progress=False)
+        for item in items:
+            item = Item(internal_dict=item.as_dict())
+            # for borg recreate, we already have a size member in the source item (giving the total file size),
+            # but we consider only a part of the file here, thus we must recompute the size from the chunks:
+            item.get_size(memorize=True, from_chunks=True)
+            item.path += ".borg_part"
+            self.add_item(item, show_progress=False)
         self.write_checkpoint()
+        self.checkpoints += 1
 
-    def maybe_checkpoint(self, item):
+    def maybe_checkpoint(self, *items):
         checkpoint_done = False
         sig_int_triggered = sig_int and sig_int.action_triggered()
         if (
@@ -1282,7 +1473,7 @@ def maybe_checkpoint(self, item):
         ):
             if sig_int_triggered:
                 logger.info("checkpoint requested: starting checkpoint creation...")
-            self.write_part_file(item)
+            self.write_part_file(*items)
             checkpoint_done = True
             self.last_checkpoint = time.monotonic()
             self.last_volume_checkpoint = self.current_volume
@@ -1291,33 +1482,215 @@ def maybe_checkpoint(self, item):
                 logger.info("checkpoint requested: finished checkpoint creation!")
         return checkpoint_done  # whether a checkpoint archive was created
 
-    def process_file_chunks(self, item, cache, stats, show_progress, chunk_iter, chunk_processor=None):
-        if not chunk_processor:
+    def pack_chunk(self, chunk):
+        """
+        Hash *chunk* and format it for the repository (compress and encrypt), unless it is known already.
+
+        This is safe to call from other threads (see packed_chunks), it does not change the cache.
+        """
+        started = time.monotonic()
+        chunk_id, data = cached_hash(chunk, self.key.id_hash)
+        hashed = time.monotonic()
+        with self.cache_lock:
+            # only a hint: the cache might learn about the chunk before this one gets stored, see store_chunk
+            known = self.cache.seen_chunk(chunk_id, len(data))
+        cdata = None if known else self.cache.repo_objs.format(chunk_id, {}, data)
+        return self.Packed(chunk_id, len(data), data, cdata, hashed - started, time.monotonic() - hashed)
+
+    def store_chunk(self, packed, *, cache, stats, overwrite=False):
+        """Add a chunk packed by pack_chunk (or an old ChunkListEntry to re-use) to the cache and repository"""
+        with self.cache_lock:
+            if isinstance(packed, ChunkListEntry):
+                # re-using an old chunk
+                return cache.chunk_incref(packed.id, stats)
+
+            stats.hashing_time += packed.hashing_time
+            chunk_entry = cache.add_chunk(
+                packed.id, {}, packed.data, stats=stats, overwrite=overwrite, wait=False, cdata=packed.cdata
+            )
+            cache.repository.async_response(wait=False)
+        return chunk_entry
 
-            def chunk_processor(chunk):
+    def process_chunk(self, chunk, *, cache, stats):
+        if not isinstance(chunk, ChunkListEntry):
+            chunk = self.pack_chunk(chunk)
+        return self.store_chunk(chunk, cache=cache, stats=stats)
+
+    def packed_chunks(self, chunk_iter):
+        """
+        Pack the chunks of *chunk_iter* on the workers, yielding them (see pack_chunk) in order.
+
+        ChunkListEntrys (old chunks to be re-used) are passed through. Only so many chunks are in flight,
+        if they are not stored fast enough, the chunker has to wait.
+        """
+        if self.workers <= 1:
+            for chunk in chunk_iter:
+                yield chunk if isinstance(chunk, ChunkListEntry) else self.pack_chunk(chunk)
+            return
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="borg-pack")
+        in_flight = deque()
+        try:
+            for chunk in chunk_iter:
                 if isinstance(chunk, ChunkListEntry):
-                    # re-using an old chunk
-                    return cache.chunk_incref(chunk.id, stats)
+                    in_flight.append(chunk)
+                else:
+                    if chunk.data is not None:
+                        # the chunker re-uses its buffer, so we need a copy before it moves on
+                        chunk = Chunk(bytes(chunk.data), **chunk.meta)
+                    in_flight.append(self.executor.submit(self.pack_chunk, chunk))
+                while len(in_flight) > self.workers * self.queue_depth:
+                    packed = in_flight.popleft()
+                    yield packed if isinstance(packed, ChunkListEntry) else packed.result()
+            while in_flight:
+                packed = in_flight.popleft()
+                yield packed if isinstance(packed, ChunkListEntry) else packed.result()
+        finally:
+            # if we did not get through, the chunks left are dropped. the workers must be done with them, though.
+            futures = [f for f in in_flight if not isinstance(f, ChunkListEntry) and not f.cancel()]
+            wait_futures(futures)
+
+    def append_chunk(self, item, chunk_entry, stats, show_progress, pending_items=()):
+        """
+        Append an already processed chunk to *item*, checkpointing if due.
 
-                started_hashing = time.monotonic()
-                chunk_id, data = cached_hash(chunk, self.key.id_hash)
-                stats.hashing_time += time.monotonic() - started_hashing
-                chunk_entry = cache.add_chunk(chunk_id, {}, data, stats=stats, wait=False)
-                self.cache.repository.async_response(wait=False)
-                return chunk_entry
+        *pending_items* are other items which are still being processed concurrently,
+        they get written as part files along with *item* if a checkpoint is created.
+        """
+        item.chunks.append(chunk_entry)
+        self.current_volume += chunk_entry[1]
+        if show_progress:
+            stats.show_progress(item=item, dt=0.2)
+        self.maybe_checkpoint(item, *pending_items)
+
+    def process_file_chunks(self, item, cache, stats, show_progress, chunk_iter, chunk_processor=None):
+        # chunk_processor gets the chunks packed (see packed_chunks), store_chunk by default
+        if not chunk_processor:
+            chunk_processor = partial(self.store_chunk, cache=cache, stats=stats)
 
         item.chunks = []
         # if we rechunkify, we'll get a fundamentally different chunks list, thus we need
         # to get rid of .chunks_healthy, as it might not correspond to .chunks any more.
         if self.rechunkify and "chunks_healthy" in item:
             del item.chunks_healthy
-        for chunk in chunk_iter:
-            chunk_entry = chunk_processor(chunk)
-            item.chunks.append(chunk_entry)
-            self.current_volume += chunk_entry[1]
-            if show_progress:
-                stats.show_progress(item=item, dt=0.2)
-            self.maybe_checkpoint(item)
+        with closing(self.packed_chunks(chunk_iter)) as packed_chunks:
+            for packed in packed_chunks:
+                self.append_chunk(item, chunk_processor(packed), stats, show_progress)
+
+
+class BlockHashReader:
+    """
+    Reads a file (or block device) sequentially, hashing every block of it with xxh64.
+
+    The hashes are compared to the ones of the last backup of the file (see LocalCache.memorize_block_hashes):
+    the old chunks which only cover unchanged blocks are passed through as they are (like the 'old' segments in
+    ThinObjectProcessors.delta_chunkify), all other data goes through the chunker again. As the chunks are
+    either passed through or cut from what was just read and hashed, the hashes always match the chunks.
+
+    The object is also the file-like the chunker reads from, one run of changed data at a time.
+    """
+
+    def __init__(self, fd, *, block_size, old_hashes=b"", old_chunks=()):
+        self.fd = fd
+        self.block_size = block_size
+        self.old_hashes = old_hashes
+        self.old_chunks = iter(old_chunks)
+        # the next old chunk, it starts at self.run_end
+        self.pending = next(self.old_chunks, None)
+        # concatenated hashes of the blocks read so far
+        self.hashes = bytearray()
+        # data read (in whole blocks), but not consumed yet: [self.data_start, self.read_pos)
+        self.data = bytearray()
+        self.data_start = self.read_pos = 0
+        self.eof = False
+        # the changed data up to self.run_end is handed to the chunker, it has got it up to self.pos
+        self.pos = self.run_end = 0
+        # bytes passed through as old chunks
+        self.reused = 0
+
+    def _read_block(self):
+        block = os.read(self.fd, self.block_size)
+        while block and len(block) < self.block_size:
+            more = os.read(self.fd, self.block_size - len(block))
+            if not more:
+                break
+            block += more
+        return block
+
+    def _fill(self, end):
+        """Read (and hash) blocks until there is data up to *end* (or the end of the file)"""
+        while self.read_pos < end and not self.eof:
+            block = self._read_block()
+            if len(block) < self.block_size:
+                self.eof = True
+            if block:
+                self.hashes += xxh64(block)
+                self.data += block
+                self.read_pos += len(block)
+
+    def _consume(self, end):
+        """Take the data up to *end* from the buffer"""
+        n = end - self.data_start
+        data = bytes(self.data[:n])
+        del self.data[:n]
+        # we won't read this again, don't spoil the page cache with it (like the chunker does)
+        safe_fadvise(self.fd, self.data_start, n, "DONTNEED")
+        self.data_start = end
+        return data
+
+    def _unchanged(self, start, end):
+        """Whether the data in [start, end) is what it was in the last backup"""
+        if end > self.read_pos:
+            return False  # the file got shorter
+        first = start // self.block_size * 8
+        last = -(-end // self.block_size) * 8
+        return last <= len(self.old_hashes) and self.hashes[first:last] == self.old_hashes[first:last]
+
+    def _extend_run(self):
+        """Make more changed data available to the chunker, return whether there is any"""
+        start = self.run_end
+        if self.pending is None:
+            # beyond the old chunks, everything gets chunked
+            self._fill(self.read_pos + 1)
+            self.run_end = self.read_pos
+        else:
+            end = self.run_end + self.pending.size
+            self._fill(end)
+            if self._unchanged(self.run_end, end):
+                return False
+            self.run_end = min(end, self.read_pos)
+            self.pending = next(self.old_chunks, None) if end <= self.read_pos else None
+        return self.run_end > start
+
+    def read(self, n):
+        while self.run_end - self.pos < n and self._extend_run():
+            pass
+        end = min(self.pos + n, self.run_end)
+        data = self._consume(end)
+        self.pos = end
+        return data
+
+    def seek(self, *args):
+        # the chunker can not look for holes in here
+        raise UnsupportedOperation("seek")
+
+    def chunkify(self, chunker):
+        """Yield ChunkListEntrys of the old chunks still valid and Chunks (from *chunker*) for everything else"""
+        while True:
+            while self.pending is not None:
+                end = self.pos + self.pending.size
+                self._fill(end)
+                if not self._unchanged(self.pos, end):
+                    break
+                self._consume(end)
+                yield self.pending
+                self.reused += self.pending.size
+                self.pos = self.run_end = end
+                self.pending = next(self.old_chunks, None)
+            if not self._extend_run():
+                return
+            yield from chunker.chunkify(self)
 
 
 class FilesystemObjectProcessors:
@@ -1339,6 +1712,7 @@ def __init__(
         log_json,
         iec,
         file_status_printer=None,
+        block_hashes=False,
     ):
         self.metadata_collector = metadata_collector
         self.cache = cache
@@ -1347,12 +1721,23 @@ def __init__(
         self.process_file_chunks = process_file_chunks
         self.show_progress = show_progress
         self.print_file_status = file_status_printer or (lambda *args: None)
+        self.block_hashes = block_hashes
 
         self.hlm = HardLinkManager(id_type=tuple, info_type=(list, type(None)))  # (dev, ino) -> chunks or None
         self.stats = Statistics(output_json=log_json, iec=iec)  # threading: done by cache (including progress)
         self.cwd = os.getcwd()
         self.chunker = get_chunker(*chunker_params, seed=key.chunk_seed, sparse=sparse)
 
+    def _block_hash_reader(self, fd, hashed_path, path_hash):
+        """Get a BlockHashReader for *fd*, set up with the block hashes memorized in the cache (if usable)"""
+        entry = self.cache.known_block_hashes(hashed_path, path_hash)
+        if entry is not None and entry.block_size == BLOCK_HASH_SIZE:
+            old_chunks = [ChunkListEntry(id, size) for id, size in entry.chunks]
+            # like for the files cache, make sure we still have all the chunks
+            if sum(c.size for c in old_chunks) == entry.size and all(self.cache.seen_chunk(c.id) for c in old_chunks):
+                return BlockHashReader(fd, block_size=BLOCK_HASH_SIZE, old_hashes=entry.hashes, old_chunks=old_chunks)
+        return BlockHashReader(fd, block_size=BLOCK_HASH_SIZE)
+
     @contextmanager
     def create_helper(self, path, st, status=None, hardlinkable=True):
         safe_path = make_path_safe(path)
@@ -1481,17 +1866,22 @@ def process_file(self, *, path, parent_fd, name, st, cache, flags=flags_normal):
                             chunk_entry = cache.chunk_incref(chunk_id, self.stats)
                             item.chunks.append(chunk_entry)
                     else:  # normal case, no "2nd+" hardlink
-                        if not is_special_file:
+                        use_block_hashes = self.block_hashes and (
+                            stat.S_ISBLK(st.st_mode) or stat.S_ISREG(st.st_mode) and st.st_size >= BLOCK_HASH_MIN_SIZE
+                        )
+                        if not is_special_file or use_block_hashes:
                             hashed_path = safe_encode(os.path.join(self.cwd, path))
                             started_hashing = time.monotonic()
                             path_hash = self.key.id_hash(hashed_path)
                             self.stats.hashing_time += time.monotonic() - started_hashing
+                        else:
+                            hashed_path = path_hash = None
+                        if not is_special_file:
                             known, ids = cache.file_known_and_unchanged(hashed_path, path_hash, st)
                         else:
                             # in --read-special mode, we may be called for special files.
                             # there should be no information in the cache about special files processed in
                             # read-special mode, but we better play safe as this was wrong in the past:
-                            hashed_path = path_hash = None
                             known, ids = False, None
                         if ids is not None:
                             # Make sure all ids are available
@@ -1514,13 +1904,15 @@ def process_file(self, *, path, parent_fd, name, st, cache, flags=flags_normal):
                         status = None  # we already printed the status
                         # Only chunkify the file if needed
                         if "chunks" not in item:
+                            if use_block_hashes:
+                                reader = self._block_hash_reader(fd, hashed_path, path_hash)
+                                chunk_iter = reader.chunkify(self.chunker)
+                            else:
+                                reader = None
+                                chunk_iter = self.chunker.chunkify(None, fd)
                             with backup_io("read"):
                                 self.process_file_chunks(
-                                    item,
-                                    cache,
-                                    self.stats,
-                                    self.show_progress,
-                                    backup_io_iter(self.chunker.chunkify(None, fd)),
+                                    item, cache, self.stats, self.show_progress, backup_io_iter(chunk_iter)
                                 )
                                 self.stats.chunking_time = self.chunker.chunking_time
                             if is_win32:
@@ -1541,6 +1933,17 @@ def process_file(self, *, path, parent_fd, name, st, cache, flags=flags_normal):
                                 # also, we must not memorize a potentially inconsistent/corrupt file that
                                 # changed while we backed it up.
                                 cache.memorize_file(hashed_path, path_hash, st, [c.id for c in item.chunks])
+                            if reader is not None and not changed_while_backup:
+                                # block devices may change while we read them, but the hashes are of what we read
+                                cache.memorize_block_hashes(
+                                    hashed_path,
+                                    path_hash,
+                                    block_size=reader.block_size,
+                                    size=reader.read_pos,
+                                    hashes=reader.hashes,
+                                    chunks=item.chunks,
+                                )
+                                logger.debug("%s: %d of %d bytes unchanged", path, reader.reused, reader.read_pos)
                     self.stats.nfiles += 1
                     item.update(self.metadata_collector.stat_ext_attrs(st, path, fd=fd))
                     item.get_size(memorize=True)
@@ -1665,9 +2068,19 @@ def process_file(self, *, tarinfo, status, type, tar):
                     self.cache.chunk_decref(chunk.id, self.stats, wait=False)
                 raise
 
+
 class ThinObjectProcessors:
-    snap_archname_re = re.compile(r'borgarch-(\S+)$')
     meta_path = '.lvm-meta.mpk'
+    # number of chunks each worker may have queued up for the committer when processing LVs in parallel
+    queue_depth = 4
+
+    # how many old chunks (which need to be split) are fetched ahead of time
+    preload_window = 16
+    # how many entries the old chunk alignment runs ahead to find those
+    plan_window = 4096
+
+    # part of an old chunk, which needs to be fetched and split
+    ModChunkInfo = namedtuple('ModChunkInfo', 'id start end')
 
     class Metadata:
         def __init__(self, internal_dict=None):
@@ -1676,10 +2089,11 @@ def __init__(self, internal_dict=None):
                 'lvs': {},
             }
 
-        def add_lv(self, lv_uuid, *, snapshot_uuid):
+        def add_lv(self, lv_uuid, *, snapshot_uuid, align_chunks=False):
             assert lv_uuid not in self._dict['lvs']
             self._dict['lvs'][lv_uuid] = {
                 'snapshot_uuid': snapshot_uuid,
+                'align_chunks': align_chunks,
             }
 
         def get_lv(self, lv_uuid):
@@ -1688,36 +2102,85 @@ def get_lv(self, lv_uuid):
         def as_dict(self):
             return StableDict(self._dict)
 
+    class LvJob:
+        """State of an LV being backed up (see _prepare_lvs), possibly by a worker thread"""
+
+        def __init__(self, name, *, stats):
+            self.name = name
+            # set up by _prepare_lvs, the stack holds the new snapshot until the LV is done
+            self.volume = None
+            self.stack = None
+            self.nextsnap = None
+            # set up by _plan_lv once the LV is processed, the stack then holds the last snapshot as well
+            self.lastsnap = None
+            self.old_chunks = None
+            # whether the old chunks were all cut on pool chunk boundaries (see align_chunks)
+            self.old_aligned = False
+            # the partial snapshot being resumed and the chunks (with holes) of its latest part item
+            self.resume_snap = None
+            self.done_chunks = None
+            # checkpoints written before the LV started being processed (see next_snap)
+            self.checkpoints = None
+            # why the LV can't be backed up (found while preparing)
+            self.error = None
+            # worker-side stats (chunking and hashing time)
+            self.stats = stats
+            self.item = None
+            self.status = None
+            self.future = None
+            # whether the committer has seen the end of the worker's output
+            self.ended = False
+            # set by the committer once everything the worker produced is stored
+            self.committed = threading.Event()
+
     def __init__(
         self,
         *,
         archive,
         cache,
         key,
-        process_file_chunks,
+        chunks_processor,
         chunker_params,
         show_progress,
         log_json,
         iec,
         file_status_printer=None,
+        parallel_lvs=1,
+        align_chunks=False,
+        cbt=None,
     ):
         self.archive = archive
         self.cache = cache
         self.key = key
-        self.process_file_chunks = process_file_chunks
+        self.chunks_processor = chunks_processor
+        self.process_file_chunks = chunks_processor.process_file_chunks
         self.show_progress = show_progress
         self.print_file_status = file_status_printer or (lambda *args: None)
+        self.parallel_lvs = parallel_lvs
+        self.align_chunks = align_chunks
 
+        self.chunker_params = chunker_params
         self.chunker = get_chunker(*chunker_params, seed=key.chunk_seed, sparse=True)
         self.stats = Statistics(output_json=log_json, iec=iec)  # threading: done by cache (including progress)
 
         self.metadata = self.Metadata()
         self._old_meta_cache = {}
+        # (name, stats) of the LVs processed, see _add_lv_stats
+        self.lv_stats = []
+        self.cbt = cbt if cbt is not None else LvmCbt()
+
+        # with parallel LVs, the repository (and cache) may only be used by one thread at a time
+        self.repo_lock = threading.RLock()
+        self._abort = threading.Event()
+        # gets the delta of a volume while the LVs are processed (see CbtProvider.deltas)
+        self._get_delta = None
+        # a local repository writes the chunks as they are put, a remote one only queues them (see _commit_chunk)
+        self.sync_puts = isinstance(self.cache.repository, Repository)
 
     @staticmethod
     def _segmap_for_delta(*, total_blocks, delta):
         """A bit like an fmap, but really just filling in the gaps in the LVM delta info"""
-        # TODO: possibly merge holes together
+        # adjacent segments of the same type are merged by _merge_segments
         i = 0
         for segment in delta:
             # it seems that thin_{dump,delta} can report blocks beyond the size of the thin LV (when shrunk?)
@@ -1758,42 +2221,205 @@ def _segmap_for_delta(*, total_blocks, delta):
             # account for hole at the end
             yield (i, total_blocks - i, 'hole')
 
-    class DenseDeltaFile:
-        def __init__(self, *, segmap, block_size, fd):
-            self.segmap = segmap
-            self.block_size = block_size
-            self.fd = fd
+    @staticmethod
+    def _merge_segments(segmap):
+        """Merge adjacent segments of the same type (thin_dump gives us one mapping per block when fragmented)"""
+        pending = None
+        for segment in segmap:
+            if pending is not None and pending[2] == segment[2] and pending[0] + pending[1] == segment[0]:
+                pending = (pending[0], pending[1] + segment[1], pending[2])
+                continue
+            if pending is not None:
+                yield pending
+            pending = segment
+        if pending is not None:
+            yield pending
+
+    class CompactSegmap:
+        """Segmap kept in arrays rather than a list of tuples, for holding the segmaps of big LVs in memory"""
+
+        types = ('hole', 'new', 'old')
+
+        def __init__(self, segmap=()):
+            self.begins = array('Q')
+            self.lengths = array('Q')
+            self.type_ids = bytearray()
+            for segment in segmap:
+                self.append(segment)
+
+        def append(self, segment):
+            begin, length, t = segment
+            self.begins.append(begin)
+            self.lengths.append(length)
+            self.type_ids.append(self.types.index(t))
+
+        def __len__(self):
+            return len(self.type_ids)
+
+        def __iter__(self):
+            types = self.types
+            for begin, length, type_id in zip(self.begins, self.lengths, self.type_ids):
+                yield (begin, length, types[type_id])
 
-            self.pos = -1
-            self._advance()
+    @staticmethod
+    def _reread_partial_old(*, segmap, block_size, chunks):
+        """
+        Turn the parts of 'old' segments which don't cover a whole old chunk into 'new' segments.
 
-        def _advance(self):
+        Only valid if all old chunk boundaries fall on blocks: the partial chunks can then be read from the
+        new snapshot (the data is the same) instead of having to fetch and split the old chunks.
+        """
+        chunk_iter = iter(chunks)
+        # blocks covered by the current old chunk
+        chunk_start = chunk_end = 0
+        for (start, length, t) in segmap:
+            if t != 'old':
+                yield (start, length, t)
+                continue
+
+            end = start + length
+            pos = start
+            # pending segment, adjacent parts of the same type are merged
+            seg_start, seg_type = start, None
+            while pos < end:
+                while chunk_end <= pos:
+                    chunk_start, chunk_end = chunk_end, chunk_end + next(chunk_iter).size // block_size
+                part_end = min(chunk_end, end)
+                part_type = 'old' if chunk_start == pos and chunk_end <= end else 'new'
+                if part_type != seg_type:
+                    if seg_type is not None:
+                        yield (seg_start, pos - seg_start, seg_type)
+                    seg_start, seg_type = pos, part_type
+                pos = part_end
+            yield (seg_start, end - seg_start, seg_type)
+
+    class SegmapSplitter:
+        """
+        Hands out the segments of a (lazily generated) segmap to several consumers.
+
+        Each view only sees the segments of the types it was created for. Segments are pulled from the
+        source only when a view runs dry, so only those between the slowest and fastest view are kept
+        around. All views need to be created before any of them is iterated.
+        """
+
+        def __init__(self, segmap):
+            self.source = iter(segmap)
+            self.views = []
+
+        def view(self, *types):
+            pending = deque()
+            self.views.append((types, pending))
+            return self._iter_view(pending)
+
+        def _iter_view(self, pending):
             while True:
-                self.pos += 1
-                self.offset = 0
-                if self.pos == len(self.segmap):
-                    break
+                while not pending:
+                    segment = next(self.source, None)
+                    if segment is None:
+                        return
+                    for types, view_pending in self.views:
+                        if segment[2] in types:
+                            view_pending.append(segment)
+                yield pending.popleft()
 
-                if self.segmap[self.pos][2] == 'new':
-                    os.lseek(self.fd, self.segmap[self.pos][0] * self.block_size, os.SEEK_SET)
+    class DenseDeltaFile:
+        """
+        File-like object reading the 'new' segments of a snapshot back to back.
+
+        Adjacent segments are coalesced into ranges, the kernel is asked to read ahead the ranges coming
+        up and reads spanning several ranges are gathered into a reusable buffer (so the chunker gets
+        big reads without lots of small ones being concatenated).
+        """
+
+        # how much data (in bytes) the kernel is asked to read ahead
+        readahead = 64 * 1024 * 1024
+        # ranges are split up so readahead stays within bounds (and old data gets dropped from the page cache)
+        max_range = 16 * 1024 * 1024
+        # how many ranges we look ahead at most (the segmap is generated as we go)
+        max_pending = 1024
+
+        def __init__(self, *, segmap, block_size, fd, stats=None):
+            self.ranges = self._coalesce(segmap, block_size, self.max_range)
+            self.fd = fd
+            # reads are accounted as the 'read' stage, if given
+            self.stats = stats
+            # upcoming (offset, size) ranges, already advised to the kernel
+            self.pending = deque()
+            self.pending_size = 0
+            # current range
+            self.start = self.pos = self.end = 0
+            self.buffer = bytearray()
+            self._advise()
+
+        @staticmethod
+        def _coalesce(segmap, block_size, max_range):
+            start = end = None
+            for (begin, length, t) in segmap:
+                if t != 'new':
+                    continue
+                if begin * block_size != end:
+                    if start is not None:
+                        yield start, end - start
+                    start = begin * block_size
+                end = (begin + length) * block_size
+                while end - start > max_range:
+                    yield start, max_range
+                    start += max_range
+            if start is not None:
+                yield start, end - start
+
+        def _advise(self):
+            while self.pending_size < self.readahead and len(self.pending) < self.max_pending:
+                r = next(self.ranges, None)
+                if r is None:
                     break
+                safe_fadvise(self.fd, r[0], r[1], 'WILLNEED')
+                self.pending.append(r)
+                self.pending_size += r[1]
+
+        def _next_range(self):
+            if self.end:
+                # we won't read this range again, don't spoil the page cache with it (like the chunker does)
+                safe_fadvise(self.fd, self.start, self.end - self.start, 'DONTNEED')
+            self._advise()
+            if not self.pending:
+                self.start = self.pos = self.end = 0
+                return False
+            offset, size = self.pending.popleft()
+            self.pending_size -= size
+            self.start = self.pos = offset
+            self.end = offset + size
+            return True
 
         def read(self, n):
-            if self.pos == len(self.segmap):
+            started = time.monotonic()
+            data = self._read(n)
+            if self.stats is not None:
+                self.stats.add_stage('read', time.monotonic() - started, len(data))
+            return data
+
+        def _read(self, n):
+            if self.pos == self.end and not self._next_range():
                 return bytes()
 
-            begin, length, _ = self.segmap[self.pos]
-            f_pos = begin * self.block_size
-            seg_size = length * self.block_size
-            to_read = min(n, seg_size - self.offset)
-
-            data = os.read(self.fd, to_read)
-            assert len(data) == to_read
-            self.offset += to_read
-            if to_read < n:
-                self._advance()
-                return data + self.read(n - to_read)
-            return data
+            if n <= self.end - self.pos:
+                data = os.pread(self.fd, n, self.pos)
+                assert len(data) == n
+                self.pos += n
+                return data
+
+            # the read spans several ranges, gather them in our buffer
+            if len(self.buffer) < n:
+                self.buffer = bytearray(n)
+            buf = memoryview(self.buffer)
+            got = 0
+            while got < n and (self.pos < self.end or self._next_range()):
+                size = min(n - got, self.end - self.pos)
+                read = os.preadv(self.fd, [buf[got:got + size]], self.pos)
+                assert read == size
+                got += size
+                self.pos += size
+            return bytes(buf[:got])
 
     @staticmethod
     def _new_chunks_align(*, segmap, block_size, chunk_iter):
@@ -1831,20 +2457,21 @@ def _new_chunks_align(*, segmap, block_size, chunk_iter):
             # signal to the caller the segment is complete
             yield None
 
-    def _old_chunks_filter_and_align(self, *, segmap, block_size, chunks):
+    @classmethod
+    def _old_chunks_plan(cls, *, segmap, block_size, chunks):
+        """
+        Map the 'old' segments onto the old chunks.
+
+        Yields whole ChunkListEntrys (to be passed through), ModChunkInfos (parts of chunks, to be fetched
+        and processed) and None at the end of each segment.
+        """
         LeftoverInfo = namedtuple('LeftoverInfo', 'id size offset')
-        ModChunkInfo = namedtuple('ModChunkInfo', 'id start end')
 
         chunk_iter = enumerate(chunks)
         # where we actually are in the chunk stream
         chunk_stream_pos = 0
         # info about leftover data from a potential partially-consumed chunk
         leftover = None
-        # list of either whole ChunkListEntrys (to be passed through) and
-        # ModChunkInfos (to be fetched and processed)
-        aligned = []
-        # list of chunks we need to download in order to split them up
-        to_fetch = []
         for (start, length, t) in segmap:
             if t != 'old':
                 continue
@@ -1893,7 +2520,11 @@ def _old_chunks_filter_and_align(self, *, segmap, block_size, chunks):
                 if c_start != 0 or c_end != real_size:
                     # we aren't consuming a whole real chunk, so create some info that we can use to
                     # later fetch and grab some data from.
-                    info = ModChunkInfo(id=chunk.id, start=c_start, end=c_end)
+                    if chunk.id is None:
+                        # part of a hole of the old item, nothing to fetch
+                        info = Chunk(None, size=c_end - c_start, allocation=CH_HOLE)
+                    else:
+                        info = cls.ModChunkInfo(id=chunk.id, start=c_start, end=c_end)
 
                     # if there's some data left in this chunk we might want to consume it in the next segment
                     remaining = real_size - c_end
@@ -1902,15 +2533,14 @@ def _old_chunks_filter_and_align(self, *, segmap, block_size, chunks):
                     else:
                         # nothing left, so clear the leftover
                         leftover = None
-
-                    # store away this chunk's id so we can fetch it later (assuming it's not already queued up)
-                    if not to_fetch or to_fetch[-1] != chunk.id:
-                        to_fetch.append(chunk.id)
+                elif chunk.id is None:
+                    # a whole hole of the old item (see Item.chunks_with_holes)
+                    info = Chunk(None, size=chunk.size, allocation=CH_HOLE)
                 else:
                     # consumed whole chunk (not a leftover), so we can keep the ChunkListEntry
                     info = chunk
 
-                aligned.append(info)
+                yield info
 
                 # how much we ate from the underlying chunk
                 consumed = c_end - c_start
@@ -1925,22 +2555,65 @@ def _old_chunks_filter_and_align(self, *, segmap, block_size, chunks):
                 assert seg_pos <= seg_size
 
             # signal to the caller the segment is complete
-            aligned.append(None)
+            yield None
 
-        fetch_iter = self.archive.pipeline.fetch_many(to_fetch, is_preloaded=False)
+    def _old_chunks_filter_and_align(self, *, segmap, block_size, chunks, stats=None):
+        plan = self._old_chunks_plan(segmap=segmap, block_size=block_size, chunks=chunks)
+        pipeline = self.archive.pipeline
+        # planned, but not yet yielded entries
+        window = deque()
+        # ids of chunks which were preloaded, but not fetched yet
+        preloaded = deque()
+        last_preloaded = None
+        planned_all = False
         last_id = None
         data = None
-        for info in aligned:
-            if info is None or isinstance(info, ChunkListEntry):
-                # either the end of a segment or a whole chunk, just pass it through
-                yield info
-                continue
+        try:
+            while True:
+                # plan ahead, so the chunks we need to split are already on their way while we get to them
+                to_preload = []
+                while (not planned_all and len(window) < self.plan_window
+                        and len(preloaded) + len(to_preload) < self.preload_window):
+                    try:
+                        info = next(plan)
+                    except StopIteration:
+                        planned_all = True
+                        break
+                    window.append(info)
+                    if isinstance(info, self.ModChunkInfo) and info.id != last_preloaded:
+                        to_preload.append(info.id)
+                        last_preloaded = info.id
+                if to_preload:
+                    with self.repo_lock:
+                        pipeline.repository.preload(to_preload)
+                    preloaded.extend(to_preload)
+
+                if not window:
+                    return
+                info = window.popleft()
+                if not isinstance(info, self.ModChunkInfo):
+                    # either the end of a segment, a whole chunk or a hole, just pass it through
+                    yield info
+                    continue
 
-            # we haven't downloaded this chunk yet
-            if last_id is None or info.id != last_id:
-                data = next(fetch_iter)
-                last_id = info.id
-            yield Chunk(data[info.start:info.end], size=info.end-info.start, allocation=CH_DATA)
+                # we haven't downloaded this chunk yet
+                if last_id is None or info.id != last_id:
+                    fetch_id = preloaded.popleft()
+                    assert fetch_id == info.id
+                    started = time.monotonic()
+                    with self.repo_lock:
+                        data = next(pipeline.fetch_many([fetch_id], is_preloaded=True))
+                    if stats is not None:
+                        stats.add_stage('fetch', time.monotonic() - started, len(data))
+                    last_id = info.id
+                yield Chunk(data[info.start:info.end], size=info.end-info.start, allocation=CH_DATA)
+        except GeneratorExit:
+            # preloaded chunks need to be retrieved, otherwise they pile up in the (remote) repository
+            if preloaded:
+                with self.repo_lock:
+                    for _ in pipeline.fetch_many(list(preloaded), is_preloaded=True):
+                        pass
+            raise
 
     @staticmethod
     def _zeros_align(*, segmap, block_size):
@@ -1948,25 +2621,76 @@ def _zeros_align(*, segmap, block_size):
             if t != 'hole':
                 continue
 
-            seg_pos = 0
-            seg_size = length * block_size
-            while seg_pos < seg_size:
-                size = min(seg_size - seg_pos, len(zeros))
-                yield Chunk(None, size=size, allocation=CH_HOLE)
-                seg_pos += size
+            # holes don't become chunks (see _record_holes), so there is no need to split them up
+            yield Chunk(None, size=length * block_size, allocation=CH_HOLE)
 
             # signal to the caller the segment is complete
             yield None
 
-    def delta_chunkify(self, *, fd, total_blocks, block_size, delta, old_chunks):
-        segmap = list(self._segmap_for_delta(total_blocks=total_blocks, delta=delta))
-
-        hole_iter = self._zeros_align(segmap=segmap, block_size=block_size)
+    @classmethod
+    def _plan_segmap(cls, *, segmap, block_size, old_chunks, aligned=False):
+        """Adjust the segmap of the delta to how the old chunks will be processed"""
+        if aligned and old_chunks:
+            # the old chunks were cut on blocks (see align_chunks), so we never need to fetch any of them.
+            # merge what is re-read with the 'new' segments around it, so chunks aren't cut between them.
+            segmap = cls._merge_segments(
+                cls._reread_partial_old(segmap=segmap, block_size=block_size, chunks=old_chunks))
+        return segmap
 
-        fo = self.DenseDeltaFile(segmap=segmap, block_size=block_size, fd=fd)
-        new_chunk_iter = self._new_chunks_align(segmap=segmap, block_size=block_size, chunk_iter=self.chunker.chunkify(fo))
+    @classmethod
+    def _resume_plan(cls, *, segmap, block_size, done_chunks, old_chunks):
+        """
+        Adjust the delta and old chunks of an LV resumed from a checkpoint, to keep what its part item has.
 
-        old_chunk_iter = self._old_chunks_filter_and_align(segmap=segmap, block_size=block_size, chunks=old_chunks)
+        The blocks covered by *done_chunks* (of the part item) become an 'old' segment on them. From the block
+        the part item ends in up to the next boundary of the old chunks (of the last archive), blocks are re-read.
+        The rest of the delta stays as it is. Returns (segmap, old_chunks).
+        """
+        done = sum(cle.size for cle in done_chunks)
+        # the old chunks which start at or after the end of the part item are still needed
+        skip = boundary = 0
+        while boundary < done and skip < len(old_chunks):
+            boundary += old_chunks[skip].size
+            skip += 1
+        begin = done // block_size
+        end = max(-(-boundary // block_size), begin)
+
+        chunks = list(done_chunks)
+        if boundary > done:
+            # keeps the old chunks in their place, it's within the re-read blocks so it is never used
+            chunks.append(ChunkListEntry(None, boundary - done))
+        chunks += old_chunks[skip:]
+
+        def resumed_segmap():
+            if begin:
+                yield (0, begin, 'old')
+            for start, length, t in segmap:
+                for lo, hi, t in ((begin, end, 'new' if t == 'old' else t), (end, start + length, t)):
+                    lo, hi = max(lo, start), min(hi, start + length)
+                    if lo < hi:
+                        yield (lo, hi - lo, t)
+
+        return cls._merge_segments(resumed_segmap()), chunks
+
+    def delta_chunkify(self, *, fd, block_size, segmap, old_chunks, aligned=False, chunker=None, stats=None):
+        chunker = chunker or self.chunker
+        stats = stats or self.stats
+        segmap = self._plan_segmap(segmap=segmap, block_size=block_size, old_chunks=old_chunks, aligned=aligned)
+        # the delta is consumed as it is parsed, each stage gets to see the segments relevant to it
+        segments = self.SegmapSplitter(segmap)
+        segmap = segments.view('hole', 'new', 'old')
+        hole_segmap = segments.view('hole')
+        read_segmap = segments.view('new')
+        new_segmap = segments.view('new')
+        old_segmap = segments.view('old')
+
+        hole_iter = self._zeros_align(segmap=hole_segmap, block_size=block_size)
+
+        fo = self.DenseDeltaFile(segmap=read_segmap, block_size=block_size, fd=fd, stats=stats)
+        new_chunk_iter = self._new_chunks_align(segmap=new_segmap, block_size=block_size, chunk_iter=chunker.chunkify(fo))
+
+        old_chunk_iter = self._old_chunks_filter_and_align(
+            segmap=old_segmap, block_size=block_size, chunks=old_chunks, stats=stats)
         for (_, _, t) in segmap:
             #print(f'seg_{t},{b*block_size},{l*block_size}', file=f)
             match t:
@@ -1979,188 +2703,536 @@ def delta_chunkify(self, *, fd, total_blocks, block_size, delta, old_chunks):
 
             started_chunking = time.monotonic()
             while chunk := next(it):
-                self.stats.chunking_time += time.monotonic() - started_chunking
+                stats.chunking_time += time.monotonic() - started_chunking
                 yield chunk
                 started_chunking = time.monotonic()
 
     @staticmethod
-    def wrap_lvm_call(task, fun, *args, **kwargs):
-        """Replace CalledProcessError with BackupError (so backup continues for other LVs)"""
+    def _record_holes(item, chunk_iter):
+        """Leave the holes out of the chunk stream, they are kept in item.holes instead"""
+        holes = []
+        offset = 0
+        for chunk in chunk_iter:
+            if isinstance(chunk, ChunkListEntry):
+                offset += chunk.size
+                yield chunk
+                continue
+
+            size = chunk.meta['size']
+            if chunk.meta['allocation'] == CH_HOLE:
+                if holes and sum(holes[-1]) == offset:
+                    holes[-1] = (holes[-1][0], holes[-1][1] + size)
+                else:
+                    holes.append((offset, size))
+                    item.holes = holes
+            else:
+                yield chunk
+            offset += size
+
+    @staticmethod
+    def _cbt_call(stats, fun, *args, **kwargs):
+        """Call *fun* of the CBT provider, accounting the time as the 'cbt' stage (LVM commands, for LvmCbt)"""
+        started = time.monotonic()
         try:
             return fun(*args, **kwargs)
-        except subprocess.CalledProcessError as ex:
-            if ex.returncode != 5:
-                raise
-            raise BackupError(f'LVM {task} failed')
+        finally:
+            stats.add_stage('cbt', time.monotonic() - started)
 
     @contextmanager
-    def next_snap(self, *, vg, lv):
-        # https://github.com/lvmteam/lvm2/blob/b84a9927b78727efffbb257a61e9e95a648cdfab/lib/misc/lvm-string.c#L49
-        # tag charset: A-Za-z0-9._-+/=!:&# (aka fine for plain base64)
-        # seems length is unlimited?
-        archive_name_clean = base64.b64encode(self.archive.name.encode('utf-8')).decode('ascii')
-        name = f'{lv}_{time.time_ns() // 1000 // 1000}' # time in ms suffix so it's unique (but still short)
-        logger.debug(f'creating next snap {vg}/{name}')
-        self.wrap_lvm_call(f'create new backup snapshot {vg}/{name}', lvm.create,
-            name,
-            '-pr', # read-only
-            '-kn', # no activation skip
-            '-ay', # activate now
-            f'--addtag=borgrepo-{self.archive.repository.id_str}', # id_str is a hex string
-            f'--addtag=borgarch-{archive_name_clean}',
-            '--snapshot', f'{vg}/{lv}')
-        info = lvm.get_lvs(f'{vg}/{name}')[0]
+    def next_snap(self, job):
+        """
+        Take the new snapshot of the job's volume (or resume its partial one), which replaces the last one if the
+        with-block completes.
 
+        If it fails after a checkpoint archive got a part item of the volume, the snapshot is kept as partial for
+        the next backup to resume from. Otherwise a new snapshot is dropped, a resumed one stays as it was.
+        """
+        snap = job.resume_snap or self._cbt_call(
+            job.stats, self.cbt.create_snapshot,
+            job.volume, repo_id=self.archive.repository.id_str, archive_name=self.archive.name)
         try:
-            yield info
+            yield snap
         except:
-            lvm.remove(info['lv_uuid'])
+            if job.checkpoints is not None and self.chunks_processor.checkpoints > job.checkpoints:
+                logger.info(f'{job.name}: keeping snapshot {snap.name} to resume from the checkpoint')
+                self._cbt_call(job.stats, self.cbt.mark_partial, snap, archive_name=self.archive.name)
+            elif job.resume_snap is None:
+                self._cbt_call(job.stats, self.cbt.release_snapshot, snap)
             raise
 
-        self.wrap_lvm_call(
-            f'mark new backup snapshot {vg}/{name} as completed', lvm.change,
-            info['lv_uuid'], '--addtag', 'borgthin-last')
+        self._cbt_call(job.stats, self.cbt.commit_snapshot, snap, archive_name=self.archive.name)
 
-    @contextmanager
-    def consume_oldsnap(self, *, lv_info, thin_meta_path, nextsnap_info):
-        lv_qual = lv_info['lv_full_name']
+    def _checkpointed_chunks(self, volume, snapshot):
+        """
+        Return the chunks (with holes) of the volume's part item in the latest checkpoint of the archive the
+        partial *snapshot* was backed up to, or None.
+        """
+        if snapshot.archive_name is None:
+            return None
+        prefix = snapshot.archive_name + '.checkpoint'
+        checkpoints = [
+            info.name for info in self.archive.manifest.archives.list(sort_by=('ts',))
+            if info.name == prefix or info.name.startswith(prefix + '.') and info.name[len(prefix) + 1:].isdigit()]
+        if not checkpoints:
+            return None
+
+        logger.debug(f"loading checkpoint '{checkpoints[-1]}' for {volume.name}")
+        path = make_path_safe(volume.name) + '.borg_part'
+        with self.repo_lock:
+            checkpoint = Archive(self.archive.manifest, checkpoints[-1], cache=self.cache)
+            for item in checkpoint.iter_items(preload=False, filter=lambda i: i.path == path):
+                return item.chunks_with_holes()
+        return None
 
-        lvs = lvm.get_lvs(
-            select=f'origin_uuid="{lv_info["lv_uuid"]}" && tags={{"borgrepo-{self.archive.repository.id_str}" && "borgthin-last"}}')
-        if not lvs:
-            yield None, None
+    @contextmanager
+    def consume_oldsnap(self, volume, *, stats):
+        lastsnap = self._cbt_call(stats, self.cbt.last_snapshot, volume, repo_id=self.archive.repository.id_str)
+        if lastsnap is None:
+            yield None, None, False
             return
-        if len(lvs) != 1:
-            raise BackupError(f'Inconsistency detected: More than one valid snapshot exists for {lv_qual}')
-
-        lastsnap_info = lvs[0]
-        lastsnap_tags = lastsnap_info['lv_tags'].split(',')
-        lv_lastsnap_qual = lastsnap_info['lv_full_name']
-        for tag in lastsnap_tags:
-            m = self.snap_archname_re.match(tag)
-            if m:
-                last_arch_name = base64.b64decode(m.group(1)).decode('utf-8')
-                break
-        else:
-            logger.warning(f'Old snapshot {lv_lastsnap_qual} is missing a borgarch tag')
-            yield None, None
+
+        last_arch_name = lastsnap.archive_name
+        if last_arch_name is None:
+            logger.warning(f'Old snapshot {lastsnap.name} is missing a borgarch tag')
+            yield None, None, False
             return
 
-        logger.debug(f"loading old archive '{last_arch_name}' for {lv_qual}")
+        logger.debug(f"loading old archive '{last_arch_name}' for {volume.name}")
+        path = make_path_safe(volume.name)
         try:
-            last_archive = Archive(self.archive.manifest, last_arch_name, cache=self.cache)
+            with self.repo_lock:
+                last_archive = Archive(self.archive.manifest, last_arch_name, cache=self.cache)
         except Archive.DoesNotExist:
-            logger.warning(f"Old archive '{last_arch_name}' not found for LV {lv_qual}")
-            yield None, None
+            logger.warning(f"Old archive '{last_arch_name}' not found for LV {volume.name}")
+            yield None, None, False
             return
 
         old_meta = self._old_meta_cache.get(last_arch_name)
         last_item = None
-        for it in last_archive.iter_items(
+        for it in locked_iter(self.repo_lock, last_archive.iter_items(
                 preload=False,
-                filter=lambda i: i.path == lv_qual or (old_meta is None and i.path == self.meta_path)):
+                filter=lambda i: i.path == path or (old_meta is None and i.path == self.meta_path))):
             if it.path == self.meta_path:
                 up = msgpack.Unpacker(use_list=False)
-                for data in self.archive.pipeline.fetch_many([cle.id for cle in it.chunks], is_preloaded=False):
+                fetch_iter = self.archive.pipeline.fetch_many([cle.id for cle in it.chunks], is_preloaded=False)
+                for data in locked_iter(self.repo_lock, fetch_iter):
                     up.feed(data)
                 self._old_meta_cache[last_arch_name] = old_meta = self.Metadata(internal_dict=next(up))
             else:
                 last_item = it
         if old_meta is None:
             logger.warning(f"Thin metadata is missing from old archive '{last_arch_name}'")
-            yield None, None
+            yield None, None, False
             return
         if last_item is None:
-            logger.warning(f"LV {lv_qual} not found in old archive '{last_arch_name}'")
-            yield None, None
+            logger.warning(f"LV {volume.name} not found in old archive '{last_arch_name}'")
+            yield None, None, False
             return
 
-        last_meta = old_meta.get_lv(lv_info['lv_uuid'])
+        last_meta = old_meta.get_lv(volume.uuid)
         if last_meta is None:
-            logger.warning(f"Metadata is missing for LV {lv_qual} in old archive '{last_arch_name}'")
-            yield None, None
+            logger.warning(f"Metadata is missing for LV {volume.name} in old archive '{last_arch_name}'")
+            yield None, None, False
             return
-        if last_meta['snapshot_uuid'] != lastsnap_info['lv_uuid']:
+        if last_meta['snapshot_uuid'] != lastsnap.uuid:
             logger.warning(
-                f"UUID of snapshot for LV {lv_qual} in old archive '{last_arch_name}' doesn't match "
-                f"(snapshot is {lastsnap_info['lv_uuid']}, archive has {last_meta['snapshot_uuid']})")
-            yield None, None
+                f"UUID of snapshot for LV {volume.name} in old archive '{last_arch_name}' doesn't match "
+                f"(snapshot is {lastsnap.uuid}, archive has {last_meta['snapshot_uuid']})")
+            yield None, None, False
             return
 
-        logger.debug(f"calculating thin delta for {lastsnap_info['lv_full_name']} -> {nextsnap_info['lv_full_name']}")
-        delta = self.wrap_lvm_call(
-            f'calculate delta from last snapshot {lv_lastsnap_qual}', lvm.thin_delta,
-            thin_meta_path, int(lastsnap_info['thin_id']), int(nextsnap_info['thin_id']))
-        yield delta, last_item.chunks
-
-        self.wrap_lvm_call(
-            f'delete last snapshot {lv_lastsnap_qual}', lvm.remove,
-            lastsnap_info['lv_uuid'])
-
-    def process_lv(self, *, vg, lv):
-        lv_qual = f'{vg}/{lv}'
-        lvs = lvm.get_lvs(lv_qual)
-        if not lvs:
-            raise BackupError(f'LV {lv_qual} not found')
-
-        info = lvs[0]
-        if not info['pool_lv'] or info['segtype'] != 'thin':
-            raise BackupError(f'{lv_qual} is not a thin LV')
-
-        pool_info = lvm.get_lvs(uuid=info['pool_lv_uuid'])[0]
-        block_size = lvm.get_size(pool_info, 'chunk_size')
-        meta_info = lvm.get_lvs(uuid=pool_info['metadata_lv_uuid'])[0]
-
-        with self.next_snap(vg=vg, lv=lv) as nextsnap_info:
-            nextsnap_size = lvm.get_size(nextsnap_info, 'lv_size')
-            assert nextsnap_size % block_size == 0
-
-            with lvm.meta_snapshot(pool_info['lv_dm_path'] + '-tpool'):
-                with OsOpen(path=nextsnap_info['lv_path'], flags=flags_special_follow) as fd:
-                    t = int(time.time()) * 1000000000
-                    item = Item(
-                        path=lv_qual, size=nextsnap_size, mode=0o100660, # forcing regular file mode
-                        mtime=t, atime=t, ctime=t)
-                    self.metadata.add_lv(info['lv_uuid'], snapshot_uuid=nextsnap_info['lv_uuid'])
-
-                    with self.consume_oldsnap(
-                            lv_info=info,
-                            thin_meta_path=meta_info['lv_dm_path'],
-                            nextsnap_info=nextsnap_info) as (delta, old_chunks):
-                        if delta is None or old_chunks is None:
-                            logger.warning(f'Valid old archive for {lv_qual} not found, backing up from scratch')
-                            delta = self.wrap_lvm_call(
-                                f"dump {nextsnap_info['lv_full_name']} thin metadata", lvm.thin_dump,
-                                meta_info['lv_dm_path'], int(nextsnap_info['thin_id']))
-                            old_chunks = []
-
-                            status = 'A'
-                        else:
-                            status = 'M'
+        # archives from before align_chunks was recorded are taken as not aligned
+        yield lastsnap, last_item.chunks_with_holes(), last_meta.get('align_chunks', False)
 
-                        try:
-                            chunk_iter = self.delta_chunkify(
-                                fd=fd, total_blocks=nextsnap_size // block_size,
-                                block_size=block_size, delta=delta, old_chunks=old_chunks)
+        self._cbt_call(stats, self.cbt.release_snapshot, lastsnap)
 
-                            self.print_file_status(status, lv_qual)
-                            self.stats.files_stats[status] += 1
-                            with backup_io("read"):
-                                logger.debug(f'processing chunks for {lv_qual}')
-                                self.process_file_chunks(
-                                    item, self.cache, self.stats, self.show_progress,
-                                    backup_io_iter(chunk_iter))
+    @staticmethod
+    def _abandon(job, error):
+        """Be done with a prepared job without backing it up: drop its new snapshot (keeping the last one)"""
+        job.error = error
+        stack, job.stack = job.stack, None
+        try:
+            stack.__exit__(type(error), error, error.__traceback__)
+        except CbtError as e:
+            logger.warning(f'{job.name}: {e}')
+
+    def _find_resume(self, job):
+        """Set the job up to resume from the volume's partial snapshot, if there is one with a usable checkpoint"""
+        partial = self._cbt_call(
+            job.stats, self.cbt.partial_snapshot, job.volume, repo_id=self.archive.repository.id_str)
+        if partial is None:
+            return
+        done_chunks = self._checkpointed_chunks(job.volume, partial)
+        if done_chunks is None or sum(cle.size for cle in done_chunks) > partial.size:
+            logger.warning(f'No checkpoint found to resume {job.name} from, dropping partial snapshot {partial.name}')
+            self._cbt_call(job.stats, self.cbt.release_snapshot, partial)
+            return
+        logger.info(f'{job.name}: resuming from checkpoint of archive {partial.archive_name}')
+        job.resume_snap, job.done_chunks = partial, done_chunks
 
-                            self.stats.nfiles += 1
-                        except (BackupError, BackupOSError):
-                            # take care of potential orphaned chunks in a failure scenario
-                            for chunk in item.get("chunks", []):
-                                cache.chunk_decref(chunk.id, self.stats, wait=False)
-                            raise
+    def _prepare_lvs(self, jobs):
+        """
+        Snapshot all volumes, before getting the delta of any of them (see _plan_lv).
 
-        self.archive.add_item(item, stats=self.stats)
+        With all snapshots taken first, the provider can share work between the deltas (e.g. one metadata snapshot
+        per thin pool, rather than one per LV, see CbtProvider.deltas).
+        A volume with a partial snapshot (of a backup which was interrupted after a checkpoint) is resumed: the
+        snapshot is used again and only what its part item doesn't have yet is processed (see _resume_plan).
+        Jobs which can't be prepared get their error set.
+        """
+        for job in jobs:
+            job.stack = ExitStack()
+            try:
+                job.volume = self._cbt_call(job.stats, self.cbt.get_volume, job.name)
+                self._find_resume(job)
+                job.nextsnap = job.stack.enter_context(self.next_snap(job))
+                assert job.nextsnap.size % job.volume.block_size == 0
+            except (BackupOSError, BackupError, CbtError) as e:
+                self._abandon(job, e)
+
+    @staticmethod
+    def _timed_segmap(segmap, *, stats, size):
+        """Account getting the delta (e.g. running thin_delta) and parsing it as the 'delta' stage of the LV"""
+        seconds = 0
+        try:
+            while True:
+                started = time.monotonic()
+                segment = next(segmap, None)
+                seconds += time.monotonic() - started
+                if segment is None:
+                    return
+                yield segment
+        finally:
+            stats.add_stage('delta', seconds, size)
+
+    @contextmanager
+    def _plan_lv(self, job, stack):
+        """
+        Get the delta of a prepared volume since its last snapshot (see consume_oldsnap, which is entered into
+        *stack*) and yield the segmap to process.
+
+        The segmap is generated as the delta is read, it is only valid within the with-block.
+        """
+        lastsnap, old_chunks, old_aligned = stack.enter_context(self.consume_oldsnap(job.volume, stats=job.stats))
+        if lastsnap is None or old_chunks is None:
+            logger.warning(f'Valid old archive for {job.name} not found, backing up from scratch')
+            lastsnap = None
+            old_chunks = []
+            old_aligned = True
+        job.lastsnap, job.old_chunks, job.old_aligned = lastsnap, old_chunks, old_aligned
+
+        volume, nextsnap = job.volume, job.nextsnap
+        with self._get_delta(volume, lastsnap, nextsnap) as delta:
+            segmap = self._merge_segments(self._segmap_for_delta(
+                total_blocks=nextsnap.size // volume.block_size, delta=delta))
+            if job.done_chunks is not None:
+                segmap, job.old_chunks = self._resume_plan(
+                    segmap=segmap, block_size=volume.block_size, done_chunks=job.done_chunks,
+                    old_chunks=job.old_chunks)
+                # the part item was cut by the interrupted run, which may not have had align_chunks
+                job.old_aligned = job.old_aligned and self.align_chunks and all(
+                    cle.size % volume.block_size == 0 for cle in job.done_chunks)
+            yield self._timed_segmap(segmap, stats=job.stats, size=nextsnap.size)
+
+    def _get_chunker(self, block_size):
+        """Get a chunker for an LV in a pool with the given block (chunk) size"""
+        # each LV gets its own chunker, as they can be processed in parallel.
+        # holes are known from the delta, the chunker only ever gets to see the 'new' segments (see DenseDeltaFile)
+        chunker = get_chunker(*self.chunker_params, seed=self.key.chunk_seed, sparse=False)
+        if not self.align_chunks:
+            return chunker
+
+        algo, *params = self.chunker_params
+        max_size = 2 ** params[1] if algo == CH_BUZHASH else params[0]
+        if max_size + block_size > MAX_DATA_SIZE:
+            raise BackupError(f'pool chunk size {block_size} is too big to align chunks to')
+        return ChunkerAligned(chunker, block_size)
+
+    @contextmanager
+    def open_lv(self, job, *, stats):
+        """
+        Set up processing of what changed in a prepared volume (see _prepare_lvs) since its last snapshot (see
+        _plan_lv).
+
+        Yields the volume's item (without chunks), its status and an iterator over the chunks for the item.
+        The new snapshot only replaces the last one if the with-block completes without error.
+        """
+        if job.error is not None:
+            raise job.error
+        stack, job.stack = job.stack, None
+        with stack:
+            volume, nextsnap = job.volume, job.nextsnap
+            job.checkpoints = self.chunks_processor.checkpoints
+            chunker = self._get_chunker(volume.block_size)
+            segmap = stack.enter_context(self._plan_lv(job, stack))
+            with backup_io('open'):
+                fd = self.cbt.open_snapshot(nextsnap)
+            try:
+                t = int(time.time()) * 1000000000
+                item = Item(
+                    path=make_path_safe(volume.name), size=nextsnap.size, mode=0o100660,  # forcing regular file mode
+                    mtime=t, atime=t, ctime=t)
+                status = 'A' if job.lastsnap is None else 'M'
+
+                chunk_iter = self.delta_chunkify(
+                    fd=fd, block_size=volume.block_size, segmap=segmap, old_chunks=job.old_chunks,
+                    aligned=job.old_aligned, chunker=chunker, stats=stats)
+                yield item, status, self._record_holes(item, chunk_iter)
+            finally:
+                os.close(fd)
+
+    @staticmethod
+    def _until_interrupted(chunk_iter):
+        """Stop once the checkpoint asked for by Ctrl-C / SIGINT is written, the LV can be resumed from there"""
+        for chunk in chunk_iter:
+            if sig_int and sig_int.action_done():
+                raise BackupError('interrupted')
+            yield chunk
+
+    def process_lv(self, job):
+        try:
+            with self.open_lv(job, stats=job.stats) as (item, status, chunk_iter):
+                item.chunks = []
+                job.item = item
+                try:
+                    self.print_file_status(status, job.name)
+                    self.stats.files_stats[status] += 1
+                    with backup_io("read"):
+                        logger.debug(f'processing chunks for {job.name}')
+                        chunk_iter = backup_io_iter(self._until_interrupted(chunk_iter))
+                        # packed by the workers of the chunks processor (if any), stored here in order
+                        with closing(self.chunks_processor.packed_chunks(chunk_iter)) as packed_chunks:
+                            for packed in packed_chunks:
+                                self._commit_chunk(job, packed, pending=())
+
+                    self.stats.nfiles += 1
+                except (BackupError, BackupOSError):
+                    # take care of potential orphaned chunks in a failure scenario
+                    for chunk in item.chunks:
+                        self.cache.chunk_decref(chunk.id, self.stats, wait=False)
+                    raise
+        finally:
+            self._add_lv_stats(job)
+
+        self._add_lv_item(job, item)
         return None
 
+    def _add_lv_item(self, job, item):
+        """Add the item of a backed up LV to the archive and record it in the thin metadata, in the order given"""
+        volume, nextsnap = job.volume, job.nextsnap
+        self.metadata.add_lv(volume.uuid, snapshot_uuid=nextsnap.uuid, align_chunks=self.align_chunks)
+        self.archive.add_item(item, stats=self.stats)
+
+    def _add_lv_stats(self, job):
+        """Add the stats of an LV (which is done with) to the totals, and keep them for the per-LV report"""
+        self.stats.chunking_time += job.stats.chunking_time
+        self.stats.hashing_time += job.stats.hashing_time
+        for stage, seconds in job.stats.stage_times.items():
+            self.stats.add_stage(stage, seconds, job.stats.stage_sizes[stage])
+        self.lv_stats.append((job.name, job.stats))
+
+    def _show_progress(self, job):
+        """Show the progress of the archive, including the stages of the LV being stored"""
+        if time.monotonic() - self.stats.last_progress > 0.2:
+            (self.stats + job.stats).show_progress(item=job.item)
+            self.stats.last_progress = time.monotonic()
+
+    @classmethod
+    def estimate_lv(cls, *, size, block_size, segmap, old_chunks, aligned=False):
+        """
+        Work out what backing up an LV with the given delta would take, without reading it.
+
+        Returns the bytes in new (to be read), old (from the old archive) and hole segments, and the old chunks
+        (and their bytes) which straddle segment boundaries and need to be fetched to be split up.
+        """
+        estimate = {
+            'size': size, 'new_size': 0, 'old_size': 0, 'hole_size': 0, 'refetch_chunks': 0, 'refetch_size': 0,
+        }
+        segmap = cls.CompactSegmap(
+            cls._plan_segmap(segmap=segmap, block_size=block_size, old_chunks=old_chunks, aligned=aligned))
+        for _, length, t in segmap:
+            estimate[f'{t}_size'] += length * block_size
+
+        sizes = {cle.id: cle.size for cle in old_chunks if cle.id is not None}
+        last_id = None
+        for info in cls._old_chunks_plan(segmap=segmap, block_size=block_size, chunks=old_chunks):
+            # same as _old_chunks_filter_and_align, a chunk needed by consecutive segments is fetched once
+            if isinstance(info, cls.ModChunkInfo) and info.id != last_id:
+                estimate['refetch_chunks'] += 1
+                estimate['refetch_size'] += sizes[info.id]
+                last_id = info.id
+        return estimate
+
+    def estimate_lvs(self, names):
+        """
+        Like process_lvs, but only snapshot the volumes and estimate what backing them up would take (see
+        estimate_lv), yielding (name, estimate, error) in order.
+
+        The new snapshots are dropped again (the last ones are kept), nothing is read from the volumes or stored.
+        """
+        jobs = [self.LvJob(name, stats=Statistics(self.stats.output_json, self.stats.iec)) for name in names]
+        try:
+            self._prepare_lvs(jobs)
+            with self.cbt.deltas() as self._get_delta:
+                for job in jobs:
+                    if job.error is not None:
+                        yield job.name, None, job.error
+                        continue
+                    try:
+                        with self._plan_lv(job, job.stack) as segmap:
+                            estimate = self.estimate_lv(
+                                size=job.nextsnap.size, block_size=job.volume.block_size, segmap=segmap,
+                                old_chunks=job.old_chunks, aligned=job.old_aligned)
+                    except (BackupOSError, BackupError, CbtError) as e:
+                        self._abandon(job, e)
+                        yield job.name, None, e
+                        continue
+                    self._abandon(job, BackupError('only estimating'))
+                    yield job.name, estimate, None
+        finally:
+            for job in jobs:
+                if job.stack is not None:
+                    self._abandon(job, BackupError('aborted'))
+
+    def process_lvs(self, names):
+        """
+        Back up the given volumes, yielding (name, status, error) for each of them in order.
+
+        All volumes are snapshotted first (see _prepare_lvs), the delta of each one is read as it is processed
+        (see _plan_lv). With parallel_lvs > 1, reading, chunking and hashing run for several LVs at once on a pool
+        of worker threads. Storing the chunks and adding the items stays on the calling thread, which adds the
+        items in the order given to keep the archive deterministic. After Ctrl-C / SIGINT, the LVs in progress stop
+        once the checkpoint is written (to be resumed later) and the remaining ones are skipped.
+        """
+        stats = self.stats
+        jobs = [self.LvJob(name, stats=Statistics(stats.output_json, stats.iec)) for name in names]
+        try:
+            self._prepare_lvs(jobs)
+            with self.cbt.deltas() as self._get_delta:
+                if self.parallel_lvs == 1:
+                    for job in jobs:
+                        if sig_int and sig_int.action_done():
+                            break
+                        try:
+                            status = self.process_lv(job)
+                        except (BackupOSError, BackupError, CbtError) as e:
+                            yield job.name, None, e
+                        else:
+                            yield job.name, status, None
+                else:
+                    yield from self._process_jobs_parallel(jobs)
+        finally:
+            # the new snapshots of LVs we didn't get to (closed early, or something went badly wrong) are dropped
+            for job in jobs:
+                if job.stack is not None:
+                    self._abandon(job, BackupError('aborted'))
+
+    def _process_jobs_parallel(self, jobs):
+        out = queue.Queue(maxsize=self.parallel_lvs * self.queue_depth)
+        # index of the next job to add the item for
+        next_job = 0
+        with ThreadPoolExecutor(max_workers=self.parallel_lvs, thread_name_prefix='borg-thin') as executor:
+            for job in jobs:
+                job.future = executor.submit(self._lv_worker, job, out)
+            try:
+                while next_job < len(jobs):
+                    job, chunk = out.get()
+                    if chunk is not None:
+                        self._commit_chunk(job, chunk, pending=jobs[next_job:])
+                        if sig_int and sig_int.action_done():
+                            # the LVs in progress are resumed from the checkpoint, the rest are left for next time
+                            return
+                        continue
+
+                    job.ended = True
+                    job.committed.set()
+                    while next_job < len(jobs) and jobs[next_job].ended:
+                        yield self._commit_lv(jobs[next_job])
+                        next_job += 1
+            finally:
+                if next_job < len(jobs):
+                    # something went badly wrong (or we were closed early), get the workers to give up
+                    self._abort.set()
+                    for job in jobs:
+                        job.future.cancel()
+                        job.committed.set()
+                    while not all(job.future.done() for job in jobs):
+                        try:
+                            out.get(timeout=0.1)
+                        except queue.Empty:
+                            pass
+
+    def _prepare_chunk(self, chunk):
+        """Copy and pack new data on the worker (see ChunksProcessor.pack_chunk), the committer only stores it"""
+        if isinstance(chunk, ChunkListEntry):
+            return chunk
+
+        if chunk.data is not None:
+            # the chunker re-uses its buffer, so we need a copy before it moves on
+            chunk = Chunk(bytes(chunk.data), **chunk.meta)
+        return self.chunks_processor.pack_chunk(chunk)
+
+    def _lv_worker(self, job, out):
+        ended = False
+        try:
+            with self.open_lv(job, stats=job.stats) as (item, status, chunk_iter):
+                item.chunks = []
+                job.item, job.status = item, status
+                logger.debug(f'processing chunks for {item.path}')
+                for chunk in backup_io_iter(chunk_iter):
+                    if self._abort.is_set():
+                        raise BackupError('aborted')
+                    out.put((job, self._prepare_chunk(chunk)))
+
+                ended = True
+                out.put((job, None))
+                # only replace the last snapshot once all chunks made it into the cache
+                job.committed.wait()
+                if self._abort.is_set():
+                    raise BackupError('aborted')
+        finally:
+            if not ended:
+                out.put((job, None))
+
+    def _commit_chunk(self, job, chunk, *, pending):
+        with self.repo_lock:
+            # chunks the cache knows already only get referenced, they were neither packed nor put
+            new = not isinstance(chunk, ChunkListEntry) and chunk.cdata is not None and not self.cache.seen_chunk(
+                chunk.id)
+            started = time.monotonic()
+            chunk_entry = self.chunks_processor.store_chunk(chunk, cache=self.cache, stats=self.stats)
+            stored = time.monotonic()
+            # everything it takes to get the chunk into the repository (and cache), for the LV
+            job.stats.add_stage('store', stored - started, chunk_entry.size)
+            if new:
+                # compression and encryption, done by pack_chunk (possibly on a worker)
+                job.stats.add_stage('pack', chunk.packing_time, chunk.size)
+                if self.sync_puts:
+                    job.stats.add_stage('put', stored - started, len(chunk.cdata))
+            # other LVs in progress need to be part of a checkpoint too
+            pending_items = [j.item for j in pending if j is not job and j.item is not None]
+            self.chunks_processor.append_chunk(job.item, chunk_entry, self.stats, False, pending_items)
+            if self.show_progress:
+                self._show_progress(job)
+
+    def _commit_lv(self, job):
+        self._add_lv_stats(job)
+
+        error = job.future.exception()
+        with self.repo_lock:
+            if error is None:
+                self.stats.nfiles += 1
+                self._add_lv_item(job, job.item)
+                return job.name, job.status, None
+
+            if job.item is not None:
+                # take care of potential orphaned chunks in a failure scenario
+                for chunk in job.item.chunks:
+                    self.cache.chunk_decref(chunk.id, self.stats, wait=False)
+        if not isinstance(error, (BackupOSError, BackupError, CbtError)):
+            raise error
+        return job.name, None, error
+
     def finalise(self):
         data = msgpack.packb(self.metadata.as_dict())
         assert len(data) <= MAX_DATA_SIZE
@@ -2168,12 +3240,252 @@ def finalise(self):
 
         t = int(time.time()) * 1000000000
         meta_item = Item(
-            path=self.meta_path, size=chunk.meta['size'], mode=0o100660, # forcing regular file mode
+            path=self.meta_path, size=chunk.meta['size'], mode=0o100660,  # forcing regular file mode
             mtime=t, atime=t, ctime=t)
         self.process_file_chunks(meta_item, self.cache, self.stats, False, [chunk])
 
         self.archive.add_item(meta_item, show_progress=False)
 
+
+class ThinDeviceRestorer:
+    """
+    Restore LV items of thin archives onto block devices (e.g. thin LVs).
+
+    Holes are discarded instead of written with zeros. If the target is known to hold the contents of an older
+    item of the same LV already (e.g. because it was restored from it), only what differs from it is written.
+    """
+
+    def __init__(self, *, archive, zeroout=False, dry_run=False):
+        self.archive = archive
+        self.zeroout = zeroout
+        self.dry_run = dry_run
+        # byte counters over all restored items
+        self.written = 0
+        self.discarded = 0
+        self.skipped = 0
+
+    @staticmethod
+    def _plan(chunks, ref_chunks):
+        """
+        Yield (offset, chunk) for the entries of *chunks* which differ from *ref_chunks* (both as returned by
+        Item.chunks_with_holes), in order.
+
+        Data chunks are unchanged only if the reference has the same chunk at the same offset. Holes are trimmed to
+        the ranges which aren't holes in the reference already.
+        """
+        ref = []
+        ref_offset = 0
+        for ref_chunk in ref_chunks:
+            ref.append((ref_offset, ref_chunk))
+            ref_offset += ref_chunk.size
+
+        offset = 0
+        i = 0
+        for chunk in chunks:
+            end = offset + chunk.size
+            # skip to the reference chunk containing offset
+            while i < len(ref) and ref[i][0] + ref[i][1].size <= offset:
+                i += 1
+
+            if chunk.id is not None:
+                if i == len(ref) or ref[i] != (offset, chunk):
+                    yield offset, chunk
+            else:
+                run = None  # start of the range of the hole which needs to be discarded
+                pos = offset
+                j = i
+                while pos < end:
+                    if j < len(ref):
+                        r_offset, r = ref[j]
+                        r_end = min(r_offset + r.size, end)
+                        j += 1
+                    else:
+                        # beyond the end of the reference
+                        r, r_end = None, end
+
+                    if r is not None and r.id is None:
+                        if run is not None:
+                            yield run, ChunkListEntry(None, pos - run)
+                            run = None
+                    elif run is None:
+                        run = pos
+                    pos = r_end
+                if run is not None:
+                    yield run, ChunkListEntry(None, end - run)
+            offset = end
+
+    def _discard(self, fd, offset, size, *, is_blk):
+        if is_blk:
+            blkdiscard(fd, offset, size, zeroout=self.zeroout)
+            return
+
+        # not a block device (e.g. an image file), just write the zeros
+        for pos in range(offset, offset + size, len(zeros)):
+            self._write(fd, pos, memoryview(zeros)[: min(len(zeros), offset + size - pos)])
+
+    @staticmethod
+    def _write(fd, offset, data):
+        data = memoryview(data)
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+
+    def restore(self, item, fd, *, ref_item=None):
+        """
+        Write *item* to the block device (or file) open as *fd*.
+
+        If *ref_item* is given, the target must hold its contents, only the ranges which differ are written then.
+        """
+        is_blk = stat.S_ISBLK(os.fstat(fd).st_mode)
+        target_size = os.lseek(fd, 0, os.SEEK_END)
+        if target_size < item.size and is_blk:
+            raise BackupError(f'target is too small ({target_size} bytes, need {item.size})')
+        if target_size != item.size and not is_blk and not self.dry_run:
+            os.ftruncate(fd, item.size)
+
+        ref_chunks = ref_item.chunks_with_holes() if ref_item is not None else []
+        plan = list(self._plan(item.chunks_with_holes(), ref_chunks))
+        changed = 0
+        if self.dry_run:
+            data_iter = None
+        else:
+            data_iter = self.archive.pipeline.fetch_many([chunk.id for _, chunk in plan if chunk.id is not None])
+        for offset, chunk in plan:
+            changed += chunk.size
+            if chunk.id is None:
+                if not self.dry_run:
+                    self._discard(fd, offset, chunk.size, is_blk=is_blk)
+                self.discarded += chunk.size
+            else:
+                if not self.dry_run:
+                    self._write(fd, offset, next(data_iter))
+                self.written += chunk.size
+        self.skipped += item.size - changed
+        if not self.dry_run:
+            os.fsync(fd)
+
+
+class ThinItemDiff:
+    """
+    Find the changed byte ranges between two LV items of thin archives, from their chunk lists.
+
+    The chunk lists are aligned by offset. Where both items have the same chunk at the same place (or both have
+    zeros), nothing changed. Where both have a whole chunk in the same place, but different ones, the range
+    changed. Where the chunk boundaries of the items differ, it can only be told by comparing the content: with
+    *compare_content*, the chunks are fetched and compared in pieces of *granularity* bytes, otherwise the
+    range is reported as unknown.
+    """
+
+    def __init__(self, *, archive, compare_content=False, granularity=4096):
+        self.archive = archive
+        self.key = archive.key
+        self.compare_content = compare_content
+        self.granularity = granularity
+        # byte counters over all compared items
+        self.changed = 0
+        self.unknown = 0
+        # the last chunk fetched for each side, it's usually needed for a few pieces in a row
+        self._fetched = [None, None]
+
+    @staticmethod
+    def _pieces(chunks1, chunks2):
+        """
+        Yield (offset, size, (chunk1, start1), (chunk2, start2)) for the ranges between the chunk boundaries of
+        both *chunks1* and *chunks2* (as returned by Item.chunks_with_holes), with *start* being the offset into
+        the chunk. Past the end of a chunk list, its chunk is None.
+        """
+        it1, it2 = iter(chunks1), iter(chunks2)
+        chunk1, chunk2 = next(it1, None), next(it2, None)
+        # where the current chunks start
+        offset1 = offset2 = offset = 0
+        while chunk1 is not None or chunk2 is not None:
+            end1 = offset1 + chunk1.size if chunk1 is not None else None
+            end2 = offset2 + chunk2.size if chunk2 is not None else None
+            end = min(e for e in (end1, end2) if e is not None)
+            yield offset, end - offset, (chunk1, offset - offset1), (chunk2, offset - offset2)
+            offset = end
+            if end == end1:
+                chunk1, offset1 = next(it1, None), end1
+            if end == end2:
+                chunk2, offset2 = next(it2, None), end2
+
+    def _is_zeros(self, chunk):
+        if chunk.id is None:
+            return True
+        if chunk.size > len(zeros):
+            return False
+        # all-zero chunks are stored like any other (see cached_hash)
+        zero_id, _ = cached_hash(Chunk(None, size=chunk.size, allocation=CH_ALLOC), self.key.id_hash)
+        return chunk.id == zero_id
+
+    def _classify(self, piece):
+        """Return 'changed', 'unknown' or None (unchanged) for a piece as given by _pieces"""
+        _, size, (chunk1, start1), (chunk2, start2) = piece
+        if chunk1 is None or chunk2 is None:
+            # the items differ in size
+            return 'changed'
+        if chunk1.id == chunk2.id and start1 == start2:
+            return None
+        zeros1, zeros2 = self._is_zeros(chunk1), self._is_zeros(chunk2)
+        if zeros1 and zeros2:
+            return None
+        if chunk1.id is not None and chunk2.id is not None and size == chunk1.size == chunk2.size:
+            # both are whole chunks in the same place
+            return 'changed'
+        if chunk1.id is None and size == chunk2.size or chunk2.id is None and size == chunk1.size:
+            # a whole chunk (which isn't all zeros) in place of zeros
+            return 'changed'
+        return 'unknown'
+
+    def _read(self, side, chunk, start, size):
+        if chunk.id is None:
+            return memoryview(zeros)[:size] if size <= len(zeros) else bytes(size)
+        fetched = self._fetched[side]
+        if fetched is None or fetched[0] != chunk.id:
+            data = next(self.archive.pipeline.fetch_many([chunk.id], is_preloaded=False))
+            self._fetched[side] = fetched = (chunk.id, data)
+        return memoryview(fetched[1])[start : start + size]
+
+    def _compare(self, piece):
+        """Yield (offset, size, status) for a piece, in pieces of *granularity* bytes on absolute offsets"""
+        offset, size, (chunk1, start1), (chunk2, start2) = piece
+        data1 = self._read(0, chunk1, start1, size)
+        data2 = self._read(1, chunk2, start2, size)
+        pos, end = offset, offset + size
+        while pos < end:
+            next_pos = min((pos // self.granularity + 1) * self.granularity, end)
+            a, b = pos - offset, next_pos - offset
+            yield pos, next_pos - pos, 'changed' if data1[a:b] != data2[a:b] else None
+            pos = next_pos
+
+    def diff(self, item1, item2):
+        """
+        Yield (offset, size, status) for the ranges which changed between *item1* and *item2*, in order, with
+        status being 'changed' or 'unknown'. Adjacent ranges with the same status are merged.
+        """
+        pending = None
+        for piece in self._pieces(item1.chunks_with_holes(), item2.chunks_with_holes()):
+            status = self._classify(piece)
+            if status == 'unknown' and self.compare_content:
+                ranges = self._compare(piece)
+            else:
+                ranges = [(piece[0], piece[1], status)]
+            for offset, size, status in ranges:
+                if status == 'changed':
+                    self.changed += size
+                elif status == 'unknown':
+                    self.unknown += size
+                if pending is not None and pending[2] == status:
+                    pending = (pending[0], pending[1] + size, status)
+                    continue
+                if pending is not None and pending[2] is not None:
+                    yield pending
+                pending = (offset, size, status)
+        if pending is not None and pending[2] is not None:
+            yield pending
+
+
 def valid_msgpacked_dict(d, keys_serialized):
     """check if the data <d> looks like a msgpacked dict"""
     d_len = len(d)
@@ -2822,6 +4134,7 @@ def __init__(
         timestamp=None,
         checkpoint_interval=1800,
         checkpoint_volume=0,
+        workers=1,
     ):
         self.manifest = manifest
         self.repository = manifest.repository
@@ -2850,6 +4163,7 @@ def __init__(
         self.print_file_status = file_status_printer or (lambda *args: None)
         self.checkpoint_interval = None if dry_run else checkpoint_interval
         self.checkpoint_volume = None if dry_run else checkpoint_volume
+        self.workers = workers
 
     def recreate(self, archive_name, comment=None, target_name=None):
         assert not self.is_temporary_archive(archive_name)
@@ -2900,12 +4214,16 @@ def process_chunks(self, archive, target, item):
             for chunk_id, size in item.chunks:
                 self.cache.chunk_incref(chunk_id, target.stats)
             return item.chunks
-        chunk_iterator = self.iter_chunks(archive, target, list(item.chunks))
+        # when rechunking, the holes go through the chunker, too
+        chunks = item.chunks_with_holes() if target.recreate_rechunkify else item.chunks
+        chunk_iterator = self.iter_chunks(archive, target, list(chunks))
         chunk_processor = partial(self.chunk_processor, target)
         target.process_file_chunks(item, self.cache, target.stats, self.progress, chunk_iterator, chunk_processor)
+        if target.recreate_rechunkify and "holes" in item:
+            del item.holes
 
-    def chunk_processor(self, target, chunk):
-        chunk_id, data = cached_hash(chunk, self.key.id_hash)
+    def chunk_processor(self, target, packed):
+        chunk_id, data = packed.id, packed.data
         if chunk_id in self.seen_chunks:
             return self.cache.chunk_incref(chunk_id, target.stats)
         overwrite = self.recompress
@@ -2920,13 +4238,14 @@ def chunk_processor(self, target, chunk):
             ):
                 # Stored chunk has the same compression method and level as we wanted
                 overwrite = False
-        chunk_entry = self.cache.add_chunk(chunk_id, {}, data, stats=target.stats, overwrite=overwrite, wait=False)
-        self.cache.repository.async_response(wait=False)
+        chunk_entry = target.chunks_processor.store_chunk(
+            packed, cache=self.cache, stats=target.stats, overwrite=overwrite
+        )
         self.seen_chunks.add(chunk_entry.id)
         return chunk_entry
 
     def iter_chunks(self, archive, target, chunks):
-        chunk_iterator = archive.pipeline.fetch_many([chunk_id for chunk_id, _ in chunks])
+        chunk_iterator = archive.pipeline.fetch_chunks(chunks)
         if target.recreate_rechunkify:
             # The target.chunker will read the file contents through ChunkIteratorFileWrapper chunk-by-chunk
             # (does not load the entire file into memory)
@@ -3011,7 +4330,7 @@ def create_target(self, archive, target_name=None):
             logger.debug(
                 "Rechunking archive from %s to %s", source_chunker_params or "(unknown)", target.chunker_params
             )
-        target.process_file_chunks = ChunksProcessor(
+        target.chunks_processor = ChunksProcessor(
             cache=self.cache,
             key=self.key,
             add_item=target.add_item,
@@ -3020,7 +4339,9 @@ def create_target(self, archive, target_name=None):
             checkpoint_interval=self.checkpoint_interval,
             checkpoint_volume=self.checkpoint_volume,
             rechunkify=target.recreate_rechunkify,
-        ).process_file_chunks
+            workers=self.workers,
+        )
+        target.process_file_chunks = target.chunks_processor.process_file_chunks
         target.chunker = get_chunker(*target.chunker_params, seed=self.key.chunk_seed, sparse=False)
         return target
 
@@ -5,17 +5,19 @@
 import stat
 import subprocess
 import time
+from contextlib import closing
 from io import TextIOWrapper
 
 from ._common import with_repository, Highlander
 from .. import helpers
 from ..archive import Archive, is_special
 from ..archive import BackupError, BackupOSError, backup_io, OsOpen, stat_update_check
-from ..archive import FilesystemObjectProcessors, MetadataCollector, ChunksProcessor
+from ..archive import FilesystemObjectProcessors, MetadataCollector, MetadataPrefetcher, ChunksProcessor
 from ..cache import Cache
 from ..constants import *  # NOQA
 from ..compress import CompressionSpec
 from ..helpers import comment_validator, ChunkerParams
+from ..helpers import positive_int_validator, non_negative_int_validator
 from ..helpers import archivename_validator, FilesCacheMode
 from ..helpers import eval_escapes
 from ..helpers import timestamp, archive_ts_now
@@ -130,6 +132,9 @@ def create_inner(archive, cache, fso):
                         self.print_error("Command %r exited with status %d", args.paths[0], rc)
                         return self.exit_code
             else:
+                prefetcher = MetadataPrefetcher(
+                    workers=args.prefetch, matcher=matcher, metadata_collector=fso.metadata_collector if fso else None
+                )
                 for path in args.paths:
                     if path == "-":  # stdin
                         path = args.stdin_name
@@ -180,6 +185,7 @@ def create_inner(archive, cache, fso):
                                 restrict_dev=restrict_dev,
                                 read_special=args.read_special,
                                 dry_run=dry_run,
+                                prefetcher=prefetcher,
                             )
                             # if we get back here, we've finished recursing into <path>,
                             # we do not ever want to get back in there (even if path is given twice as recursion root)
@@ -260,6 +266,7 @@ def create_inner(archive, cache, fso):
                     checkpoint_interval=args.checkpoint_interval,
                     checkpoint_volume=args.checkpoint_volume,
                     rechunkify=False,
+                    workers=args.workers,
                 )
                 fso = FilesystemObjectProcessors(
                     metadata_collector=metadata_collector,
@@ -273,6 +280,7 @@ def create_inner(archive, cache, fso):
                     log_json=args.log_json,
                     iec=args.iec,
                     file_status_printer=self.print_file_status,
+                    block_hashes=args.block_hashes,
                 )
                 create_inner(archive, cache, fso)
         else:
@@ -356,10 +364,14 @@ def _rec_walk(
         restrict_dev,
         read_special,
         dry_run,
+        prefetcher,
+        prefetched=None,
     ):
         """
         Process *path* (or, preferably, parent_fd/name) recursively according to the various parameters.
 
+        *prefetched* is what *prefetcher* already found out about the item (see MetadataPrefetcher.entries).
+
         This should only raise on critical errors. Per-item errors must be handled within this method.
         """
         if sig_int and sig_int.action_done():
@@ -369,22 +381,23 @@ def _rec_walk(
         status = None
         try:
             recurse_excluded_dir = False
-            if matcher.match(path):
-                with backup_io("stat"):
-                    st = os_stat(path=path, parent_fd=parent_fd, name=name, follow_symlinks=False)
-            else:
+            if prefetched is None:
+                prefetched = MetadataPrefetcher.Prefetched(matcher.match(path), matcher.recurse_dir, None)
+            included, recurse_dir, st = prefetched
+            if not included:
                 self.print_file_status("-", path)  # excluded
                 # get out here as quickly as possible:
                 # we only need to continue if we shall recurse into an excluded directory.
                 # if we shall not recurse, then do not even touch (stat()) the item, it
                 # could trigger an error, e.g. if access is forbidden, see #3209.
-                if not matcher.recurse_dir:
+                if not recurse_dir:
                     return
                 recurse_excluded_dir = True
+            if st is None:
                 with backup_io("stat"):
                     st = os_stat(path=path, parent_fd=parent_fd, name=name, follow_symlinks=False)
-                if not stat.S_ISDIR(st.st_mode):
-                    return
+            if recurse_excluded_dir and not stat.S_ISDIR(st.st_mode):
+                return
 
             if (st.st_ino, st.st_dev) in skip_inodes:
                 return
@@ -446,6 +459,7 @@ def _rec_walk(
                                             restrict_dev=restrict_dev,
                                             read_special=read_special,
                                             dry_run=dry_run,
+                                            prefetcher=prefetcher,
                                         )
                                 self.print_file_status("-", path)  # excluded
                             return
@@ -457,23 +471,25 @@ def _rec_walk(
                     if recurse:
                         with backup_io("scandir"):
                             entries = helpers.scandir_inorder(path=path, fd=child_fd)
-                        for dirent in entries:
-                            normpath = os.path.normpath(os.path.join(path, dirent.name))
-                            self._rec_walk(
-                                path=normpath,
-                                parent_fd=child_fd,
-                                name=dirent.name,
-                                fso=fso,
-                                cache=cache,
-                                matcher=matcher,
-                                exclude_caches=exclude_caches,
-                                exclude_if_present=exclude_if_present,
-                                keep_exclude_tags=keep_exclude_tags,
-                                skip_inodes=skip_inodes,
-                                restrict_dev=restrict_dev,
-                                read_special=read_special,
-                                dry_run=dry_run,
-                            )
+                        with closing(prefetcher.entries(path, child_fd, entries)) as entries:
+                            for dirent_name, normpath, prefetched in entries:
+                                self._rec_walk(
+                                    path=normpath,
+                                    parent_fd=child_fd,
+                                    name=dirent_name,
+                                    fso=fso,
+                                    cache=cache,
+                                    matcher=matcher,
+                                    exclude_caches=exclude_caches,
+                                    exclude_if_present=exclude_if_present,
+                                    keep_exclude_tags=keep_exclude_tags,
+                                    skip_inodes=skip_inodes,
+                                    restrict_dev=restrict_dev,
+                                    read_special=read_special,
+                                    dry_run=dry_run,
+                                    prefetcher=prefetcher,
+                                    prefetched=prefetched,
+                                )
 
         except (BackupOSError, BackupError) as e:
             self.print_warning("%s: %s", path, e)
@@ -552,6 +568,20 @@ def build_parser_create(self, subparsers, common_parser, mid_common_parser):
         is used to determine changed files quickly uses absolute filenames.
         If this is not possible, consider creating a bind mount to a stable location.
 
+        The files cache can not tell what changed inside a file, and block devices (see
+        ``--read-special``) are never considered unmodified. With ``--block-hashes``, a
+        hash of every 1MiB block of block devices and of files bigger than 64MiB is kept
+        in the cache as well. They are still read completely, but only the changed blocks
+        are chunked, hashed and compressed again: the chunks of the last backup which only
+        cover unchanged blocks are reused as they are. The block hashes share the cache
+        mode and TTL of the files cache.
+
+        With many (mostly unchanged) files, especially on network filesystems, borg is
+        often waiting for metadata lookups rather than for file contents. With ``--prefetch N``,
+        N threads lstat() the upcoming entries of a directory and read their xattrs and ACLs
+        in advance. The entries are still processed one after the other, in the same order
+        as without it.
+
         The ``--progress`` option shows (from left to right) Original and (uncompressed)
         deduplicated size (O and U respectively), then the Number of files (N) processed so far,
         followed by the currently processed path.
@@ -818,6 +848,21 @@ def build_parser_create(self, subparsers, common_parser, mid_common_parser):
             help="open and read block and char device files as well as FIFOs as if they were "
             "regular files. Also follows symlinks pointing to these kinds of files.",
         )
+        fs_group.add_argument(
+            "--block-hashes",
+            dest="block_hashes",
+            action="store_true",
+            help="keep block hashes of block devices (see --read-special) and big files in the cache, "
+            "to only chunk their changed blocks again",
+        )
+        fs_group.add_argument(
+            "--prefetch",
+            metavar="N",
+            dest="prefetch",
+            type=non_negative_int_validator,
+            default=0,
+            help="look up the metadata of upcoming directory entries on N threads (Default: 0, no extra threads)",
+        )
 
         archive_group = subparser.add_argument_group("Archive options")
         archive_group.add_argument(
@@ -873,6 +918,14 @@ def build_parser_create(self, subparsers, common_parser, mid_common_parser):
             default=CompressionSpec("lz4"),
             help="select compression algorithm, see the output of the " '"borg help compression" command for details.',
         )
+        archive_group.add_argument(
+            "--workers",
+            metavar="N",
+            dest="workers",
+            type=positive_int_validator,
+            default=1,
+            help="hash, compress and encrypt chunks on N threads (Default: 1, no extra threads)",
+        )
 
         subparser.add_argument("name", metavar="NAME", type=archivename_validator, help="specify the archive name")
         subparser.add_argument("paths", metavar="PATH", nargs="*", type=str, action="extend", help="paths to archive")
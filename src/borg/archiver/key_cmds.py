@@ -63,7 +63,17 @@ def do_change_location(self, args, repository, manifest, cache):
                 print("Change not needed or not supported.")
                 return EXIT_WARNING
 
-        for name in ("repository_id", "crypt_key", "id_key", "chunk_seed", "tam_required", "sessionid", "cipher"):
+        for name in (
+            "repository_id",
+            "crypt_key",
+            "id_key",
+            "chunk_seed",
+            "tam_required",
+            "sessionid",
+            "cipher",
+            "iv_lock",
+            "thread_ciphers",
+        ):
             value = getattr(key, name)
             setattr(key_new, name, value)
 
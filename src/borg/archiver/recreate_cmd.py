@@ -6,6 +6,7 @@
 from ..constants import *  # NOQA
 from ..compress import CompressionSpec
 from ..helpers import archivename_validator, comment_validator, ChunkerParams
+from ..helpers import positive_int_validator
 from ..helpers import timestamp
 from ..manifest import Manifest
 
@@ -42,6 +43,7 @@ def do_recreate(self, args, repository, manifest, cache):
             checkpoint_volume=args.checkpoint_volume,
             dry_run=args.dry_run,
             timestamp=args.timestamp,
+            workers=args.workers,
         )
 
         archive_names = tuple(archive.name for archive in manifest.archives.list_considering(args))
@@ -195,6 +197,14 @@ def build_parser_recreate(self, subparsers, common_parser, mid_common_parser):
             default=CompressionSpec("lz4"),
             help="select compression algorithm, see the output of the " '"borg help compression" command for details.',
         )
+        archive_group.add_argument(
+            "--workers",
+            metavar="N",
+            dest="workers",
+            type=positive_int_validator,
+            default=1,
+            help="hash, compress and encrypt chunks on N threads (Default: 1, no extra threads)",
+        )
         archive_group.add_argument(
             "--recompress",
             metavar="MODE",
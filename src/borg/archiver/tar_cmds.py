@@ -16,6 +16,7 @@
 from ..helpers import create_filter_process
 from ..helpers import ChunkIteratorFileWrapper
 from ..helpers import archivename_validator, comment_validator, ChunkerParams
+from ..helpers import positive_int_validator
 from ..helpers import remove_surrogates
 from ..helpers import timestamp, archive_ts_now
 from ..helpers import basic_json_data, json_print
@@ -110,7 +111,7 @@ def item_content_stream(item):
             """
             Return a file-like object that reads from the chunks of *item*.
             """
-            chunk_iterator = archive.pipeline.fetch_many([chunk_id for chunk_id, _ in item.chunks], is_preloaded=True)
+            chunk_iterator = archive.pipeline.fetch_item(item, is_preloaded=True)
             if pi:
                 info = [remove_surrogates(item.path)]
                 return ChunkIteratorFileWrapper(
@@ -276,6 +277,7 @@ def _import_tar(self, args, repository, manifest, key, cache, tarstream):
             checkpoint_interval=args.checkpoint_interval,
             checkpoint_volume=args.checkpoint_volume,
             rechunkify=False,
+            workers=args.workers,
         )
         tfo = TarfileObjectProcessors(
             cache=cache,
@@ -542,6 +544,14 @@ def build_parser_tar(self, subparsers, common_parser, mid_common_parser):
             default=CompressionSpec("lz4"),
             help="select compression algorithm, see the output of the " '"borg help compression" command for details.',
         )
+        archive_group.add_argument(
+            "--workers",
+            metavar="N",
+            dest="workers",
+            type=positive_int_validator,
+            default=1,
+            help="hash, compress and encrypt chunks on N threads (Default: 1, no extra threads)",
+        )
 
         subparser.add_argument("name", metavar="NAME", type=archivename_validator, help="specify the archive name")
         subparser.add_argument("tarfile", metavar="TARFILE", help='input tar file. "-" to read from stdin instead.')
@@ -1,20 +1,24 @@
 import argparse
+import json
 import logging
 import os
 import time
+from functools import partial
 
-from ..archive import Archive, ThinObjectProcessors, ChunksProcessor
-from ..archive import BackupError, BackupOSError
+from ..archive import Archive, ThinObjectProcessors, ThinDeviceRestorer, ThinItemDiff, ChunksProcessor
+from ..archive import BackupError, BackupOSError, backup_io
 from ..compress import CompressionSpec
 from ..constants import *  # NOQA
-from ..helpers import archivename_validator, comment_validator, lv_validator, ChunkerParams
+from ..cbt import LvmCbt, FileCbt
+from ..helpers import archivename_validator, comment_validator, ChunkerParams
+from ..helpers import positive_int_validator
 from ..helpers import timestamp, archive_ts_now
 from ..helpers import basic_json_data, json_print
-from ..helpers import log_multi
+from ..helpers import log_multi, format_file_size, make_path_safe
 from ..helpers import sig_int
 from ..manifest import Manifest
 
-from ._common import with_repository, Highlander
+from ._common import with_repository, with_archive, Highlander
 
 from ..logger import create_logger
 
@@ -52,26 +56,31 @@ def do_create_thin(self, args, repository, manifest, cache):
             checkpoint_interval=args.checkpoint_interval,
             checkpoint_volume=args.checkpoint_volume,
             rechunkify=False,
+            workers=args.workers,
         )
         top = ThinObjectProcessors(
             archive=archive,
             cache=cache,
             key=manifest.key,
             chunker_params=args.chunker_params,
-            process_file_chunks=cp.process_file_chunks,
+            chunks_processor=cp,
             show_progress=args.progress,
             log_json=args.log_json,
             iec=args.iec,
             file_status_printer=self.print_file_status,
+            parallel_lvs=args.parallel_lvs,
+            align_chunks=args.align_chunks,
+            cbt=FileCbt() if args.cbt == 'file' else LvmCbt(),
         )
 
-        for vg, lv in args.lvs:
-            try:
-                status = top.process_lv(vg=vg, lv=lv)
-            except (BackupOSError, BackupError) as e:
-                self.print_warning('%s/%s: %s', vg, lv, e)
+        if args.estimate:
+            return self._estimate_thin(args, manifest, top)
+
+        for name, status, error in top.process_lvs(args.lvs):
+            if error is not None:
+                self.print_warning('%s: %s', name, error)
                 status = 'E'
-            self.print_file_status(status, f'{vg}/{lv}')
+            self.print_file_status(status, name)
             if status is not None:
                 top.stats.files_stats[status] += 1
         top.finalise()
@@ -87,11 +96,128 @@ def do_create_thin(self, args, repository, manifest, cache):
             archive.save(comment=args.comment, timestamp=args.timestamp)
             args.stats |= args.json
             if args.stats:
+                volumes = [{"name": name, "stages": stats.stages_as_dict()} for name, stats in top.lv_stats]
                 if args.json:
-                    json_print(basic_json_data(archive.manifest, cache=archive.cache, extra={"archive": archive}))
+                    json_print(basic_json_data(
+                        archive.manifest, cache=archive.cache, extra={"archive": archive, "volumes": volumes}))
                 else:
-                    log_multi(str(archive), str(archive.stats), logger=logging.getLogger("borg.output.stats"))
+                    lv_lines = []
+                    for name, stats in top.lv_stats:
+                        lv_lines.append(f"{name}:")
+                        lv_lines.extend("    " + line for line in stats.stages_lines())
+                    log_multi(
+                        str(archive), str(archive.stats), *lv_lines, logger=logging.getLogger("borg.output.stats"))
+
+        return self.exit_code
+
+    def _estimate_thin(self, args, manifest, top):
+        estimates = []
+        for name, estimate, error in top.estimate_lvs(args.lvs):
+            if error is not None:
+                self.print_warning('%s: %s', name, error)
+                continue
+            estimates.append(dict(name=name, **estimate))
+            if not args.json:
+                fmt = partial(format_file_size, iec=args.iec)
+                print(
+                    f"{name}: new {fmt(estimate['new_size'])}, old {fmt(estimate['old_size'])}, "
+                    f"holes {fmt(estimate['hole_size'])}, {estimate['refetch_chunks']} old chunks "
+                    f"({fmt(estimate['refetch_size'])}) to re-fetch"
+                )
+        if args.json:
+            json_print(basic_json_data(manifest, extra={'volumes': estimates}))
+        return self.exit_code
 
+    @staticmethod
+    def _find_lv_item(archive, path):
+        for item in archive.iter_items(filter=lambda i: i.path == path):
+            return item
+        return None
+
+    @with_repository(compatibility=(Manifest.Operation.READ,))
+    @with_archive
+    def do_diff_thin(self, args, repository, manifest, archive):
+        """Find the changed ranges of a thin volume between two archives"""
+        lv_qual = make_path_safe(args.lv)
+        archive1 = archive
+        archive2 = Archive(manifest, args.other_name)
+        items = []
+        for arch in (archive1, archive2):
+            item = self._find_lv_item(arch, lv_qual)
+            if item is None:
+                self.print_error(f"LV {lv_qual} not found in archive '{arch.name}'")
+                return self.exit_code
+            items.append(item)
+
+        if archive1.metadata.get("chunker_params") != archive2.metadata.get("chunker_params") and not args.content:
+            self.print_warning(
+                "--chunker-params are different between archives, most ranges will be unknown.\n"
+                "Pass --content to compare the contents of those ranges."
+            )
+
+        differ = ThinItemDiff(archive=archive1, compare_content=args.content, granularity=args.granularity)
+        for offset, size, status in differ.diff(*items):
+            if args.json_lines:
+                print(json.dumps({"offset": offset, "size": size, "status": status}))
+            else:
+                print(f"{status:<8} {offset:>16} {size:>16}")
+
+        if args.stats:
+            log_multi(
+                f"Size: {format_file_size(items[0].size, iec=args.iec)} -> "
+                f"{format_file_size(items[1].size, iec=args.iec)}",
+                f"Changed: {format_file_size(differ.changed, iec=args.iec)}",
+                f"Unknown: {format_file_size(differ.unknown, iec=args.iec)}",
+                logger=logging.getLogger("borg.output.stats"))
+        return self.exit_code
+
+    @with_repository(compatibility=(Manifest.Operation.READ,))
+    @with_archive
+    def do_extract_thin(self, args, repository, manifest, archive):
+        """Restore a thin volume from an archive onto a block device"""
+        lv_qual = make_path_safe(args.lv)
+        # LVs are restored to themselves, as are image files (see FileCbt) given by their absolute path
+        device = args.device or os.path.join('/dev', args.lv)
+
+        item = self._find_lv_item(archive, lv_qual)
+        if item is None:
+            self.print_error(f"LV {lv_qual} not found in archive '{archive.name}'")
+            return self.exit_code
+        ref_item = None
+        if args.reference is not None:
+            ref_item = self._find_lv_item(Archive(manifest, args.reference), lv_qual)
+            if ref_item is None:
+                self.print_error(f"LV {lv_qual} not found in reference archive '{args.reference}'")
+                return self.exit_code
+
+        restorer = ThinDeviceRestorer(archive=archive, zeroout=args.zeroout, dry_run=args.dry_run)
+        logger.info(f'Restoring {lv_qual} to {device}')
+        try:
+            with backup_io('open'):
+                fd = os.open(device, os.O_RDWR if not args.dry_run else os.O_RDONLY)
+            try:
+                with backup_io('write'):
+                    restorer.restore(item, fd, ref_item=ref_item)
+            finally:
+                os.close(fd)
+        except (BackupOSError, BackupError) as e:
+            self.print_error(f'{device}: {e}')
+            return self.exit_code
+
+        if args.stats or args.json:
+            stats = {
+                'written_size': restorer.written,
+                'discarded_size': restorer.discarded,
+                'unchanged_size': restorer.skipped,
+            }
+            if args.json:
+                json_print(basic_json_data(manifest, extra={'restore': stats}))
+            else:
+                log_multi(
+                    f"Written: {format_file_size(restorer.written, iec=args.iec)}",
+                    f"Discarded: {format_file_size(restorer.discarded, iec=args.iec)}",
+                    f"Unchanged: {format_file_size(restorer.skipped, iec=args.iec)}",
+                    logger=logging.getLogger("borg.output.stats"))
         return self.exit_code
 
     def build_parser_thin(self, subparsers, common_parser, mid_common_parser):
@@ -100,6 +226,49 @@ def build_parser_thin(self, subparsers, common_parser, mid_common_parser):
             """
         This command creates a backup archive from LVM thin volumes.
 
+        All LVs are snapshotted first. The changes since their last backup are then read
+        from one thin pool metadata snapshot per pool, as each LV is backed up.
+
+        With ``--parallel-lvs N``, reading, chunking and hashing happens for up to N LVs
+        at the same time. The chunks are still stored and the LVs added to the
+        archive one at a time, in the order they were given on the command line.
+        The chunks of these LVs are compressed and encrypted on their own threads, too.
+        Otherwise, ``--workers N`` does that on N threads while the LV is read.
+
+        With ``--align-chunks``, chunks are only cut on thin pool chunk boundaries (the
+        content-defined chunker still picks the places to cut, rounded to the pool chunk
+        size). Unchanged data of later backups then always maps onto whole chunks of the
+        previous archive, so none of them need to be fetched from the repository to split
+        them up. Parts of old chunks which were partially changed are re-read from the new
+        snapshot instead. Whether an LV was backed up with ``--align-chunks`` is recorded in
+        the archive, so this only applies to backups following such an archive.
+
+        Checkpoints (see ``--checkpoint-interval`` and ``--checkpoint-volume``) include the LVs
+        in progress as part items. If the backup does not complete after a checkpoint (Ctrl-C
+        writes one and stops, or borg is killed), the new snapshots of those LVs are kept and
+        tagged ``borgthin-partial``. The next backup of such an LV resumes from its part item in
+        the latest checkpoint: the same snapshot is used and only the delta after the
+        checkpointed offset is processed. A partial snapshot without a checkpoint is dropped.
+
+        With ``--estimate``, the LVs are snapshotted and their deltas calculated, but no data
+        is read from them and no archive is created. For every LV, the bytes in new (to be
+        read), old (unchanged since the last backup) and unallocated ranges are listed, as
+        well as the old chunks which straddle changed ranges and would need to be fetched
+        from the repository. The snapshots taken are dropped again.
+
+        ``--stats`` shows where the time went, per LV and for the whole archive: ``cbt``
+        (snapshot management), ``delta`` (computing the changed ranges), ``read`` (reading
+        new data from the snapshot), ``fetch`` (fetching old chunks from the repository to
+        split them up), ``store`` (handing chunks to the cache), ``pack`` (compressing and
+        encrypting new chunks) and ``put`` (writing new chunks to a local repository, a
+        remote one gets them asynchronously). ``--progress`` shows the throughput of these
+        stages while running.
+
+        With ``--cbt file``, image files (given by path) are backed up instead of LVs. Their
+        changes are tracked in a per-block generation map kept next to the image
+        (``IMAGE.cbt``), which only knows about writes made through ``borg.cbt.CbtImage``.
+        This allows incremental block backups (e.g. for testing and benchmarking) without
+        LVM or root.
         """
         )
         subparser = subparsers.add_parser(
@@ -135,6 +304,29 @@ def build_parser_thin(self, subparsers, common_parser, mid_common_parser):
             help="only display items with the given status characters",
         )
         subparser.add_argument("--json", action="store_true", help="output stats as JSON (implies --stats)")
+        subparser.add_argument(
+            "--estimate",
+            dest="estimate",
+            action="store_true",
+            help="only estimate how much data each LV would need to be read or fetched, do not create an archive",
+        )
+        subparser.add_argument(
+            "--cbt",
+            metavar="PROVIDER",
+            dest="cbt",
+            choices=("lvm", "file"),
+            default="lvm",
+            help="how to snapshot volumes and find their changes: lvm (thin LVs) or file (image files with "
+            "tracked writes). Default: lvm",
+        )
+        subparser.add_argument(
+            "--parallel-lvs",
+            metavar="N",
+            dest="parallel_lvs",
+            type=positive_int_validator,
+            default=1,
+            help="process up to N LVs concurrently (Default: 1)",
+        )
 
         archive_group = subparser.add_argument_group("Archive options")
         archive_group.add_argument(
@@ -181,6 +373,12 @@ def build_parser_thin(self, subparsers, common_parser, mid_common_parser):
             help="specify the chunker parameters (ALGO, CHUNK_MIN_EXP, CHUNK_MAX_EXP, "
             "HASH_MASK_BITS, HASH_WINDOW_SIZE). default: %s,%d,%d,%d,%d" % CHUNKER_PARAMS,
         )
+        archive_group.add_argument(
+            "--align-chunks",
+            dest="align_chunks",
+            action="store_true",
+            help="only cut chunks on thin pool chunk boundaries",
+        )
         archive_group.add_argument(
             "-C",
             "--compression",
@@ -190,6 +388,133 @@ def build_parser_thin(self, subparsers, common_parser, mid_common_parser):
             default=CompressionSpec("lz4"),
             help="select compression algorithm, see the output of the " '"borg help compression" command for details.',
         )
+        archive_group.add_argument(
+            "--workers",
+            metavar="N",
+            dest="workers",
+            type=positive_int_validator,
+            default=1,
+            help="hash, compress and encrypt chunks on N threads (Default: 1, no extra threads)",
+        )
 
         subparser.add_argument("name", metavar="NAME", type=archivename_validator, help="specify the archive name")
-        subparser.add_argument("lvs", metavar="LV", nargs="*", type=lv_validator, action="extend", help="LVs to backup (`vg/lv`)")
+        subparser.add_argument(
+            "lvs", metavar="LV", nargs="*", action="extend", help="LVs (`vg/lv`) or image files (with `--cbt file`) to backup"
+        )
+
+        extract_thin_epilog = process_epilog(
+            """
+        This command writes an LV from an archive created by ``borg tcreate`` onto a block
+        device, by default the LV itself (``/dev/VG/LV``). The device must be at least as
+        big as the LV was.
+
+        Holes (ranges of the LV which weren't allocated in the thin pool) are discarded
+        instead of written with zeros. This relies on the device reading discarded ranges
+        back as zeros, which thin LVs do (unless their pool ignores discards). Use
+        ``--zeroout`` for devices which don't.
+
+        With ``--reference ARCHIVE``, only the ranges where the chunks of the LV differ from
+        those in the reference archive are written or discarded. The device must hold
+        exactly what is in the reference archive then, e.g. because it was restored from
+        it, or it is the LV that archive was created from and it wasn't changed since.
+        Rolling back an LV by a few backups only writes what changed in between.
+        """
+        )
+        subparser = subparsers.add_parser(
+            "textract",
+            parents=[common_parser],
+            add_help=False,
+            description=self.do_extract_thin.__doc__,
+            epilog=extract_thin_epilog,
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            help=self.do_extract_thin.__doc__,
+        )
+        subparser.set_defaults(func=self.do_extract_thin)
+        subparser.add_argument(
+            "-n", "--dry-run", dest="dry_run", action="store_true", help="do not actually change any data"
+        )
+        subparser.add_argument(
+            "-s",
+            "--stats",
+            dest="stats",
+            action="store_true",
+            default=False,
+            help="print how much data was written, discarded and left unchanged",
+        )
+        subparser.add_argument("--json", action="store_true", help="output stats as JSON (implies --stats)")
+        subparser.add_argument(
+            "--to-device",
+            metavar="DEVICE",
+            dest="device",
+            help="restore to DEVICE instead of the LV itself",
+        )
+        subparser.add_argument(
+            "--reference",
+            metavar="ARCHIVE",
+            dest="reference",
+            type=archivename_validator,
+            help="only write what differs from the LV in ARCHIVE, which the device currently holds",
+        )
+        subparser.add_argument(
+            "--zeroout",
+            dest="zeroout",
+            action="store_true",
+            help="zero out holes instead of discarding them",
+        )
+        subparser.add_argument("name", metavar="NAME", type=archivename_validator, help="specify the archive name")
+        subparser.add_argument("lv", metavar="LV", help="LV (`vg/lv`) or image file to restore")
+
+        diff_thin_epilog = process_epilog(
+            """
+        This command lists the byte ranges of an LV (or image file) which changed between two
+        archives created by ``borg tcreate``, without reading the data of either.
+
+        The chunk lists of the LV in both archives are lined up by offset. Ranges where both
+        have the same chunk in the same place (or both are unallocated or zeros) did not
+        change. Ranges where both have a whole chunk in the same place, but a different one,
+        changed. Where the chunk boundaries differ (right after a change, the chunker needs a
+        bit to get back in step), the ranges are listed as ``unknown``, unless ``--content``
+        is given: then just the chunks of those ranges are fetched and compared, in pieces of
+        ``--granularity`` bytes.
+
+        Each output line has the status (``changed`` or ``unknown``), offset and size of a
+        range. With ``--json-lines``, every range is a JSON object with ``status``,
+        ``offset`` and ``size`` keys instead.
+        """
+        )
+        subparser = subparsers.add_parser(
+            "tdiff",
+            parents=[common_parser],
+            add_help=False,
+            description=self.do_diff_thin.__doc__,
+            epilog=diff_thin_epilog,
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            help=self.do_diff_thin.__doc__,
+        )
+        subparser.set_defaults(func=self.do_diff_thin)
+        subparser.add_argument(
+            "-s",
+            "--stats",
+            dest="stats",
+            action="store_true",
+            default=False,
+            help="print how much data changed",
+        )
+        subparser.add_argument("--json-lines", action="store_true", help="Format output as JSON Lines.")
+        subparser.add_argument(
+            "--content",
+            dest="content",
+            action="store_true",
+            help="compare the content where chunk boundaries differ (fetches those chunks)",
+        )
+        subparser.add_argument(
+            "--granularity",
+            metavar="BYTES",
+            dest="granularity",
+            type=positive_int_validator,
+            default=4096,
+            help="compare content in pieces of BYTES (Default: 4096)",
+        )
+        subparser.add_argument("name", metavar="ARCHIVE1", type=archivename_validator, help="ARCHIVE1 name")
+        subparser.add_argument("other_name", metavar="ARCHIVE2", type=archivename_validator, help="ARCHIVE2 name")
+        subparser.add_argument("lv", metavar="LV", help="LV (`vg/lv`) or image file to compare")
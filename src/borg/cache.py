@@ -2,8 +2,11 @@
 import os
 import shutil
 import stat
+import threading
 from binascii import unhexlify
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_futures
+from itertools import islice
 from time import perf_counter
 
 from .logger import create_logger
@@ -12,10 +15,10 @@
 
 files_cache_logger = create_logger("borg.debug.files_cache")
 
-from .constants import CACHE_README, FILES_CACHE_MODE_DISABLED
+from .constants import CACHE_README, FILES_CACHE_MODE_DISABLED, CHANGES_LIMIT
 from .hashindex import ChunkIndex, ChunkIndexEntry, CacheSynchronizer
 from .helpers import Location
-from .helpers import Error
+from .helpers import Error, IntegrityError
 from .helpers import get_cache_dir, get_security_dir
 from .helpers import bin_to_hex, parse_stringified_list
 from .helpers import format_file_size
@@ -24,20 +27,21 @@
 from .helpers import remove_surrogates
 from .helpers import ProgressIndicatorPercent, ProgressIndicatorMessage
 from .helpers import set_ec, EXIT_WARNING
-from .helpers import safe_unlink
+from .helpers import safe_unlink, clone_file
+from .helpers import chunkit
 from .helpers import msgpack
-from .helpers.msgpack import int_to_timestamp, timestamp_to_int
 from .item import ArchiveItem, ChunkListEntry
 from .crypto.key import PlaintextKey
 from .crypto.file_integrity import IntegrityCheckedFile, DetachedIntegrityCheckedFile, FileIntegrityError
+from .filescache import FileCacheEntry, FilesCache
 from .locking import Lock
 from .manifest import Manifest
 from .platform import SaveFile
-from .remote import cache_if_remote
+from .remote import cache_if_remote, SharedRepository, RemoteRepository
 from .repository import LIST_SCAN_LIMIT
 
-# note: cmtime might me either a ctime or a mtime timestamp
-FileCacheEntry = namedtuple("FileCacheEntry", "age inode size cmtime chunk_ids")
+# hashes: concatenated xxh64 digests of the blocks, chunks: [(id, size), ...] of the file
+BlockHashEntry = namedtuple("BlockHashEntry", "age block_size size hashes chunks")
 
 
 class SecurityManager:
@@ -258,6 +262,16 @@ def discover_files_cache_name(path):
     return [fn for fn in os.listdir(path) if fn == "files" or fn.startswith("files.")][0]
 
 
+def files_journal_name():
+    suffix = os.environ.get("BORG_FILES_CACHE_SUFFIX", "")
+    return "filesjournal." + suffix if suffix else "filesjournal"
+
+
+def block_hashes_name():
+    suffix = os.environ.get("BORG_FILES_CACHE_SUFFIX", "")
+    return "blockhashes." + suffix if suffix else "blockhashes"
+
+
 class CacheConfig:
     def __init__(self, repository, path=None, lock_wait=None):
         self.repository = repository
@@ -299,6 +313,9 @@ def load(self):
         self._check_upgrade(self.config_path)
         self.id = self._config.get("cache", "repository")
         self.manifest_id = unhexlify(self._config.get("cache", "manifest"))
+        # the repository transaction the chunks index is in sync with, see LocalCache.sync
+        transaction_id = self._config.get("cache", "transaction", fallback="")
+        self.transaction_id = int(transaction_id) if transaction_id else None
         self.timestamp = self._config.get("cache", "timestamp", fallback=None)
         self.key_type = self._config.get("cache", "key_type", fallback=None)
         self.ignored_features = set(parse_stringified_list(self._config.get("cache", "ignored_features", fallback="")))
@@ -339,6 +356,7 @@ def save(self, manifest=None, key=None):
             self._config.set("integrity", "manifest", manifest.id_str)
         if key:
             self._config.set("cache", "key_type", str(key.TYPE))
+        self._config.set("cache", "transaction", "" if self.transaction_id is None else str(self.transaction_id))
         with SaveFile(self.config_path) as fd:
             self._config.write(fd)
 
@@ -511,6 +529,7 @@ def __init__(
         self.cache_mode = cache_mode
         self.timestamp = None
         self.txn_active = False
+        self.files = None
 
         self.path = cache_dir(self.repository, path)
         self.security_manager = SecurityManager(self.repository)
@@ -561,11 +580,18 @@ def _do_open(self):
             write=False,
             integrity_data=self.cache_config.integrity.get("chunks"),
         ) as fd:
-            self.chunks = ChunkIndex.read(fd)
+            # commands only looking up some chunks do not need all of a big chunks index in memory,
+            # it is copied into memory when it gets changed first.
+            self.chunks = ChunkIndex.read(fd, mapped=True)
+        # the ids of the chunks changed since the last commit, see _publish_chunks_changes
+        self.chunks_changed = ChunkIndex()
         if "d" in self.cache_mode:  # d(isabled)
             self.files = None
         else:
             self._read_files()
+        # only read when used, see known_block_hashes, and only written if changed
+        self.block_hashes = None
+        self.block_hashes_changed = False
 
     def open(self):
         if not os.path.isdir(self.path):
@@ -579,16 +605,43 @@ def close(self):
             self.cache_config = None
 
     def _read_files(self):
-        self.files = {}
         self._newest_cmtime = None
         logger.debug("Reading files cache ...")
         files_cache_logger.debug("FILES-CACHE-LOAD: starting...")
         msg = None
+        path = os.path.join(self.path, files_cache_name())
+        journal_path = os.path.join(self.path, files_journal_name())
+        ttl = int(os.environ.get("BORG_FILES_CACHE_TTL", 20))
         try:
-            with IntegrityCheckedFile(
-                path=os.path.join(self.path, files_cache_name()),
-                write=False,
+            # the entries are memory-mapped, not loaded, see filescache
+            self.files = FilesCache.read(
+                path,
                 integrity_data=self.cache_config.integrity.get(files_cache_name()),
+                journal_path=journal_path,
+                journal_integrity_data=self.cache_config.integrity.get(files_journal_name()),
+                ttl=ttl,
+            )
+        except (TypeError, ValueError) as exc:
+            msg = "The files cache seems invalid. [%s]" % str(exc)
+        except OSError as exc:
+            msg = "The files cache can't be read. [%s]" % str(exc)
+        except FileIntegrityError as fie:
+            msg = "The files cache is corrupted. [%s]" % str(fie)
+        if msg is not None:
+            logger.warning(msg)
+            logger.warning("Continuing without files cache - expect lower performance.")
+            self.files = FilesCache(path=path, journal_path=journal_path, ttl=ttl)
+        files_cache_logger.debug("FILES-CACHE-LOAD: finished, %d entries loaded.", len(self.files))
+
+    def _read_block_hashes(self):
+        self.block_hashes = {}
+        path = os.path.join(self.path, block_hashes_name())
+        if not os.path.exists(path):
+            return
+        msg = None
+        try:
+            with IntegrityCheckedFile(
+                path=path, write=False, integrity_data=self.cache_config.integrity.get(block_hashes_name())
             ) as fd:
                 u = msgpack.Unpacker(use_list=True)
                 while True:
@@ -598,37 +651,62 @@ def _read_files(self):
                     u.feed(data)
                     try:
                         for path_hash, item in u:
-                            entry = FileCacheEntry(*item)
-                            # in the end, this takes about 240 Bytes per file
-                            self.files[path_hash] = msgpack.packb(entry._replace(age=entry.age + 1))
+                            entry = BlockHashEntry(*item)
+                            self.block_hashes[path_hash] = msgpack.packb(entry._replace(age=entry.age + 1))
                     except (TypeError, ValueError) as exc:
-                        msg = "The files cache seems invalid. [%s]" % str(exc)
+                        msg = "The block hashes seem invalid. [%s]" % str(exc)
                         break
         except OSError as exc:
-            msg = "The files cache can't be read. [%s]" % str(exc)
+            msg = "The block hashes can't be read. [%s]" % str(exc)
         except FileIntegrityError as fie:
-            msg = "The files cache is corrupted. [%s]" % str(fie)
+            msg = "The block hashes are corrupted. [%s]" % str(fie)
         if msg is not None:
             logger.warning(msg)
-            logger.warning("Continuing without files cache - expect lower performance.")
-            self.files = {}
-        files_cache_logger.debug("FILES-CACHE-LOAD: finished, %d entries loaded.", len(self.files))
+            logger.warning("Continuing without block hashes - expect lower performance.")
+            self.block_hashes = {}
+        files_cache_logger.debug("BLOCK-HASHES-LOAD: finished, %d entries loaded.", len(self.block_hashes))
+
+    def _write_block_hashes(self, ttl):
+        path = os.path.join(self.path, block_hashes_name())
+        with IntegrityCheckedFile(path=path + ".tmp", write=True, filename=block_hashes_name()) as fd:
+            entry_count = 0
+            for path_hash, item in self.block_hashes.items():
+                entry = BlockHashEntry(*msgpack.unpackb(item))
+                if entry.age < ttl:
+                    msgpack.pack((path_hash, entry), fd)
+                    entry_count += 1
+        os.replace(path + ".tmp", path)
+        files_cache_logger.debug("BLOCK-HASHES-SAVE: finished, %d remaining entries saved.", entry_count)
+        self.cache_config.integrity[block_hashes_name()] = fd.integrity_data
+        self.block_hashes_changed = False
+
+    @staticmethod
+    def _snapshot(src_dir, name, dst_dir):
+        # The cache files are never modified in place (written to a temporary file which replaces them, or only
+        # appended to), so a hard link is a snapshot. Fall back to a (reflink) copy if the filesystem has no links.
+        src, dst = os.path.join(src_dir, name), os.path.join(dst_dir, name)
+        try:
+            os.link(src, dst + ".tmp")
+        except OSError:
+            clone_file(src, dst + ".tmp")
+        os.replace(dst + ".tmp", dst)
 
     def begin_txn(self):
         # Initialize transaction snapshot
         pi = ProgressIndicatorMessage(msgid="cache.begin_transaction")
         txn_dir = os.path.join(self.path, "txn.tmp")
         os.mkdir(txn_dir)
-        pi.output("Initializing cache transaction: Reading config")
-        shutil.copy(os.path.join(self.path, "config"), txn_dir)
-        pi.output("Initializing cache transaction: Reading chunks")
-        shutil.copy(os.path.join(self.path, "chunks"), txn_dir)
-        pi.output("Initializing cache transaction: Reading files")
-        try:
-            shutil.copy(os.path.join(self.path, files_cache_name()), txn_dir)
-        except FileNotFoundError:
+        pi.output("Initializing cache transaction")
+        self._snapshot(self.path, "config", txn_dir)
+        self._snapshot(self.path, "chunks", txn_dir)
+        if os.path.exists(os.path.join(self.path, files_cache_name())):
+            self._snapshot(self.path, files_cache_name(), txn_dir)
+        else:
             with SaveFile(os.path.join(txn_dir, files_cache_name()), binary=True):
                 pass  # empty file
+        for name in files_journal_name(), block_hashes_name():
+            if os.path.exists(os.path.join(self.path, name)):
+                self._snapshot(self.path, name, txn_dir)
         os.replace(txn_dir, os.path.join(self.path, "txn.active"))
         self.txn_active = True
         pi.finish()
@@ -639,37 +717,35 @@ def commit(self):
             return
         self.security_manager.save(self.manifest, self.key)
         pi = ProgressIndicatorMessage(msgid="cache.commit")
+        ttl = int(os.environ.get("BORG_FILES_CACHE_TTL", 20))
         if self.files is not None:
             if self._newest_cmtime is None:
                 # was never set because no files were modified/added
                 self._newest_cmtime = 2**63 - 1  # nanoseconds, good until y2262
-            ttl = int(os.environ.get("BORG_FILES_CACHE_TTL", 20))
             pi.output("Saving files cache")
             files_cache_logger.debug("FILES-CACHE-SAVE: starting...")
-            with IntegrityCheckedFile(path=os.path.join(self.path, files_cache_name()), write=True) as fd:
-                entry_count = 0
-                for path_hash, item in self.files.items():
-                    # Only keep files seen in this backup that are older than newest cmtime seen in this backup -
-                    # this is to avoid issues with filesystem snapshots and cmtime granularity.
-                    # Also keep files from older backups that have not reached BORG_FILES_CACHE_TTL yet.
-                    entry = FileCacheEntry(*msgpack.unpackb(item))
-                    if (
-                        entry.age == 0
-                        and timestamp_to_int(entry.cmtime) < self._newest_cmtime
-                        or entry.age > 0
-                        and entry.age < ttl
-                    ):
-                        msgpack.pack((path_hash, entry), fd)
-                        entry_count += 1
+
+            def keep(entry):
+                # Only keep files seen in this backup that are older than newest cmtime seen in this backup -
+                # this is to avoid issues with filesystem snapshots and cmtime granularity.
+                # Also keep files from older backups that have not reached BORG_FILES_CACHE_TTL yet.
+                return entry.age == 0 and entry.cmtime < self._newest_cmtime or entry.age > 0 and entry.age < ttl
+
+            # usually only appends the changes to the journal, see filescache
+            self.cache_config.integrity.update(self.files.commit(keep))
             files_cache_logger.debug("FILES-CACHE-KILL: removed all old entries with age >= TTL [%d]", ttl)
             files_cache_logger.debug(
                 "FILES-CACHE-KILL: removed all current entries with newest cmtime %d", self._newest_cmtime
             )
-            files_cache_logger.debug("FILES-CACHE-SAVE: finished, %d remaining entries saved.", entry_count)
-            self.cache_config.integrity[files_cache_name()] = fd.integrity_data
+        if self.block_hashes_changed:
+            pi.output("Saving block hashes")
+            self._write_block_hashes(ttl)
         pi.output("Saving chunks cache")
-        with IntegrityCheckedFile(path=os.path.join(self.path, "chunks"), write=True) as fd:
+        self.cache_config.transaction_id = self._publish_chunks_changes()
+        path = os.path.join(self.path, "chunks")
+        with IntegrityCheckedFile(path=path + ".tmp", write=True, filename="chunks") as fd:
             self.chunks.write(fd)
+        os.replace(path + ".tmp", path)
         self.cache_config.integrity["chunks"] = fd.integrity_data
         pi.output("Saving cache config")
         self.cache_config.save(self.manifest, self.key)
@@ -678,6 +754,41 @@ def commit(self):
         self.txn_active = False
         pi.finish()
 
+    def _get_changes(self, transaction_id=None):
+        try:
+            return self.repository.get_changes(transaction_id)
+        except RemoteRepository.RPCServerOutdated:
+            return None
+
+    def _publish_chunks_changes(self):
+        """
+        Add how the chunks index changed to the change log of the current repository transaction.
+
+        Return the repository transaction the chunks index is in sync with now (None if unknown).
+        """
+        base = self.cache_config.transaction_id
+        if not len(self.chunks_changed):
+            return base
+        changes = self._get_changes()
+        if changes is None or changes["transaction"] == base:
+            # we do not know the repository transaction our changes belong to
+            return None
+        transaction_id = changes["transaction"]
+        if base is not None and len(self.chunks_changed) <= CHANGES_LIMIT:
+            # the current reference counts (0: deleted) of the changed chunks, encrypted like any other object
+            entries = [(id, *self.chunks.get(id, ChunkIndexEntry(0, 0))) for id, _ in self.chunks_changed.iteritems()]
+            parts = list(chunkit(entries, 100000))
+            for i, part in enumerate(parts):
+                data = msgpack.packb(
+                    {"transaction": transaction_id, "base": base, "part": i, "parts": len(parts), "chunks": part}
+                )
+                id = self.key.id_hash(data)
+                cdata = self.repo_objs.format(id, {}, data)
+                if not self.repository.add_cache_changes(transaction_id, base, id + cdata):
+                    break
+        self.chunks_changed.clear()
+        return transaction_id
+
     def rollback(self):
         """Roll back partial and aborted transactions"""
         # Remove partial transaction
@@ -685,10 +796,20 @@ def rollback(self):
             shutil.rmtree(os.path.join(self.path, "txn.tmp"))
         # Roll back active transaction
         txn_dir = os.path.join(self.path, "txn.active")
+        # the chunks index and the files cache get replaced below, they must not be mapped any more
+        self.chunks = None
+        if self.files is not None:
+            self.files.close()
+            self.files = None
         if os.path.exists(txn_dir):
-            shutil.copy(os.path.join(txn_dir, "config"), self.path)
-            shutil.copy(os.path.join(txn_dir, "chunks"), self.path)
-            shutil.copy(os.path.join(txn_dir, discover_files_cache_name(txn_dir)), self.path)
+            # the files cache journal and the block hashes did not necessarily exist before the transaction
+            for name in files_journal_name(), block_hashes_name():
+                try:
+                    os.unlink(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    pass
+            for name in os.listdir(txn_dir):
+                self._snapshot(txn_dir, name, self.path)
             txn_tmp = os.path.join(self.path, "txn.tmp")
             os.replace(txn_dir, txn_tmp)
             if os.path.exists(txn_tmp):
@@ -711,6 +832,8 @@ def sync(self):
         processed_item_metadata_bytes = 0
         processed_item_metadata_chunks = 0
         compact_chunks_archive_saved_space = 0
+        # archive indexes are built on several threads, see parallel_master_idx
+        instrumentation_lock = threading.Lock()
 
         def mkpath(id, suffix=""):
             id_hex = bin_to_hex(id)
@@ -766,17 +889,22 @@ def fetch_and_build_idx(archive_id, decrypted_repository, chunk_idx):
                     ids = msgpack.unpackb(data)
                     items.extend(ids)
             sync = CacheSynchronizer(chunk_idx)
+            metadata_bytes = 0
             for item_id, (csize, data) in zip(items, decrypted_repository.get_many(items)):
                 chunk_idx.add(item_id, 1, len(data))
-                processed_item_metadata_bytes += len(data)
-                processed_item_metadata_chunks += 1
+                metadata_bytes += len(data)
                 sync.feed(data)
+            with instrumentation_lock:
+                processed_item_metadata_bytes += metadata_bytes
+                processed_item_metadata_chunks += len(items)
             if self.do_cache:
                 write_archive_index(archive_id, chunk_idx)
 
         def write_archive_index(archive_id, chunk_idx):
             nonlocal compact_chunks_archive_saved_space
-            compact_chunks_archive_saved_space += chunk_idx.compact()
+            saved_space = chunk_idx.compact()
+            with instrumentation_lock:
+                compact_chunks_archive_saved_space += saved_space
             fn = mkpath(archive_id, suffix=".compact")
             fn_tmp = mkpath(archive_id, suffix=".tmp")
             try:
@@ -818,6 +946,63 @@ def read_archive_index(archive_id, archive_name):
             write_archive_index(archive_id, archive_chunk_idx)
             return archive_chunk_idx
 
+        def get_archive_idx(archive_id, archive_name, cached, decrypted_repository):
+            if cached:
+                archive_chunk_idx = read_archive_index(archive_id, archive_name)
+                if archive_chunk_idx is not None:
+                    return archive_chunk_idx
+            logger.info("Fetching and building archive index for %s.", archive_name)
+            archive_chunk_idx = ChunkIndex()
+            fetch_and_build_idx(archive_id, decrypted_repository, archive_chunk_idx)
+            return archive_chunk_idx
+
+        def parallel_master_idx(archive_ids_to_names, cached_ids, decrypted_repository, workers, pi):
+            # Archive indexes get built (or read) on the workers and merged pairwise as they come in, also on the
+            # workers. Only a few indexes are in memory at a time: the ones being built and the merged ones.
+            def build(archive_id, archive_name):
+                if self.do_cache:
+                    # compacted (or read from disk), so it can't be merged into
+                    cached = archive_id in cached_ids
+                    return get_archive_idx(archive_id, archive_name, cached, decrypted_repository), False
+                logger.info("Fetching archive index for %s.", archive_name)
+                archive_chunk_idx = ChunkIndex()
+                fetch_and_build_idx(archive_id, decrypted_repository, archive_chunk_idx)
+                return archive_chunk_idx, True
+
+            def merge(a, b):
+                # merge the smaller index into the larger one (if that one can be merged into),
+                # inserting into a table that is smaller than the one iterated over is slow.
+                if len(a[0]) < len(b[0]) and b[1] or not a[1]:
+                    a, b = b, a
+                idx, mergeable = a
+                if not mergeable:
+                    idx = ChunkIndex(usable=max(len(a[0]), len(b[0])) * 1.1)
+                    idx.merge(a[0])
+                idx.merge(b[0])
+                return idx, True
+
+            archives = iter(archive_ids_to_names.items())
+            running = {}  # future -> archive name (None for merges)
+            idxs = []
+            executor = ThreadPoolExecutor(workers, thread_name_prefix="borg-sync")
+            try:
+                while True:
+                    for archive_id, archive_name in islice(archives, max(workers - len(running), 0)):
+                        running[executor.submit(build, archive_id, archive_name)] = archive_name
+                    if not running:
+                        break
+                    finished, _ = wait_futures(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        archive_name = running.pop(future)
+                        if archive_name is not None:
+                            pi.show(info=[remove_surrogates(archive_name)])
+                        idxs.append(future.result())
+                    while len(idxs) >= 2:
+                        running[executor.submit(merge, idxs.pop(), idxs.pop())] = None
+            finally:
+                executor.shutdown(wait=True, cancel_futures=True)
+            return idxs[0]
+
         def get_archive_ids_to_names(archive_ids):
             # Pass once over all archives and build a mapping from ids to names.
             # The easier approach, doing a similar loop for each archive, has
@@ -830,7 +1015,7 @@ def get_archive_ids_to_names(archive_ids):
             assert len(archive_names) == len(archive_ids)
             return archive_names
 
-        def create_master_idx(chunk_idx):
+        def create_master_idx(chunk_idx, decrypted_repository, workers):
             logger.debug("Synchronizing chunks index...")
             cached_ids = cached_archives()
             archive_ids = repo_archives()
@@ -855,25 +1040,30 @@ def create_master_idx(chunk_idx):
                     msgid="cache.sync",
                 )
                 archive_ids_to_names = get_archive_ids_to_names(archive_ids)
-                for archive_id, archive_name in archive_ids_to_names.items():
-                    pi.show(info=[remove_surrogates(archive_name)])  # legacy. borg2 always has pure unicode arch names.
-                    if self.do_cache:
-                        if archive_id in cached_ids:
-                            archive_chunk_idx = read_archive_index(archive_id, archive_name)
-                            if archive_chunk_idx is None:
-                                cached_ids.remove(archive_id)
-                        if archive_id not in cached_ids:
-                            # Do not make this an else branch; the FileIntegrityError exception handler
-                            # above can remove *archive_id* from *cached_ids*.
-                            logger.info("Fetching and building archive index for %s.", archive_name)
-                            archive_chunk_idx = ChunkIndex()
-                            fetch_and_build_idx(archive_id, decrypted_repository, archive_chunk_idx)
-                        logger.debug("Merging into master chunks index.")
-                        chunk_idx.merge(archive_chunk_idx)
+                if workers > 1:
+                    archive_chunk_idx, mergeable = parallel_master_idx(
+                        archive_ids_to_names, cached_ids, decrypted_repository, workers, pi
+                    )
+                    if mergeable:
+                        chunk_idx = archive_chunk_idx
                     else:
-                        chunk_idx = chunk_idx or ChunkIndex(usable=master_index_capacity)
-                        logger.info("Fetching archive index for %s.", archive_name)
-                        fetch_and_build_idx(archive_id, decrypted_repository, chunk_idx)
+                        # just one archive, compacted
+                        chunk_idx = ChunkIndex(usable=master_index_capacity)
+                        chunk_idx.merge(archive_chunk_idx)
+                else:
+                    for archive_id, archive_name in archive_ids_to_names.items():
+                        # legacy. borg2 always has pure unicode arch names.
+                        pi.show(info=[remove_surrogates(archive_name)])
+                        if self.do_cache:
+                            archive_chunk_idx = get_archive_idx(
+                                archive_id, archive_name, archive_id in cached_ids, decrypted_repository
+                            )
+                            logger.debug("Merging into master chunks index.")
+                            chunk_idx.merge(archive_chunk_idx)
+                        else:
+                            chunk_idx = chunk_idx or ChunkIndex(usable=master_index_capacity)
+                            logger.info("Fetching archive index for %s.", archive_name)
+                            fetch_and_build_idx(archive_id, decrypted_repository, chunk_idx)
                 pi.finish()
                 logger.debug(
                     "Chunks index sync: processed %s (%d chunks) of metadata.",
@@ -892,12 +1082,82 @@ def create_master_idx(chunk_idx):
         # Since the sync will attempt to read archives, check compatibility with Manifest.Operation.READ.
         self.manifest.check_repository_compatibility((Manifest.Operation.READ,))
 
+        # archive indexes are built on that many threads
+        workers = int(os.environ.get("BORG_CACHE_SYNC_WORKERS", 1))
+
         self.begin_txn()
-        with cache_if_remote(self.repository, decrypted_cache=self.repo_objs) as decrypted_repository:
+        self.chunks_changed.clear()
+        if self._replay_changes():
+            return
+        changes = self._get_changes()
+        self.cache_config.transaction_id = changes["transaction"] if changes is not None else None
+        # with several workers, the objects are cached as they are and decrypted by the workers, see SharedRepository
+        with cache_if_remote(self.repository, decrypted_cache=self.repo_objs if workers <= 1 else False) as repository:
             # TEMPORARY HACK: to avoid archive index caching, create a FILE named ~/.cache/borg/REPOID/chunks.archive.d -
             # this is only recommended if you have a fast, low latency connection to your repo (e.g. if repo is local disk)
             self.do_cache = os.path.isdir(archive_path)
-            self.chunks = create_master_idx(self.chunks)
+            decrypted_repository = SharedRepository(repository, self.repo_objs) if workers > 1 else repository
+            self.chunks = create_master_idx(self.chunks, decrypted_repository, workers)
+
+    def _replay_changes(self):
+        """
+        Bring the chunks index up to date by replaying the change log of the repository (see Repository.get_changes).
+
+        Return False if that is not possible, the chunks index then needs to be rebuilt from the archives.
+        """
+        base = self.cache_config.transaction_id
+        changes = self._get_changes()
+        if base is None or changes is None or changes["transaction"] == base:
+            return False
+        transaction_id = changes["transaction"]
+        # walk back to our transaction, the cache data of a transaction covers all changes since its cache_base
+        replay = []
+        while True:
+            replay.append(changes)
+            cache_base = changes["cache_base"]
+            if cache_base is not None and cache_base <= base:
+                break
+            previous = changes["previous"] if cache_base is None else cache_base
+            if previous == base:
+                break
+            if previous is None or previous < base:
+                return False
+            changes = self._get_changes(previous)
+            if changes is None:
+                return False
+        logger.debug("Replaying the change log of %d repository transactions...", len(replay))
+        for changes in reversed(replay):
+            if changes["cache_base"] is None:
+                # no client told us how the chunks index changed (e.g. one with an ad-hoc cache, see
+                # --no-cache-sync), this is only fine if it did not: nothing deleted and nothing new put
+                if changes["put"] is None or changes["delete"]:
+                    return False
+                if any(id not in self.chunks and id != Manifest.MANIFEST_ID for id in changes["put"]):
+                    return False
+                continue
+            parts = []
+            for data in changes["cache"]:
+                id, cdata = data[:32], data[32:]
+                try:
+                    _, data = self.repo_objs.parse(id, cdata)
+                except IntegrityError as err:
+                    logger.warning("Change log of transaction %d is invalid: %s", changes["transaction"], err)
+                    return False
+                part = msgpack.unpackb(data)
+                if part["transaction"] != changes["transaction"] or part["base"] != changes["cache_base"]:
+                    return False
+                parts.append(part)
+            if not parts or [part["part"] for part in parts] != list(range(parts[-1]["parts"])):
+                return False
+            for part in parts:
+                for id, refcount, size in part["chunks"]:
+                    if refcount:
+                        self.chunks[id] = ChunkIndexEntry(refcount, size)
+                    elif id in self.chunks:
+                        del self.chunks[id]
+        logger.debug("Replayed the change log up to repository transaction %d.", transaction_id)
+        self.cache_config.transaction_id = transaction_id
+        return True
 
     def check_cache_compatibility(self):
         my_features = Manifest.SUPPORTED_REPO_FEATURES
@@ -920,8 +1180,19 @@ def wipe_cache(self):
         self.chunks = ChunkIndex()
         with SaveFile(os.path.join(self.path, files_cache_name()), binary=True):
             pass  # empty file
+        for name in files_journal_name(), block_hashes_name():
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+        if self.files is not None:
+            # the journal is gone, so the next commit needs to rewrite the files cache
+            self.files.rewrite = True
+        self.block_hashes = None
+        self.block_hashes_changed = False
         self.cache_config.manifest_id = ""
         self.cache_config._config.set("cache", "manifest", "")
+        self.cache_config.transaction_id = None
 
         self.cache_config.ignored_features = set()
         self.cache_config.mandatory_features = set()
@@ -937,8 +1208,26 @@ def update_compatibility(self):
         self.cache_config.mandatory_features.update(repo_features & my_features)
 
     def add_chunk(
-        self, id, meta, data, *, stats, overwrite=False, wait=True, compress=True, size=None, ctype=None, clevel=None
+        self,
+        id,
+        meta,
+        data,
+        *,
+        stats,
+        overwrite=False,
+        wait=True,
+        compress=True,
+        size=None,
+        ctype=None,
+        clevel=None,
+        cdata=None,
     ):
+        """
+        Add a chunk to the cache and repository (or just a reference, if it is known already).
+
+        *cdata* may be given if *data* was already formatted (compressed and encrypted) by repo_objs.format,
+        e.g. on a worker thread (see ChunksProcessor.pack_chunk).
+        """
         if not self.txn_active:
             self.begin_txn()
         if size is None and compress:
@@ -948,9 +1237,11 @@ def add_chunk(
             return self.chunk_incref(id, stats)
         if size is None:
             raise ValueError("when giving compressed data for a new chunk, the uncompressed size must be given also")
-        cdata = self.repo_objs.format(id, meta, data, compress=compress, size=size, ctype=ctype, clevel=clevel)
+        if cdata is None:
+            cdata = self.repo_objs.format(id, meta, data, compress=compress, size=size, ctype=ctype, clevel=clevel)
         self.repository.put(id, cdata, wait=wait)
         self.chunks.add(id, 1, size)
+        self.chunks_changed[id] = ChunkIndexEntry(0, 0)
         stats.update(size, not refcount)
         return ChunkListEntry(id, size)
 
@@ -968,6 +1259,7 @@ def chunk_incref(self, id, stats, size=None):
         if not self.txn_active:
             self.begin_txn()
         count, _size = self.chunks.incref(id)
+        self.chunks_changed[id] = ChunkIndexEntry(0, 0)
         stats.update(_size, False)
         return ChunkListEntry(id, _size)
 
@@ -975,6 +1267,7 @@ def chunk_decref(self, id, stats, wait=True):
         if not self.txn_active:
             self.begin_txn()
         count, size = self.chunks.decref(id)
+        self.chunks_changed[id] = ChunkIndexEntry(0, 0)
         if count == 0:
             del self.chunks[id]
             self.repository.delete(id, wait=wait)
@@ -1006,21 +1299,20 @@ def file_known_and_unchanged(self, hashed_path, path_hash, st):
             files_cache_logger.debug("UNKNOWN: rechunking enforced")
             return False, None
         entry = self.files.get(path_hash)
-        if not entry:
+        if entry is None:
             files_cache_logger.debug("UNKNOWN: no file metadata in cache for: %r", hashed_path)
             return False, None
         # we know the file!
-        entry = FileCacheEntry(*msgpack.unpackb(entry))
         if "s" in cache_mode and entry.size != st.st_size:
             files_cache_logger.debug("KNOWN-CHANGED: file size has changed: %r", hashed_path)
             return True, None
         if "i" in cache_mode and entry.inode != st.st_ino:
             files_cache_logger.debug("KNOWN-CHANGED: file inode number has changed: %r", hashed_path)
             return True, None
-        if "c" in cache_mode and timestamp_to_int(entry.cmtime) != st.st_ctime_ns:
+        if "c" in cache_mode and entry.cmtime != st.st_ctime_ns:
             files_cache_logger.debug("KNOWN-CHANGED: file ctime has changed: %r", hashed_path)
             return True, None
-        elif "m" in cache_mode and timestamp_to_int(entry.cmtime) != st.st_mtime_ns:
+        elif "m" in cache_mode and entry.cmtime != st.st_mtime_ns:
             files_cache_logger.debug("KNOWN-CHANGED: file mtime has changed: %r", hashed_path)
             return True, None
         # we ignored the inode number in the comparison above or it is still same.
@@ -1031,7 +1323,9 @@ def file_known_and_unchanged(self, hashed_path, path_hash, st):
         # number comparison in a future backup run (and avoid chunking everything
         # again at that time), we need to update the inode number in the cache with what
         # we see in the filesystem.
-        self.files[path_hash] = msgpack.packb(entry._replace(inode=st.st_ino, age=0))
+        # if it is not older than the newest cmtime seen so far, commit might need to drop it, see keep().
+        recheck = self._newest_cmtime is None or entry.cmtime >= self._newest_cmtime
+        self.files.touch(path_hash, st.st_ino, recheck=recheck)
         return True, entry.chunk_ids
 
     def memorize_file(self, hashed_path, path_hash, st, ids):
@@ -1048,10 +1342,8 @@ def memorize_file(self, hashed_path, path_hash, st, ids):
         elif "m" in cache_mode:
             cmtime_type = "mtime"
             cmtime_ns = safe_ns(st.st_mtime_ns)
-        entry = FileCacheEntry(
-            age=0, inode=st.st_ino, size=st.st_size, cmtime=int_to_timestamp(cmtime_ns), chunk_ids=ids
-        )
-        self.files[path_hash] = msgpack.packb(entry)
+        entry = FileCacheEntry(age=0, inode=st.st_ino, size=st.st_size, cmtime=cmtime_ns, chunk_ids=ids)
+        self.files[path_hash] = entry
         self._newest_cmtime = max(self._newest_cmtime or 0, cmtime_ns)
         files_cache_logger.debug(
             "FILES-CACHE-UPDATE: put %r [has %s] <- %r",
@@ -1060,6 +1352,38 @@ def memorize_file(self, hashed_path, path_hash, st, ids):
             hashed_path,
         )
 
+    def known_block_hashes(self, hashed_path, path_hash):
+        """
+        Get the block hashes memorized for the file or block device that has this path_hash.
+
+        :return: a BlockHashEntry or None (if unknown or the files cache is disabled / rechunking is enforced).
+        """
+        cache_mode = self.cache_mode
+        if "d" in cache_mode or "r" in cache_mode:  # d(isabled), r(echunk)
+            return None
+        if self.block_hashes is None:
+            self._read_block_hashes()
+        entry = self.block_hashes.get(path_hash)
+        if not entry:
+            files_cache_logger.debug("BLOCK-HASHES: no block hashes in cache for: %r", hashed_path)
+            return None
+        return BlockHashEntry(*msgpack.unpackb(entry))
+
+    def memorize_block_hashes(self, hashed_path, path_hash, *, block_size, size, hashes, chunks):
+        """Memorize the block *hashes* of a file (or block device) of *size* bytes along with its *chunks*"""
+        if "d" in self.cache_mode:
+            return
+        if self.block_hashes is None:
+            self._read_block_hashes()
+        entry = BlockHashEntry(
+            age=0, block_size=block_size, size=size, hashes=bytes(hashes), chunks=[(c.id, c.size) for c in chunks]
+        )
+        self.block_hashes[path_hash] = msgpack.packb(entry)
+        self.block_hashes_changed = True
+        files_cache_logger.debug(
+            "BLOCK-HASHES-UPDATE: put %d block hashes, %d chunks <- %r", len(hashes) // 8, len(chunks), hashed_path
+        )
+
 
 class AdHocCache(CacheStatsMixin):
     """
@@ -1109,7 +1433,13 @@ def file_known_and_unchanged(self, hashed_path, path_hash, st):
     def memorize_file(self, hashed_path, path_hash, st, ids):
         pass
 
-    def add_chunk(self, id, meta, data, *, stats, overwrite=False, wait=True, compress=True, size=None):
+    def known_block_hashes(self, hashed_path, path_hash):
+        return None
+
+    def memorize_block_hashes(self, hashed_path, path_hash, *, block_size, size, hashes, chunks):
+        pass
+
+    def add_chunk(self, id, meta, data, *, stats, overwrite=False, wait=True, compress=True, size=None, cdata=None):
         assert not overwrite, "AdHocCache does not permit overwrites — trying to use it for recreate?"
         if not self._txn_active:
             self.begin_txn()
@@ -1120,7 +1450,8 @@ def add_chunk(self, id, meta, data, *, stats, overwrite=False, wait=True, compre
         refcount = self.seen_chunk(id, size)
         if refcount:
             return self.chunk_incref(id, stats, size=size)
-        cdata = self.repo_objs.format(id, meta, data, compress=compress)
+        if cdata is None:
+            cdata = self.repo_objs.format(id, meta, data, compress=compress)
         self.repository.put(id, cdata, wait=wait)
         self.chunks.add(id, 1, size)
         stats.update(size, not refcount)
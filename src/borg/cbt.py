@@ -0,0 +1,539 @@
+"""
+Changed block tracking (CBT): what ThinObjectProcessors needs from the thing managing the volumes it backs up.
+
+A provider knows how to find a volume by name, take point-in-time snapshots of it and tell which blocks changed
+between two of its snapshots. LvmCbt does this for LVM thin volumes (with thin pool metadata), FileCbt for image
+files which are written through CbtImage (with per-block generation maps).
+"""
+
+import base64
+import json
+import os
+import stat
+import subprocess
+import threading
+import time
+import uuid
+from array import array
+from collections import namedtuple
+from contextlib import contextmanager, ExitStack
+
+from .helpers import Error
+from .helpers import lvm
+from .helpers import os_open, flags_special_follow, clone_file, data_ranges
+from .helpers.parseformat import lv_name_re
+
+from .logger import create_logger
+
+logger = create_logger(__name__)
+
+
+class CbtError(Error):
+    """{}"""
+
+
+# *data* is private to the provider
+Volume = namedtuple('Volume', 'name uuid block_size data')
+# *archive_name* is the archive the snapshot was backed up to (None if unknown)
+Snapshot = namedtuple('Snapshot', 'name uuid path size archive_name data')
+
+
+class CbtProvider:
+    """
+    Interface of changed block tracking providers.
+
+    Snapshots are tagged with the repository they were taken for. The one of the last successful backup of a
+    volume is marked as the last one (commit_snapshot), there must only be one such snapshot per volume and
+    repository. Methods may be called from several threads at once.
+    """
+
+    def get_volume(self, name):
+        """Look up the volume *name* (as given on the command line), raising CbtError if it can't be backed up"""
+        raise NotImplementedError
+
+    def create_snapshot(self, volume, *, repo_id, archive_name):
+        """Take a new snapshot of *volume* for a backup to archive *archive_name* in repository *repo_id* (hex)"""
+        raise NotImplementedError
+
+    def last_snapshot(self, volume, *, repo_id):
+        """Return the snapshot of *volume* marked as the last one for repository *repo_id*, or None"""
+        raise NotImplementedError
+
+    def commit_snapshot(self, snapshot, *, archive_name=None):
+        """
+        Mark *snapshot* as the last one (after it was backed up successfully), no longer partial.
+
+        *archive_name* is given if the snapshot ended up in another archive than the one it was taken for.
+        """
+        raise NotImplementedError
+
+    def partial_snapshot(self, volume, *, repo_id):
+        """Return the snapshot of *volume* marked as partial for repository *repo_id*, or None"""
+        raise NotImplementedError
+
+    def mark_partial(self, snapshot, *, archive_name):
+        """
+        Keep *snapshot* (instead of releasing it) as only partly backed up, to checkpoints of *archive_name*.
+
+        The next backup of the volume resumes from it rather than taking a new snapshot, there must only be
+        one partial snapshot per volume and repository.
+        """
+        raise NotImplementedError
+
+    def release_snapshot(self, snapshot):
+        """Delete *snapshot*"""
+        raise NotImplementedError
+
+    def open_snapshot(self, snapshot):
+        """Open *snapshot* for reading, returning a file descriptor"""
+        return os_open(path=snapshot.path, flags=flags_special_follow)
+
+    @contextmanager
+    def delta(self, volume, last, snapshot):
+        """
+        Yield an iterator over the blocks of *snapshot* which are allocated or changed since snapshot *last*, as
+        lvm.Delta ranges in order. With *last* being None, all allocated blocks are given as right_only.
+
+        The iterator is only valid within the with-block.
+        """
+        raise NotImplementedError
+
+    @contextmanager
+    def deltas(self):
+        """
+        Yield a function like delta(), for getting the deltas of several volumes within the with-block.
+
+        It may be called from several threads. Providers can override this to share work between the volumes,
+        all their snapshots must be taken before the first delta is asked for.
+        """
+        yield self.delta
+
+
+class LvmCbt(CbtProvider):
+    """Changed block tracking for LVM thin volumes, with the thin pool metadata (thin_delta/thin_dump)"""
+
+    def __init__(self):
+        self.lvs = lvm.LvmInventory()
+        # pool metadata snapshot path -> lock, as there can only be one metadata snapshot per pool
+        self._pool_locks = {}
+
+    @staticmethod
+    def wrap_lvm_call(task, fun, *args, **kwargs):
+        """Replace CalledProcessError with CbtError (so backup continues for other LVs)"""
+        try:
+            return fun(*args, **kwargs)
+        except subprocess.CalledProcessError as ex:
+            if ex.returncode != 5:
+                raise
+            raise CbtError(f'LVM {task} failed')
+
+    def get_volume(self, name):
+        m = lv_name_re.match(name)
+        if not m:
+            raise CbtError(f'Invalid LV name "{name}"')
+        info = self.lvs.get(name)
+        if info is None:
+            raise CbtError(f'LV {name} not found')
+        if not info['pool_lv'] or info['segtype'] != 'thin':
+            raise CbtError(f'{name} is not a thin LV')
+
+        pool_info = self.lvs.get_uuid(info['pool_lv_uuid'])
+        meta_info = self.lvs.get_uuid(pool_info['metadata_lv_uuid'])
+        return Volume(
+            name=name, uuid=info['lv_uuid'], block_size=lvm.get_size(pool_info, 'chunk_size'),
+            data=(info, pool_info, meta_info))
+
+    @staticmethod
+    def _snapshot(info, archive_name=None):
+        return Snapshot(
+            name=info['lv_full_name'], uuid=info['lv_uuid'], path=info['lv_path'],
+            size=lvm.get_size(info, 'lv_size'), archive_name=archive_name, data=info)
+
+    def create_snapshot(self, volume, *, repo_id, archive_name):
+        vg, lv = lv_name_re.match(volume.name).groups()
+        name = f'{lv}_{time.time_ns() // 1000 // 1000}'  # time in ms suffix so it's unique (but still short)
+        logger.debug(f'creating next snap {vg}/{name}')
+        info = self.wrap_lvm_call(
+            f'create new backup snapshot {vg}/{name}', self.lvs.create,
+            vg, name,
+            '-pr',  # read-only
+            '-kn',  # no activation skip
+            '-ay',  # activate now
+            f'--addtag=borgrepo-{repo_id}',  # id_str is a hex string
+            f'--addtag={self._archive_tag(archive_name)}',
+            '--snapshot', volume.name)
+        return self._snapshot(info, archive_name)
+
+    def _tagged_snapshot(self, volume, *, repo_id, tag, what):
+        lvs = self.lvs.select(origin_uuid=volume.uuid, tags=(f'borgrepo-{repo_id}', tag))
+        if not lvs:
+            return None
+        if len(lvs) != 1:
+            raise CbtError(f'Inconsistency detected: More than one {what} snapshot exists for {volume.name}')
+
+        info = lvs[0]
+        for tag in info['lv_tags'].split(','):
+            if tag.startswith('borgarch-'):
+                return self._snapshot(info, base64.b64decode(tag[len('borgarch-'):]).decode('utf-8'))
+        return self._snapshot(info)
+
+    def last_snapshot(self, volume, *, repo_id):
+        return self._tagged_snapshot(volume, repo_id=repo_id, tag='borgthin-last', what='valid')
+
+    def partial_snapshot(self, volume, *, repo_id):
+        return self._tagged_snapshot(volume, repo_id=repo_id, tag='borgthin-partial', what='partial')
+
+    @staticmethod
+    def _archive_tag(archive_name):
+        # https://github.com/lvmteam/lvm2/blob/b84a9927b78727efffbb257a61e9e95a648cdfab/lib/misc/lvm-string.c#L49
+        # tag charset: A-Za-z0-9._-+/=!:&# (aka fine for plain base64)
+        # seems length is unlimited?
+        return 'borgarch-' + base64.b64encode(archive_name.encode('utf-8')).decode('ascii')
+
+    @classmethod
+    def _archive_tag_params(cls, snapshot, archive_name):
+        """lvchange parameters to point the borgarch tag of *snapshot* at *archive_name*"""
+        if archive_name is None or archive_name == snapshot.archive_name:
+            return []
+        params = ['--addtag', cls._archive_tag(archive_name)]
+        if snapshot.archive_name is not None:
+            params += ['--deltag', cls._archive_tag(snapshot.archive_name)]
+        return params
+
+    def commit_snapshot(self, snapshot, *, archive_name=None):
+        params = self._archive_tag_params(snapshot, archive_name)
+        if 'borgthin-partial' in snapshot.data['lv_tags'].split(','):
+            params += ['--deltag', 'borgthin-partial']
+        self.wrap_lvm_call(
+            f'mark new backup snapshot {snapshot.name} as completed', self.lvs.change,
+            snapshot.uuid, '--addtag', 'borgthin-last', *params)
+
+    def mark_partial(self, snapshot, *, archive_name):
+        params = self._archive_tag_params(snapshot, archive_name)
+        if 'borgthin-partial' not in snapshot.data['lv_tags'].split(','):
+            params += ['--addtag', 'borgthin-partial']
+        if params:
+            self.wrap_lvm_call(
+                f'keep partial backup snapshot {snapshot.name}', self.lvs.change, snapshot.uuid, *params)
+
+    def release_snapshot(self, snapshot):
+        self.wrap_lvm_call(f'delete snapshot {snapshot.name}', self.lvs.remove, snapshot.uuid)
+
+    @contextmanager
+    def _meta_snapshot(self, volume):
+        _, pool_info, _ = volume.data
+        tpool_path = pool_info['lv_dm_path'] + '-tpool'
+        # a pool can only have one metadata snapshot at a time, so LVs in the same pool need to take turns
+        with self._pool_locks.setdefault(tpool_path, threading.Lock()), lvm.meta_snapshot(tpool_path):
+            yield
+
+    def _delta(self, volume, last, snapshot):
+        """Delta from the metadata snapshot of the volume's pool, which must be held"""
+        _, _, meta_info = volume.data
+        meta_path = meta_info['lv_dm_path']
+        if last is None:
+            return self.wrap_lvm_call(
+                f'dump {snapshot.name} thin metadata', lvm.thin_dump,
+                meta_path, int(snapshot.data['thin_id']))
+
+        logger.debug(f'calculating thin delta for {last.name} -> {snapshot.name}')
+        return self.wrap_lvm_call(
+            f'calculate delta from last snapshot {last.name}', lvm.thin_delta,
+            meta_path, int(last.data['thin_id']), int(snapshot.data['thin_id']))
+
+    @contextmanager
+    def delta(self, volume, last, snapshot):
+        with self._meta_snapshot(volume):
+            yield self._delta(volume, last, snapshot)
+
+    @contextmanager
+    def deltas(self):
+        # one metadata snapshot per pool for the deltas of all LVs in it (the snapshots must all exist already),
+        # taken for the first of them and held until the with-block is done
+        with ExitStack() as stack:
+            lock = threading.Lock()
+            pools = set()
+
+            @contextmanager
+            def delta(volume, last, snapshot):
+                _, pool_info, _ = volume.data
+                with lock:
+                    if pool_info['lv_uuid'] not in pools:
+                        stack.enter_context(self._meta_snapshot(volume))
+                        pools.add(pool_info['lv_uuid'])
+                yield self._delta(volume, last, snapshot)
+
+            yield delta
+
+
+class CbtImage:
+    """
+    An image file with changes tracked in a per-block generation map, for FileCbt.
+
+    The state is kept in a directory next to the image (``IMAGE.cbt``). Every block has the generation it was
+    last written in (0 for holes), the generation is bumped for every snapshot. Only writes (and discards) made
+    through this class are tracked, other writes to the image are missed by the next incremental backup.
+
+    Only one CbtImage (or snapshot) may be open per image at a time, across processes.
+    """
+
+    default_block_size = 64 * 1024
+
+    def __init__(self, path, *, block_size=None, create_size=None):
+        """
+        Open the image *path* for tracked writes (starting to track it if it isn't yet).
+
+        With *create_size*, a new (sparse) image of that size is created if it doesn't exist.
+        """
+        self.path = path
+        self.state_dir = path + '.cbt'
+        if create_size is not None and not os.path.exists(path):
+            with open(path, 'xb') as f:
+                f.truncate(create_size)
+        self.fd = os.open(path, os.O_RDWR)
+        try:
+            os.makedirs(self.state_dir, exist_ok=True)
+            self._lock_fd = os.open(os.path.join(self.state_dir, 'lock'), os.O_RDWR | os.O_CREAT, 0o600)
+            self._lock()
+            self._load(block_size)
+        except (OSError, ValueError, CbtError):
+            self.close(save=False)
+            raise
+
+    def _lock(self):
+        import fcntl
+
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise CbtError(f'{self.path} is in use') from None
+
+    def _load(self, block_size):
+        size = os.fstat(self.fd).st_size
+        try:
+            with open(os.path.join(self.state_dir, 'volume'), 'r') as f:
+                self.info = json.load(f)
+        except FileNotFoundError:
+            self.info = None
+        if self.info is None:
+            # start tracking, all data which is already there is in the first generation
+            self.info = {'uuid': uuid.uuid4().hex, 'block_size': block_size or self.default_block_size, 'generation': 1}
+            if size % self.block_size:
+                raise CbtError(f'size of {self.path} is not a multiple of {self.block_size}')
+            logger.warning(f'{self.path}: starting changed block tracking, only tracked writes will be backed up')
+            self.map = array('I', [0]) * (size // self.block_size)
+            for begin, end in data_ranges(self.fd, size):
+                for block in range(begin // self.block_size, -(-end // self.block_size)):
+                    self.map[block] = 1
+            self._save()
+            return
+
+        self.map = self._read_map(os.path.join(self.state_dir, 'map'))
+        if len(self.map) * self.block_size != size:
+            raise CbtError(f'size of {self.path} changed outside of changed block tracking')
+
+    @staticmethod
+    def _read_map(path):
+        gens = array('I')
+        with open(path, 'rb') as f:
+            data = f.read()
+        gens.frombytes(data)
+        return gens
+
+    @staticmethod
+    def _write_file(path, data):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _save(self):
+        self._write_file(os.path.join(self.state_dir, 'map'), self.map.tobytes())
+        self._write_file(os.path.join(self.state_dir, 'volume'), json.dumps(self.info).encode())
+
+    @property
+    def block_size(self):
+        return self.info['block_size']
+
+    @property
+    def uuid(self):
+        return self.info['uuid']
+
+    @property
+    def size(self):
+        return len(self.map) * self.block_size
+
+    def _touch(self, offset, size, generation):
+        end = offset + size
+        if end > self.size:
+            # grow in whole blocks
+            blocks = -(-end // self.block_size)
+            self.map.extend([0] * (blocks - len(self.map)))
+            os.ftruncate(self.fd, self.size)
+        for block in range(offset // self.block_size, -(-end // self.block_size)):
+            self.map[block] = generation
+
+    def write(self, offset, data):
+        """Write *data* at *offset*, the image grows in whole blocks if needed"""
+        self._touch(offset, len(data), self.info['generation'])
+        data = memoryview(data)
+        while data:
+            written = os.pwrite(self.fd, data, offset)
+            data = data[written:]
+            offset += written
+
+    def discard(self, offset, size):
+        """
+        Turn the whole blocks within *size* bytes at *offset* into holes.
+
+        The blocks are overwritten with zeros (the space isn't freed), so the image reads the same as the backups.
+        """
+        begin = -(-offset // self.block_size)
+        end = min((offset + size) // self.block_size, len(self.map))
+        zeros = bytes(self.block_size)
+        for block in range(begin, end):
+            self.map[block] = 0
+            os.pwrite(self.fd, zeros, block * self.block_size)
+
+    def snapshot(self, snap_id):
+        """Save a point-in-time copy of the image and its map as snapshot *snap_id*, starting a new generation"""
+        img_path = os.path.join(self.state_dir, f'snap-{snap_id}.img')
+        os.fsync(self.fd)
+        clone_file(self.path, img_path)
+        with open(img_path, 'rb') as f:
+            os.fsync(f.fileno())
+        self._write_file(os.path.join(self.state_dir, f'snap-{snap_id}.map'), self.map.tobytes())
+        self.info['generation'] += 1
+        self._save()
+        return img_path
+
+    def close(self, save=True):
+        if self.fd is None:
+            return
+        try:
+            if save:
+                os.fsync(self.fd)
+                self._save()
+        finally:
+            os.close(self.fd)
+            self.fd = None
+            if getattr(self, '_lock_fd', None) is not None:
+                os.close(self._lock_fd)
+                self._lock_fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close(save=exc[0] is None)
+
+
+class FileCbt(CbtProvider):
+    """
+    Changed block tracking for image files (see CbtImage), no LVM (or root) needed.
+
+    Volumes are named by the path of the image. Snapshots are copies of the image (reflinks if the file system
+    supports them) kept with the generation map in the image's state directory.
+    """
+
+    def get_volume(self, name):
+        try:
+            st = os.stat(name)
+        except OSError as e:
+            raise CbtError(f'{name}: {e.strerror}') from None
+        if not stat.S_ISREG(st.st_mode):
+            raise CbtError(f'{name} is not an image file')
+        with CbtImage(name) as image:
+            return Volume(name=name, uuid=image.uuid, block_size=image.block_size, data=image.state_dir)
+
+    @staticmethod
+    def _snap_path(volume, snap_id, ext):
+        return os.path.join(volume.data, f'snap-{snap_id}.{ext}')
+
+    def _snapshot(self, volume, snap_id, info):
+        path = self._snap_path(volume, snap_id, 'img')
+        return Snapshot(
+            name=f'{volume.name}@{snap_id}', uuid=snap_id, path=path, size=os.stat(path).st_size,
+            archive_name=info.get('archive_name'), data=info)
+
+    def create_snapshot(self, volume, *, repo_id, archive_name):
+        snap_id = uuid.uuid4().hex
+        logger.debug(f'creating next snap {volume.name}@{snap_id}')
+        with CbtImage(volume.name) as image:
+            if image.uuid != volume.uuid:
+                raise CbtError(f'{volume.name} was replaced')
+            image.snapshot(snap_id)
+        info = {'repo_id': repo_id, 'archive_name': archive_name, 'last': False}
+        CbtImage._write_file(self._snap_path(volume, snap_id, 'json'), json.dumps(info).encode())
+        return self._snapshot(volume, snap_id, info)
+
+    def _snapshots(self, volume):
+        for name in sorted(os.listdir(volume.data)):
+            if name.startswith('snap-') and name.endswith('.json'):
+                snap_id = name[len('snap-'):-len('.json')]
+                with open(os.path.join(volume.data, name)) as f:
+                    yield snap_id, json.load(f)
+
+    def _flagged_snapshot(self, volume, *, repo_id, flag, what):
+        snaps = [
+            (snap_id, info) for snap_id, info in self._snapshots(volume)
+            if info['repo_id'] == repo_id and info.get(flag)]
+        if not snaps:
+            return None
+        if len(snaps) != 1:
+            raise CbtError(f'Inconsistency detected: More than one {what} snapshot exists for {volume.name}')
+        return self._snapshot(volume, *snaps[0])
+
+    def last_snapshot(self, volume, *, repo_id):
+        return self._flagged_snapshot(volume, repo_id=repo_id, flag='last', what='valid')
+
+    def partial_snapshot(self, volume, *, repo_id):
+        return self._flagged_snapshot(volume, repo_id=repo_id, flag='partial', what='partial')
+
+    @staticmethod
+    def _update_info(snapshot, **kwargs):
+        info = dict(snapshot.data, **kwargs)
+        CbtImage._write_file(os.path.splitext(snapshot.path)[0] + '.json', json.dumps(info).encode())
+
+    def commit_snapshot(self, snapshot, *, archive_name=None):
+        self._update_info(
+            snapshot, last=True, partial=False, archive_name=archive_name or snapshot.archive_name)
+
+    def mark_partial(self, snapshot, *, archive_name):
+        self._update_info(snapshot, partial=True, archive_name=archive_name)
+
+    def release_snapshot(self, snapshot):
+        base = os.path.splitext(snapshot.path)[0]
+        # the json goes first, without it the rest is garbage
+        for ext in ('json', 'map', 'img'):
+            try:
+                os.unlink(f'{base}.{ext}')
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _delta(old, new):
+        """Yield lvm.Delta ranges for the generation maps *old* and *new* (of snapshots)"""
+        run_type, run_begin = None, 0
+        for block, gen in enumerate(new):
+            old_gen = old[block] if block < len(old) else 0
+            if not gen:
+                t = 'left_only' if old_gen else None
+            elif not old_gen:
+                t = 'right_only'
+            else:
+                t = 'same' if gen == old_gen else 'different'
+            if t != run_type:
+                if run_type is not None:
+                    yield lvm.Delta(run_type, run_begin, block - run_begin)
+                run_type, run_begin = t, block
+        if run_type is not None:
+            yield lvm.Delta(run_type, run_begin, len(new) - run_begin)
+
+    @contextmanager
+    def delta(self, volume, last, snapshot):
+        new = CbtImage._read_map(os.path.splitext(snapshot.path)[0] + '.map')
+        old = CbtImage._read_map(os.path.splitext(last.path)[0] + '.map') if last is not None else array('I')
+        yield self._delta(old, new)
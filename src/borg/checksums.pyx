@@ -23,10 +23,10 @@ cdef extern from "xxhash.h":
 
     XXH64_state_t* XXH64_createState()
     XXH_errorcode XXH64_freeState(XXH64_state_t* statePtr)
-    XXH64_hash_t XXH64(const void* input, size_t length, unsigned long long seed)
+    XXH64_hash_t XXH64(const void* input, size_t length, unsigned long long seed) nogil
 
     XXH_errorcode XXH64_reset(XXH64_state_t* statePtr, unsigned long long seed)
-    XXH_errorcode XXH64_update(XXH64_state_t* statePtr, const void* input, size_t length)
+    XXH_errorcode XXH64_update(XXH64_state_t* statePtr, const void* input, size_t length) nogil
     XXH64_hash_t XXH64_digest(const XXH64_state_t* statePtr)
 
     void XXH64_canonicalFromHash(XXH64_canonical_t* dst, XXH64_hash_t hash)
@@ -50,7 +50,8 @@ def xxh64(data, seed=0):
     cdef XXH64_canonical_t digest
     cdef Py_buffer data_buf = ro_buffer(data)
     try:
-        hash = XXH64(data_buf.buf, data_buf.len, _seed)
+        with nogil:
+            hash = XXH64(data_buf.buf, data_buf.len, _seed)
     finally:
         PyBuffer_Release(&data_buf)
     XXH64_canonicalFromHash(&digest, hash)
@@ -71,8 +72,11 @@ cdef class StreamingXXH64:
 
     def update(self, data):
         cdef Py_buffer data_buf = ro_buffer(data)
+        cdef XXH_errorcode rc
         try:
-            if XXH64_update(self.state, data_buf.buf, data_buf.len) != XXH_OK:
+            with nogil:
+                rc = XXH64_update(self.state, data_buf.buf, data_buf.len)
+            if rc != XXH_OK:
                 raise Exception('XXH64_update failed')
         finally:
             PyBuffer_Release(&data_buf)
@@ -25,6 +25,12 @@ class ChunkerFixed:
     def __init__(self, block_size: int, header_size: int = 0, sparse: bool = False) -> None: ...
     def chunkify(self, fd: BinaryIO = None, fh: int = -1, fmap: List[fmap_entry] = None) -> Iterator: ...
 
+class ChunkerAligned:
+    def __init__(self, chunker: Any, align: int) -> None: ...
+    @property
+    def chunking_time(self) -> float: ...
+    def chunkify(self, fd: BinaryIO = None, fh: int = -1) -> Iterator: ...
+
 class Chunker:
     def __init__(
         self, seed: int, chunk_min_exp: int, chunk_max_exp: int, hash_mask_bits: int, hash_window_size: int
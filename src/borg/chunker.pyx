@@ -274,6 +274,70 @@ class ChunkerFixed:
                     return
 
 
+class ChunkerAligned:
+    """
+    Wraps another chunker so that all cutting places fall on multiples of <align> bytes.
+
+    A cutting place of the wrapped chunker is moved back to the previous multiple of <align>
+    (or, if that would not be behind the start of the current chunk, the data is carried
+    over into the next chunk). For a content-defined chunker the cutting places are thus still
+    content-defined, just quantized to the <align> grid. The last chunk may end off-grid, at EOF.
+
+    Chunks might get up to <align> bytes bigger than the wrapped chunker's maximum chunk size.
+    """
+    def __init__(self, chunker, align):
+        self.chunker = chunker
+        self.align = align
+
+    @property
+    def chunking_time(self):
+        return self.chunker.chunking_time
+
+    @staticmethod
+    def _join(pieces, size):
+        if all(data is None for data, _, _ in pieces):
+            allocation = CH_HOLE if all(a == CH_HOLE for _, _, a in pieces) else CH_ALLOC
+            return Chunk(None, size=size, allocation=allocation)
+        data = b''.join(zeros[:s] if d is None else d for d, s, _ in pieces)
+        return Chunk(data, size=size, allocation=CH_DATA)
+
+    def chunkify(self, fd=None, fh=-1):
+        """
+        Cut a file into chunks.
+
+        :param fd: Python file object
+        :param fh: OS-level file handle (if available),
+                   defaults to -1 which means not to use OS-level fd.
+        """
+        align = self.align
+        pieces = []  # (data, size, allocation) carried over from previous chunks
+        carried = 0  # total size of pieces
+        offset = 0  # file offset of the first piece
+        for chunk in self.chunker.chunkify(fd, fh):
+            data, size, allocation = chunk.data, chunk.meta['size'], chunk.meta['allocation']
+            end = offset + carried + size
+            cut = end - end % align
+            if cut <= offset:
+                # no grid point inside this chunk, carry all of it over.
+                # the wrapped chunker might reuse its buffer, so we need a copy.
+                pieces.append((None if data is None else bytes(data), size, allocation))
+                carried += size
+                continue
+            head = size - (end - cut)
+            if not pieces and head == size:
+                yield chunk  # already on the grid
+            elif not pieces:
+                yield Chunk(None if data is None else data[:head], size=head, allocation=allocation)
+            else:
+                pieces.append((None if data is None else data[:head], head, allocation))
+                yield self._join(pieces, cut - offset)
+            pieces = [] if head == size else [(None if data is None else bytes(data[head:]), size - head, allocation)]
+            carried = size - head
+            offset = cut
+        if pieces:
+            yield self._join(pieces, carried)
+
+
 cdef class Chunker:
     """
     Content-Defined Chunker, variable chunk sizes.
@@ -17,6 +17,7 @@ decompressor.
 
 import random
 from struct import Struct
+import threading
 import zlib
 
 try:
@@ -28,6 +29,8 @@ except ImportError:
 from .constants import MAX_DATA_SIZE
 from .helpers import Buffer, DecompressionError
 
+from cpython.buffer cimport PyBUF_SIMPLE, PyObject_GetBuffer, PyBuffer_Release
+
 API_VERSION = '1.2_02'
 
 cdef extern from "lz4.h":
@@ -47,7 +50,21 @@ cdef extern from "zstd.h":
     const char* ZSTD_getErrorName(size_t code) nogil
 
 
-buffer = Buffer(bytearray, size=0)
+# the (de)compressors write into this buffer while not holding the GIL, so every thread needs its own one.
+thread_buffers = threading.local()
+
+
+def get_buffer(size):
+    buffer = getattr(thread_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = thread_buffers.buffer = Buffer(bytearray, size=0)
+    return buffer.get(size)
+
+
+cdef Py_buffer ro_buffer(object data) except *:
+    cdef Py_buffer view
+    PyObject_GetBuffer(data, &view, PyBUF_SIMPLE)
+    return view
 
 
 cdef class CompressorBase:
@@ -216,17 +233,19 @@ class LZ4(DecidingCompressor):
 
         *lz4_data* is the LZ4 result if *compressor* is LZ4 as well, otherwise it is None.
         """
-        if not isinstance(idata, bytes):
-            idata = bytes(idata)  # code below does not work with memoryview
-        cdef int isize = len(idata)
+        cdef Py_buffer ibuf = ro_buffer(idata)
+        cdef int isize = ibuf.len
         cdef int osize
-        cdef char *source = idata
+        cdef const char *source = <const char *> ibuf.buf
         cdef char *dest
-        osize = LZ4_compressBound(isize)
-        buf = buffer.get(osize)
-        dest = <char *> buf
-        with nogil:
-            osize = LZ4_compress_default(source, dest, isize, osize)
+        try:
+            osize = LZ4_compressBound(isize)
+            buf = get_buffer(osize)
+            dest = <char *> buf
+            with nogil:
+                osize = LZ4_compress_default(source, dest, isize, osize)
+        finally:
+            PyBuffer_Release(&ibuf)
         if not osize:
             raise Exception('lz4 compress failed')
         # only compress if the result actually is smaller
@@ -237,31 +256,33 @@ class LZ4(DecidingCompressor):
 
     def decompress(self, meta, data):
         meta, idata = super().decompress(meta, data)
-        if not isinstance(idata, bytes):
-            idata = bytes(idata)  # code below does not work with memoryview
-        cdef int isize = len(idata)
+        cdef Py_buffer ibuf = ro_buffer(idata)
+        cdef int isize = ibuf.len
         cdef int osize
         cdef int rsize
-        cdef char *source = idata
+        cdef const char *source = <const char *> ibuf.buf
         cdef char *dest
-        # a bit more than 8MB is enough for the usual data sizes yielded by the chunker.
-        # allocate more if isize * 3 is already bigger, to avoid having to resize often.
-        osize = max(int(1.1 * 2**23), isize * 3)
-        while True:
-            try:
-                buf = buffer.get(osize)
-            except MemoryError:
-                raise DecompressionError('MemoryError')
-            dest = <char *> buf
-            with nogil:
-                rsize = LZ4_decompress_safe(source, dest, isize, osize)
-            if rsize >= 0:
-                break
-            if osize > 2 ** 27:  # 128MiB (should be enough, considering max. repo obj size and very good compression)
-                # this is insane, get out of here
-                raise DecompressionError('lz4 decompress failed')
-            # likely the buffer was too small, get a bigger one:
-            osize = int(1.5 * osize)
+        try:
+            # a bit more than 8MB is enough for the usual data sizes yielded by the chunker.
+            # allocate more if isize * 3 is already bigger, to avoid having to resize often.
+            osize = max(int(1.1 * 2**23), isize * 3)
+            while True:
+                try:
+                    buf = get_buffer(osize)
+                except MemoryError:
+                    raise DecompressionError('MemoryError')
+                dest = <char *> buf
+                with nogil:
+                    rsize = LZ4_decompress_safe(source, dest, isize, osize)
+                if rsize >= 0:
+                    break
+                if osize > 2 ** 27:  # 128MiB (should be enough, considering max. repo obj size and very good compression)
+                    # this is insane, get out of here
+                    raise DecompressionError('lz4 decompress failed')
+                # likely the buffer was too small, get a bigger one:
+                osize = int(1.5 * osize)
+        finally:
+            PyBuffer_Release(&ibuf)
         data = dest[:rsize]
         self.check_fix_size(meta, data)
         return meta, data
@@ -305,9 +326,8 @@ class LZMA(DecidingCompressor):
 
 class ZSTD(DecidingCompressor):
     """zstd compression / decompression (pypi: zstandard, gh: python-zstandard)"""
-    # This is a NOT THREAD SAFE implementation.
-    # Only ONE python context must be created at a time.
-    # It should work flawlessly as long as borg will call ONLY ONE compression job at time.
+    # the simple ZSTD_(de)compress API uses a new zstd context for every call and the output
+    # buffer is per thread, so multiple threads can (de)compress at the same time.
     ID = 0x03
     name = 'zstd'
 
@@ -321,18 +341,20 @@ class ZSTD(DecidingCompressor):
 
         *zstd_data* is the ZSTD result if *compressor* is ZSTD as well, otherwise it is None.
         """
-        if not isinstance(idata, bytes):
-            idata = bytes(idata)  # code below does not work with memoryview
-        cdef int isize = len(idata)
+        cdef Py_buffer ibuf = ro_buffer(idata)
+        cdef int isize = ibuf.len
         cdef int osize
-        cdef char *source = idata
+        cdef const char *source = <const char *> ibuf.buf
         cdef char *dest
         cdef int level = self.level
-        osize = ZSTD_compressBound(isize)
-        buf = buffer.get(osize)
-        dest = <char *> buf
-        with nogil:
-            osize = ZSTD_compress(dest, osize, source, isize, level)
+        try:
+            osize = ZSTD_compressBound(isize)
+            buf = get_buffer(osize)
+            dest = <char *> buf
+            with nogil:
+                osize = ZSTD_compress(dest, osize, source, isize, level)
+        finally:
+            PyBuffer_Release(&ibuf)
         if ZSTD_isError(osize):
             raise Exception('zstd compress failed: %s' % ZSTD_getErrorName(osize))
         # only compress if the result actually is smaller
@@ -343,25 +365,27 @@ class ZSTD(DecidingCompressor):
 
     def decompress(self, meta, data):
         meta, idata = super().decompress(meta, data)
-        if not isinstance(idata, bytes):
-            idata = bytes(idata)  # code below does not work with memoryview
-        cdef int isize = len(idata)
+        cdef Py_buffer ibuf = ro_buffer(idata)
+        cdef int isize = ibuf.len
         cdef unsigned long long osize
         cdef unsigned long long rsize
-        cdef char *source = idata
+        cdef const char *source = <const char *> ibuf.buf
         cdef char *dest
-        osize = ZSTD_getFrameContentSize(source, isize)
-        if osize == ZSTD_CONTENTSIZE_ERROR:
-            raise DecompressionError('zstd get size failed: data was not compressed by zstd')
-        if osize == ZSTD_CONTENTSIZE_UNKNOWN:
-            raise DecompressionError('zstd get size failed: original size unknown')
         try:
-            buf = buffer.get(osize)
-        except MemoryError:
-            raise DecompressionError('MemoryError')
-        dest = <char *> buf
-        with nogil:
-            rsize = ZSTD_decompress(dest, osize, source, isize)
+            osize = ZSTD_getFrameContentSize(source, isize)
+            if osize == ZSTD_CONTENTSIZE_ERROR:
+                raise DecompressionError('zstd get size failed: data was not compressed by zstd')
+            if osize == ZSTD_CONTENTSIZE_UNKNOWN:
+                raise DecompressionError('zstd get size failed: original size unknown')
+            try:
+                buf = get_buffer(osize)
+            except MemoryError:
+                raise DecompressionError('MemoryError')
+            dest = <char *> buf
+            with nogil:
+                rsize = ZSTD_decompress(dest, osize, source, isize)
+        finally:
+            PyBuffer_Release(&ibuf)
         if ZSTD_isError(rsize):
             raise DecompressionError('zstd decompress failed: %s' % ZSTD_getErrorName(rsize))
         if rsize != osize:
@@ -3,7 +3,7 @@
 ITEM_KEYS = frozenset(['path', 'source', 'target', 'rdev', 'chunks', 'chunks_healthy', 'hardlink_master', 'hlid',
                        'mode', 'user', 'group', 'uid', 'gid', 'mtime', 'atime', 'ctime', 'birthtime', 'size',
                        'xattrs', 'bsdflags', 'acl_nfs4', 'acl_access', 'acl_default', 'acl_extended',
-                       'part'])
+                       'part', 'holes'])
 # fmt: on
 
 # this is the set of keys that are always present in items:
@@ -73,6 +73,11 @@
 # repo.list() / .scan() result count limit the borg client uses
 LIST_SCAN_LIMIT = 100000
 
+# the repository keeps the change log (see Repository.get_changes) of that many transactions
+CHANGES_KEEP = 100
+# the change log of a transaction records at most that many object ids (put + delete) resp. cache changes
+CHANGES_LIMIT = 500000
+
 FD_MAX_AGE = 4 * 60  # 4 minutes
 
 # chunker algorithms
@@ -99,6 +104,10 @@
 FILES_CACHE_MODE_UI_DEFAULT = "ctime,size,inode"  # default for "borg create" command (CLI UI)
 FILES_CACHE_MODE_DISABLED = "d"  # most borg commands do not use the files cache at all (disable)
 
+# block hashes (borg create --block-hashes) of block devices and big files, kept next to the files cache
+BLOCK_HASH_SIZE = 1024 * 1024  # 1MiB blocks, 8 bytes of hash each
+BLOCK_HASH_MIN_SIZE = 64 * BLOCK_HASH_SIZE  # regular files smaller than that are just chunked again
+
 # return codes returned by borg command
 # when borg is killed by signal N, rc = 128 + N
 EXIT_SUCCESS = 0  # everything done, no problems
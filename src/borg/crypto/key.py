@@ -1,6 +1,7 @@
 import hmac
 import os
 import textwrap
+import threading
 from binascii import a2b_base64, b2a_base64, hexlify
 from hashlib import sha256, pbkdf2_hmac
 from typing import Literal, Callable, ClassVar
@@ -202,6 +203,22 @@ def encrypt(self, id, data):
     def decrypt(self, id, data):
         pass
 
+    def new_cipher(self):
+        """Return a new cipher object for the current crypt key / session"""
+        raise NotImplementedError
+
+    def thread_cipher(self):
+        """
+        Return the cipher object of the current thread.
+
+        The ciphers release the GIL while en-/decrypting, but one cipher object must not be used by
+        multiple threads at the same time. Thus, every thread gets its own one for the actual work.
+        """
+        cipher = getattr(self.thread_ciphers, "cipher", None)
+        if cipher is None:
+            cipher = self.thread_ciphers.cipher = self.new_cipher()
+        return cipher
+
     def assert_id(self, id, data):
         if id and id != Manifest.MANIFEST_ID:
             id_computed = self.id_hash(data)
@@ -372,13 +389,17 @@ class AESKeyBase(KeyBase):
     logically_encrypted = True
 
     def encrypt(self, id, data):
-        next_iv = self.nonce_manager.ensure_reservation(self.cipher.next_iv(), self.cipher.block_count(len(data)))
-        return self.cipher.encrypt(data, header=self.TYPE_STR, iv=next_iv)
+        # self.cipher hands out the ivs, the encryption itself uses a cipher of the current thread, see thread_cipher.
+        blocks = self.cipher.block_count(len(data))
+        with self.iv_lock:
+            next_iv = self.nonce_manager.ensure_reservation(self.cipher.next_iv(), blocks)
+            self.cipher.set_iv(next_iv + blocks)
+        return self.thread_cipher().encrypt(data, header=self.TYPE_STR, iv=next_iv)
 
     def decrypt(self, id, data):
         self.assert_type(data[0], id)
         try:
-            return self.cipher.decrypt(data)
+            return self.thread_cipher().decrypt(data)
         except IntegrityError as e:
             raise IntegrityError(f"Chunk {bin_to_hex(id)}: Could not decrypt [{str(e)}]")
 
@@ -398,9 +419,14 @@ def init_from_random_data(self):
             chunk_seed = chunk_seed - 0xFFFFFFFF - 1
         self.init_from_given_data(crypt_key=data[0:64], id_key=data[64:96], chunk_seed=chunk_seed)
 
-    def init_ciphers(self, manifest_data=None):
+    def new_cipher(self):
         enc_key, enc_hmac_key = self.crypt_key[0:32], self.crypt_key[32:]
-        self.cipher = self.CIPHERSUITE(mac_key=enc_hmac_key, enc_key=enc_key, header_len=1, aad_offset=1)
+        return self.CIPHERSUITE(mac_key=enc_hmac_key, enc_key=enc_key, header_len=1, aad_offset=1)
+
+    def init_ciphers(self, manifest_data=None):
+        self.cipher = self.new_cipher()
+        self.iv_lock = threading.Lock()
+        self.thread_ciphers = threading.local()
         if manifest_data is None:
             nonce = 0
         else:
@@ -847,14 +873,17 @@ def assert_id(self, id, data):
         pass
 
     def encrypt(self, id, data):
-        # to encrypt new data in this session we use always self.cipher and self.sessionid
+        # to encrypt new data in this session we always use self.sessionid and an iv handed out by self.cipher,
+        # the encryption itself uses a cipher of the current thread, see thread_cipher.
         reserved = b"\0"
-        iv = self.cipher.next_iv()
-        if iv > self.MAX_IV:  # see the data-structures docs about why the IV range is enough
-            raise IntegrityError("IV overflow, should never happen.")
+        with self.iv_lock:
+            iv = self.cipher.next_iv()
+            if iv > self.MAX_IV:  # see the data-structures docs about why the IV range is enough
+                raise IntegrityError("IV overflow, should never happen.")
+            self.cipher.set_iv(iv)
         iv_48bit = iv.to_bytes(6, "big")
         header = self.TYPE_STR + reserved + iv_48bit + self.sessionid
-        return self.cipher.encrypt(data, header=header, iv=iv, aad=id)
+        return self.thread_cipher().encrypt(data, header=header, iv=iv, aad=id)
 
     def decrypt(self, id, data):
         # to decrypt existing data, we need to get a cipher configured for the sessionid and iv from header
@@ -900,10 +929,15 @@ def _get_cipher(self, sessionid, iv):
         cipher = self.CIPHERSUITE(key=key, iv=iv, header_len=1 + 1 + 6 + 24, aad_offset=0)
         return cipher
 
+    def new_cipher(self):
+        return self._get_cipher(self.sessionid, iv=0)
+
     def init_ciphers(self, manifest_data=None, iv=0):
         # in every new session we start with a fresh sessionid and at iv == 0, manifest_data and iv params are ignored
         self.sessionid = os.urandom(24)
-        self.cipher = self._get_cipher(self.sessionid, iv=0)
+        self.cipher = self.new_cipher()
+        self.iv_lock = threading.Lock()
+        self.thread_ciphers = threading.local()
 
 
 class AESOCBKeyfileKey(ID_HMAC_SHA_256, AEADKeyBase, FlexiKey):
@@ -32,6 +32,12 @@ IV handling:
     envelope = cs.encrypt(data, header, aad_offset)
     iv = cs.next_iv(len(data))
     (repeat)
+
+Threads:
+
+    The bulk en-/decryption runs without holding the GIL, so multiple threads can
+    en-/decrypt at the same time. But a cipher object (its context and iv) must only
+    be used by one thread at a time, use one cipher object per thread.
 """
 
 import hashlib
@@ -67,17 +73,17 @@ cdef extern from "openssl/evp.h":
     void EVP_CIPHER_CTX_cleanup(EVP_CIPHER_CTX *a)
 
     int EVP_EncryptInit_ex(EVP_CIPHER_CTX *ctx, const EVP_CIPHER *cipher, ENGINE *impl,
-                           const unsigned char *key, const unsigned char *iv)
+                           const unsigned char *key, const unsigned char *iv) nogil
     int EVP_DecryptInit_ex(EVP_CIPHER_CTX *ctx, const EVP_CIPHER *cipher, ENGINE *impl,
-                           const unsigned char *key, const unsigned char *iv)
+                           const unsigned char *key, const unsigned char *iv) nogil
     int EVP_EncryptUpdate(EVP_CIPHER_CTX *ctx, unsigned char *out, int *outl,
-                          const unsigned char *in_, int inl)
+                          const unsigned char *in_, int inl) nogil
     int EVP_DecryptUpdate(EVP_CIPHER_CTX *ctx, unsigned char *out, int *outl,
-                          const unsigned char *in_, int inl)
-    int EVP_EncryptFinal_ex(EVP_CIPHER_CTX *ctx, unsigned char *out, int *outl)
-    int EVP_DecryptFinal_ex(EVP_CIPHER_CTX *ctx, unsigned char *out, int *outl)
+                          const unsigned char *in_, int inl) nogil
+    int EVP_EncryptFinal_ex(EVP_CIPHER_CTX *ctx, unsigned char *out, int *outl) nogil
+    int EVP_DecryptFinal_ex(EVP_CIPHER_CTX *ctx, unsigned char *out, int *outl) nogil
 
-    int EVP_CIPHER_CTX_ctrl(EVP_CIPHER_CTX *ctx, int type, int arg, void *ptr)
+    int EVP_CIPHER_CTX_ctrl(EVP_CIPHER_CTX *ctx, int type, int arg, void *ptr) nogil
     int EVP_CTRL_AEAD_GET_TAG
     int EVP_CTRL_AEAD_SET_TAG
     int EVP_CTRL_AEAD_SET_IVLEN
@@ -245,6 +251,7 @@ cdef class AES256_CTR_BASE:
             raise MemoryError
         cdef int olen = 0
         cdef int offset
+        cdef int rc
         cdef Py_buffer idata = ro_buffer(data)
         cdef Py_buffer hdata = ro_buffer(header)
         try:
@@ -257,7 +264,9 @@ cdef class AES256_CTR_BASE:
             offset += self.iv_len_short
             if not EVP_EncryptInit_ex(self.ctx, EVP_aes_256_ctr(), NULL, self.enc_key, self.iv):
                 raise CryptoError('EVP_EncryptInit_ex failed')
-            if not EVP_EncryptUpdate(self.ctx, odata+offset, &olen, <const unsigned char*> idata.buf, ilen):
+            with nogil:
+                rc = EVP_EncryptUpdate(self.ctx, odata+offset, &olen, <const unsigned char*> idata.buf, ilen)
+            if not rc:
                 raise CryptoError('EVP_EncryptUpdate failed')
             offset += olen
             if not EVP_EncryptFinal_ex(self.ctx, odata+offset, &olen):
@@ -286,6 +295,7 @@ cdef class AES256_CTR_BASE:
             raise MemoryError
         cdef int olen = 0
         cdef int offset
+        cdef int rc
         cdef unsigned char mac_buf[32]
         assert sizeof(mac_buf) == self.mac_len
         cdef Py_buffer idata = ro_buffer(envelope)
@@ -298,9 +308,11 @@ cdef class AES256_CTR_BASE:
             if not EVP_DecryptInit_ex(self.ctx, EVP_aes_256_ctr(), NULL, self.enc_key, iv):
                 raise CryptoError('EVP_DecryptInit_ex failed')
             offset = 0
-            if not EVP_DecryptUpdate(self.ctx, odata+offset, &olen,
-                                     <const unsigned char*> idata.buf+hlen+self.mac_len+self.iv_len_short,
-                                     ilen-hlen-self.mac_len-self.iv_len_short):
+            with nogil:
+                rc = EVP_DecryptUpdate(self.ctx, odata+offset, &olen,
+                                       <const unsigned char*> idata.buf+hlen+self.mac_len+self.iv_len_short,
+                                       ilen-hlen-self.mac_len-self.iv_len_short)
+            if not rc:
                 raise CryptoError('EVP_DecryptUpdate failed')
             offset += olen
             if not EVP_DecryptFinal_ex(self.ctx, odata+offset, &olen):
@@ -481,6 +493,7 @@ cdef class _AEAD_BASE:
             raise MemoryError
         cdef int olen = 0
         cdef int offset
+        cdef int rc
         cdef Py_buffer idata = ro_buffer(data)
         cdef Py_buffer hdata = ro_buffer(header)
         cdef Py_buffer aadata = ro_buffer(aad)
@@ -500,7 +513,9 @@ cdef class _AEAD_BASE:
                 raise CryptoError('EVP_EncryptUpdate failed')
             if not EVP_EncryptUpdate(self.ctx, NULL, &olen, <const unsigned char*> hdata.buf+aoffset, alen):
                 raise CryptoError('EVP_EncryptUpdate failed')
-            if not EVP_EncryptUpdate(self.ctx, odata+offset, &olen, <const unsigned char*> idata.buf, ilen):
+            with nogil:
+                rc = EVP_EncryptUpdate(self.ctx, odata+offset, &olen, <const unsigned char*> idata.buf, ilen)
+            if not rc:
                 raise CryptoError('EVP_EncryptUpdate failed')
             offset += olen
             if not EVP_EncryptFinal_ex(self.ctx, odata+offset, &olen):
@@ -536,6 +551,7 @@ cdef class _AEAD_BASE:
             raise MemoryError
         cdef int olen = 0
         cdef int offset
+        cdef int rc
         cdef Py_buffer idata = ro_buffer(envelope)
         cdef Py_buffer aadata = ro_buffer(aad)
         try:
@@ -550,9 +566,11 @@ cdef class _AEAD_BASE:
             if not EVP_DecryptUpdate(self.ctx, NULL, &olen, <const unsigned char*> idata.buf+aoffset, alen):
                 raise CryptoError('EVP_DecryptUpdate failed')
             offset = 0
-            if not EVP_DecryptUpdate(self.ctx, odata+offset, &olen,
-                                     <const unsigned char*> idata.buf+hlen+self.mac_len,
-                                     ilen-hlen-self.mac_len):
+            with nogil:
+                rc = EVP_DecryptUpdate(self.ctx, odata+offset, &olen,
+                                       <const unsigned char*> idata.buf+hlen+self.mac_len,
+                                       ilen-hlen-self.mac_len)
+            if not rc:
                 raise CryptoError('EVP_DecryptUpdate failed')
             offset += olen
             if not EVP_CIPHER_CTX_ctrl(self.ctx, EVP_CTRL_AEAD_SET_TAG, self.mac_len, <unsigned char *> idata.buf + hlen):
@@ -714,11 +732,28 @@ cdef class AES:  # legacy
 
 
 def hmac_sha256(key, data):
-    return hmac.digest(key, data, 'sha256')
+    cdef Py_buffer key_buf = ro_buffer(key)
+    cdef Py_buffer data_buf = ro_buffer(data)
+    cdef unsigned char md[32]
+    cdef unsigned int md_len = 0
+    cdef unsigned char *rc
+    try:
+        with nogil:
+            rc = HMAC(EVP_sha256(), key_buf.buf, <int> key_buf.len,
+                      <const unsigned char *> data_buf.buf, <int> data_buf.len, md, &md_len)
+        if rc == NULL:
+            raise CryptoError('HMAC(EVP_sha256) failed')
+        return md[:md_len]
+    finally:
+        PyBuffer_Release(&data_buf)
+        PyBuffer_Release(&key_buf)
 
 
 def blake2b_256(key, data):
-    return hashlib.blake2b(key+data, digest_size=32).digest()
+    # feeding key and data separately avoids copying data, hashlib releases the GIL for the latter.
+    h = hashlib.blake2b(key, digest_size=32)
+    h.update(data)
+    return h.digest()
 
 
 def blake2b_128(data):
@@ -0,0 +1,626 @@
+"""
+Storage of the files cache.
+
+The files cache remembers, per path hash, what a regular file looked like when it was last backed up (inode
+number, size, ctime or mtime) and which chunks it consisted of, so unchanged files need not be read again.
+
+It is kept in a base file which gets memory-mapped, so loading it does not depend on the number of entries
+and the entries do not live on the heap::
+
+    MAGIC | chunk ids | buckets | trailer
+
+The buckets form a hash table with linear probing (like the one of hashindex), keyed by the path hash. Each
+bucket holds a fixed size record with the stat data, the age and the position of the file's chunk ids in the
+chunk id array. An all-zero key marks an empty bucket (path hashes are MACs, no file gets that one), a bucket
+with age DELETED a deleted entry (it keeps its key, so the entry gets its bucket back if it is re-added).
+
+Commits do not rewrite the base file, they append a record to the journal file::
+
+    JOURNAL_MAGIC, entries length, seen length, flags | entries | seen | xxh64 digest
+
+The entries are the ones added or changed in that backup (key, length, VALUE and chunk ids - length 0 deletes
+the entry), seen is a (compressed) bitmap of the buckets of the base file seen in that backup. Each record is
+one backup: entries of the base file not seen in it are one backup older after it. A record written by a later
+commit of the same backup (e.g. a checkpoint) replaces the previous record (REPLACES_PREVIOUS flag), it is
+appended rather than written over that one, so committed bytes of the journal never change and a hard link
+is enough to snapshot it for a cache transaction. Only the base file or the whole journal get replaced. The
+journal is loaded into
+memory. Once it gets long, a new base file with the same bucket layout is written in the background while the
+cache is in use (compaction) and the journal starts over on commit. If the journal gets too large anyway or
+the base file too full, commit rewrites the base file.
+
+Entries added or changed while the cache is in use are kept in memory (packed, without any msgpack) until
+they are committed, entries from the base file which were seen again are tracked in a bitmap.
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from collections import namedtuple
+
+from .checksums import xxh64
+from .crypto.file_integrity import IntegrityCheckedFile, FileIntegrityError
+from .helpers import msgpack
+from .helpers.msgpack import timestamp_to_int
+from .logger import create_logger
+from .platform import SaveFile
+
+logger = create_logger()
+
+files_cache_logger = create_logger("borg.debug.files_cache")
+
+# note: cmtime might me either a ctime or a mtime timestamp [ns]
+FileCacheEntry = namedtuple("FileCacheEntry", "age inode size cmtime chunk_ids")
+
+MAGIC = b"BORG_FC1"
+JOURNAL_MAGIC = b"BORG_FCJ"
+ID_SIZE = 32
+EMPTY_KEY = bytes(ID_SIZE)
+DELETED = 0xFFFFFFFF
+# key, inode, size, cmtime, index of first chunk id, number of chunk ids, age
+BUCKET = struct.Struct("<32sQQqQII")
+# number of chunk ids (all, used by entries), number of buckets, number of entries (live, deleted), magic
+TRAILER = struct.Struct("<QQQQQ8s")
+# inode, size, cmtime, age - followed by the chunk ids
+VALUE = struct.Struct("<QQqI")
+# magic, length of the entries, length of the seen bitmap, flags
+RECORD = struct.Struct("<8sQQI")
+REPLACES_PREVIOUS = 1
+# key, length of the value
+JOURNAL_ENTRY = struct.Struct("<32sI")
+DIGEST_SIZE = 8
+MIN_BUCKETS = 1031
+READ_SIZE = 4 * 1024 * 1024
+# compact when the journal has that many records or is larger than 1/16 of the base file,
+# rewrite the base file on commit rather than letting the journal get larger than 1/8 of it.
+COMPACT_RECORDS = 8
+COMPACT_FRACTION = 16
+REWRITE_FRACTION = 8
+MIN_JOURNAL_SIZE = 1024 * 1024
+
+
+def is_set(bitmap, idx):
+    return bitmap[idx >> 3] & (1 << (idx & 7))
+
+
+def set_bit(bitmap, idx, value=True):
+    if value:
+        bitmap[idx >> 3] |= 1 << (idx & 7)
+    else:
+        bitmap[idx >> 3] &= ~(1 << (idx & 7))
+
+
+def iter_bits(bitmap, block_size=4096):
+    """Yield the indexes of the set bits in *bitmap*"""
+    zero = bytes(block_size)
+    for start in range(0, len(bitmap), block_size):
+        block = bitmap[start : start + block_size]
+        if block == zero[: len(block)]:
+            continue
+        for i, byte in enumerate(block, start):
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield i * 8 + bit
+
+
+class FilesIndex:
+    """Read-only, memory-mapped base file of the files cache"""
+
+    def __init__(self, path):
+        with open(path, "rb") as fd:
+            self.mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(self.mm) < len(MAGIC) + TRAILER.size or self.mm[: len(MAGIC)] != MAGIC:
+                raise ValueError("not a files cache file")
+            trailer = TRAILER.unpack_from(self.mm, len(self.mm) - TRAILER.size)
+            self.num_chunks, self.num_live_chunks, self.num_buckets, self.num_entries, self.num_deleted = trailer[:5]
+            self.buckets_offset = len(MAGIC) + self.num_chunks * ID_SIZE
+            if (
+                trailer[5] != MAGIC
+                or self.num_entries + self.num_deleted >= self.num_buckets
+                or self.buckets_offset + self.num_buckets * BUCKET.size + TRAILER.size != len(self.mm)
+            ):
+                raise ValueError("files cache file has an invalid layout")
+        except Exception:
+            self.mm.close()
+            raise
+
+    def __len__(self):
+        return self.num_entries
+
+    @property
+    def size(self):
+        return len(self.mm)
+
+    def close(self):
+        self.mm.close()
+
+    def _key(self, idx):
+        offset = self.buckets_offset + idx * BUCKET.size
+        return self.mm[offset : offset + ID_SIZE]
+
+    def find(self, key):
+        """Return (index, bucket) of *key* (which might be a deleted entry), index is -1 if it is not in the table"""
+        idx = int.from_bytes(key[:4], "little") % self.num_buckets
+        while True:
+            bucket = BUCKET.unpack_from(self.mm, self.buckets_offset + idx * BUCKET.size)
+            if bucket[0] == key:
+                return idx, bucket
+            if bucket[0] == EMPTY_KEY:
+                return -1, None
+            idx = (idx + 1) % self.num_buckets
+
+    def lookup(self, key):
+        """Return (index, bucket) of *key*, index is -1 if it is not in the table"""
+        idx, bucket = self.find(key)
+        if idx >= 0 and bucket[-1] == DELETED:
+            return -1, None
+        return idx, bucket
+
+    def free_bucket(self, key, taken):
+        """Return the index of the first empty bucket for *key* which is not in *taken*"""
+        idx = int.from_bytes(key[:4], "little") % self.num_buckets
+        while idx in taken or self._key(idx) != EMPTY_KEY:
+            idx = (idx + 1) % self.num_buckets
+        return idx
+
+    def chunk_ids(self, start, count):
+        offset = len(MAGIC) + start * ID_SIZE
+        data = self.mm[offset : offset + count * ID_SIZE]
+        return [data[i : i + ID_SIZE] for i in range(0, len(data), ID_SIZE)]
+
+    def iter_buckets(self, all=False):
+        """Yield (index, bucket) of the buckets with entries (or of *all* buckets)"""
+        end = self.buckets_offset + self.num_buckets * BUCKET.size
+        step = READ_SIZE // BUCKET.size * BUCKET.size
+        idx = 0
+        for offset in range(self.buckets_offset, end, step):
+            # iterate over copies, a view into the mmap would keep it from being closed
+            for bucket in BUCKET.iter_unpack(self.mm[offset : min(offset + step, end)]):
+                if all or bucket[0] != EMPTY_KEY and bucket[-1] != DELETED:
+                    yield idx, bucket
+                idx += 1
+
+    @staticmethod
+    def write(fd, entries, capacity, tmp_dir=None):
+        """
+        Write *entries* ((key, FileCacheEntry) tuples, at most *capacity*) to file-like *fd*.
+
+        Writing needs to be sequential (*fd* usually is an IntegrityCheckedFile), so the hash table is
+        assembled in a temporary file in *tmp_dir* first. Returns the number of entries written.
+        """
+        # a load factor <= 0.6 leaves room for entries added by compaction, it aborts beyond 0.75
+        num_buckets = max(capacity * 5 // 3 + 1, MIN_BUCKETS)
+        table_size = num_buckets * BUCKET.size
+        num_chunks = num_entries = 0
+        fd.write(MAGIC)
+        with tempfile.TemporaryFile(dir=tmp_dir) as tmp:
+            tmp.truncate(table_size)
+            with mmap.mmap(tmp.fileno(), table_size) as table:
+                for key, entry in entries:
+                    assert num_entries < capacity
+                    idx = int.from_bytes(key[:4], "little") % num_buckets
+                    while table[idx * BUCKET.size : idx * BUCKET.size + ID_SIZE] != EMPTY_KEY:
+                        idx = (idx + 1) % num_buckets
+                    count = len(entry.chunk_ids)
+                    value = entry.inode, entry.size, entry.cmtime, num_chunks, count, entry.age
+                    BUCKET.pack_into(table, idx * BUCKET.size, key, *value)
+                    fd.write(b"".join(entry.chunk_ids))
+                    num_chunks += count
+                    num_entries += 1
+                for offset in range(0, table_size, READ_SIZE):
+                    fd.write(table[offset : offset + READ_SIZE])
+        fd.write(TRAILER.pack(num_chunks, num_chunks, num_buckets, num_entries, 0, MAGIC))
+        return num_entries
+
+
+class CompactionAborted(Exception):
+    """the base file can't be compacted (or compaction was cancelled)"""
+
+
+class FilesCache:
+    """
+    The files cache, a mapping of path hash -> FileCacheEntry.
+
+    Entries from the base file and the journal are one backup older than they were when they were committed,
+    unless they were seen again (see touch). Entries which got *ttl* backups old on commit are gone.
+    """
+
+    def __init__(self, index=None, *, path=None, journal_path=None, ttl=20):
+        self.index = index
+        self.path = path
+        self.journal_path = journal_path
+        self.ttl = ttl
+        # bitmap of the buckets of self.index seen in this backup
+        self.seen = bytearray(index.num_buckets // 8 + 1) if index is not None else None
+        # bitmap of the buckets of self.index seen in this backup which need to pass keep() on commit
+        self.recheck = bytearray(index.num_buckets // 8 + 1) if index is not None else None
+        # seen bitmaps of the journal records, oldest first
+        self.generations = []
+        # key -> VALUE + chunk ids (or b"" for deleted entries), ages as of the last commit
+        self.journal = {}
+        # length of the journal as read and as of the last commit (records of this backup are behind journal_size)
+        self.journal_size = 0
+        self.journal_end = 0
+        # key -> VALUE + chunk ids, entries added or changed in this backup
+        self.changed = {}
+        self.count = len(index) if index is not None else 0
+        # the base file needs to be rewritten on commit (again, if this is true)
+        self.rewrite = False
+        self.compaction = None
+        self.compacted = None
+
+    @classmethod
+    def read(cls, path, integrity_data=None, *, journal_path=None, journal_integrity_data=None, ttl=20):
+        """
+        Read the files cache at *path* (and its journal at *journal_path*), verifying their integrity first.
+
+        Files cache files of older borg versions (msgpacked entries) are loaded into memory. Raises
+        FileIntegrityError, OSError or ValueError / TypeError (for invalid contents).
+        """
+        with IntegrityCheckedFile(path=path, write=False, integrity_data=integrity_data) as fd:
+            data = fd.read(len(MAGIC))
+            if data != MAGIC:
+                return cls._read_legacy(fd, data, path=path, journal_path=journal_path, ttl=ttl)
+            while fd.read(READ_SIZE):
+                pass
+        files = cls(FilesIndex(path), path=path, journal_path=journal_path, ttl=ttl)
+        try:
+            if journal_path is not None:
+                files._read_journal(journal_integrity_data)
+        except Exception:
+            files.close()
+            raise
+        if len(files.generations) >= COMPACT_RECORDS or files.journal_size > files.index.size // COMPACT_FRACTION:
+            files.start_compaction()
+        return files
+
+    @classmethod
+    def _read_legacy(cls, fd, data, **kw):
+        files = cls(**kw)
+        u = msgpack.Unpacker(use_list=True)
+        while data:
+            u.feed(data)
+            for path_hash, item in u:
+                entry = FileCacheEntry(*item)
+                files[path_hash] = entry._replace(age=entry.age + 1, cmtime=timestamp_to_int(entry.cmtime))
+            data = fd.read(64 * 1024)
+        return files
+
+    def _read_journal(self, integrity_data):
+        # the length of the journal as of the last commit, there might be a partial record behind it
+        length = int(integrity_data) if integrity_data is not None else None
+        try:
+            fd = open(self.journal_path, "rb")
+        except FileNotFoundError:
+            if length:
+                raise FileIntegrityError(self.journal_path) from None
+            return
+        records = []
+        with fd:
+            while length is None or self.journal_size < length:
+                header = fd.read(RECORD.size)
+                if not header and length is None:
+                    break
+                if len(header) != RECORD.size:
+                    raise FileIntegrityError(self.journal_path)
+                magic, entries_size, seen_size, flags = RECORD.unpack(header)
+                if magic != JOURNAL_MAGIC:
+                    raise FileIntegrityError(self.journal_path)
+                body_size = entries_size + seen_size
+                body = fd.read(body_size + DIGEST_SIZE)
+                if len(body) != body_size + DIGEST_SIZE or xxh64(header + body[:body_size]) != body[body_size:]:
+                    raise FileIntegrityError(self.journal_path)
+                if flags & REPLACES_PREVIOUS:
+                    if not records:
+                        raise FileIntegrityError(self.journal_path)
+                    records.pop()
+                records.append((body[:entries_size], body[entries_size:body_size]))
+                self.journal_size += RECORD.size + len(body)
+        self.journal_end = self.journal_size
+        for generation, (entries, seen) in enumerate(records, 1):
+            seen = bytearray(zlib.decompress(seen))
+            if len(seen) != len(self.seen):
+                raise ValueError("files cache journal does not match the base file")
+            self.generations.append(seen)
+            # make the ages relative to the last record
+            older = len(records) - generation
+            offset = 0
+            while offset < len(entries):
+                key, length = JOURNAL_ENTRY.unpack_from(entries, offset)
+                offset += JOURNAL_ENTRY.size
+                value = entries[offset : offset + length]
+                offset += length
+                if value and older:
+                    inode, size, cmtime, age = VALUE.unpack_from(value)
+                    age += older
+                    value = VALUE.pack(inode, size, cmtime, age) + value[VALUE.size :] if age < self.ttl else b""
+                self.journal[key] = value
+        for key, value in self.journal.items():
+            in_index = self._lookup(key)[0] >= 0
+            if value and not in_index:
+                self.count += 1
+            elif not value and in_index:
+                self.count -= 1
+
+    def close(self):
+        self.cancel_compaction()
+        if self.index is not None:
+            self.index.close()
+
+    def __len__(self):
+        """Number of entries (entries of the base file which expired since the last compaction included)"""
+        return self.count
+
+    def _base_age(self, idx, age):
+        """Age of the entry in bucket *idx* of the base file as of the last commit"""
+        for i, seen in enumerate(reversed(self.generations)):
+            if is_set(seen, idx):
+                return i
+        return age + len(self.generations)
+
+    def _lookup(self, key):
+        if self.index is None:
+            return -1, None
+        idx, bucket = self.index.lookup(key)
+        if idx >= 0 and not is_set(self.seen, idx) and self._base_age(idx, bucket[-1]) >= self.ttl:
+            return -1, None
+        return idx, bucket
+
+    def _from_bucket(self, idx, bucket):
+        _, inode, size, cmtime, start, count, age = bucket
+        age = 0 if is_set(self.seen, idx) else self._base_age(idx, age) + 1
+        return FileCacheEntry(age, inode, size, cmtime, self.index.chunk_ids(start, count))
+
+    @staticmethod
+    def _from_value(value, older=0):
+        inode, size, cmtime, age = VALUE.unpack_from(value)
+        chunk_ids = [value[i : i + ID_SIZE] for i in range(VALUE.size, len(value), ID_SIZE)]
+        return FileCacheEntry(age + older, inode, size, cmtime, chunk_ids)
+
+    def get(self, key):
+        value = self.changed.get(key)
+        if value is not None:
+            return self._from_value(value)
+        value = self.journal.get(key)
+        if value is not None:
+            return self._from_value(value, older=1) if value else None
+        idx, bucket = self._lookup(key)
+        if idx < 0:
+            return None
+        return self._from_bucket(idx, bucket)
+
+    def __setitem__(self, key, entry):
+        if key not in self.changed:
+            value = self.journal.get(key)
+            if value == b"" or value is None and self._lookup(key)[0] < 0:
+                self.count += 1
+        self.changed[key] = VALUE.pack(entry.inode, entry.size, entry.cmtime, entry.age) + b"".join(entry.chunk_ids)
+
+    def touch(self, key, inode, recheck=False):
+        """
+        Mark the known entry *key* as seen in this backup (age 0), with inode number *inode*.
+
+        If *recheck* is true, commit checks the entry with keep() like the ones added in this backup.
+        """
+        value = self.changed.get(key)
+        if value is not None:
+            entry = self._from_value(value)
+        elif key in self.journal:
+            entry = self._from_value(self.journal[key], older=1)
+        else:
+            idx, bucket = self._lookup(key)
+            if bucket[1] == inode:
+                set_bit(self.seen, idx)
+                set_bit(self.recheck, idx, recheck)
+                return
+            entry = self._from_bucket(idx, bucket)
+        self[key] = entry._replace(inode=inode, age=0)
+
+    def items(self):
+        for key, value in self.changed.items():
+            yield key, self._from_value(value)
+        for key, value in self.journal.items():
+            if value and key not in self.changed:
+                yield key, self._from_value(value, older=1)
+        if self.index is not None:
+            for idx, bucket in self.index.iter_buckets():
+                key = bucket[0]
+                if key not in self.changed and key not in self.journal:
+                    entry = self._from_bucket(idx, bucket)
+                    if entry.age <= self.ttl:
+                        yield key, entry
+
+    def write(self, fd, tmp_dir=None, keep=None):
+        """Write the entries for which *keep(entry)* is true to *fd* as a base file, return their number"""
+        entries = ((key, entry) for key, entry in self.items() if keep is None or keep(entry))
+        capacity = len(self.changed) + len(self.journal) + (len(self.index) if self.index is not None else 0)
+        return FilesIndex.write(fd, entries, capacity, tmp_dir=tmp_dir)
+
+    def commit(self, keep):
+        """
+        Persist the files cache, keeping the entries for which *keep(entry)* is true.
+
+        Usually this appends a journal record (superseding the one of an earlier commit in this backup). Files
+        are either appended to or replaced, never modified, see LocalCache.begin_txn. Returns the new integrity
+        data as {filename: integrity data}.
+        """
+        integrity = {}
+        if self.compaction is not None:
+            integrity.update(self.finish_compaction())
+        record = None
+        if self.index is not None and not self.rewrite:
+            record = self._journal_record(keep, replaces=self.journal_end > self.journal_size)
+            if self.journal_end + len(record) > max(self.index.size // REWRITE_FRACTION, MIN_JOURNAL_SIZE):
+                record = None
+        if record is not None:
+            if self.journal_end:
+                with open(self.journal_path, "r+b") as fd:
+                    # drop a partial record of an interrupted commit
+                    fd.truncate(self.journal_end)
+                    fd.seek(self.journal_end)
+                    fd.write(record)
+            else:
+                with SaveFile(self.journal_path, binary=True) as fd:
+                    fd.write(record)
+            self.journal_end += len(record)
+            files_cache_logger.debug("FILES-CACHE-SAVE: finished, %d changed entries journaled.", len(self.changed))
+            integrity[os.path.basename(self.journal_path)] = str(self.journal_end)
+            return integrity
+        # the current base file is still mapped, write the new one next to it and replace it
+        with IntegrityCheckedFile(path=self.path + ".tmp", write=True, filename=os.path.basename(self.path)) as fd:
+            entry_count = self.write(fd, tmp_dir=os.path.dirname(self.path), keep=keep)
+        os.replace(self.path + ".tmp", self.path)
+        files_cache_logger.debug("FILES-CACHE-SAVE: finished, %d remaining entries saved.", entry_count)
+        integrity[os.path.basename(self.path)] = fd.integrity_data
+        if self.journal_path is not None:
+            with SaveFile(self.journal_path, binary=True):
+                pass  # empty file
+            self.journal_size = self.journal_end = 0
+            integrity[os.path.basename(self.journal_path)] = "0"
+        # the bitmaps of this backup do not apply to the new base file, so later commits need to rewrite it, too
+        self.rewrite = True
+        return integrity
+
+    def _journal_record(self, keep, replaces=False):
+        entries = []
+        for key, value in self.changed.items():
+            if not keep(self._from_value(value)):
+                value = b""
+            entries.append(JOURNAL_ENTRY.pack(key, len(value)) + value)
+        seen = bytearray(self.seen)
+        for idx in iter_bits(self.recheck):
+            if is_set(seen, idx):
+                bucket = BUCKET.unpack_from(self.index.mm, self.index.buckets_offset + idx * BUCKET.size)
+                if not keep(self._from_bucket(idx, bucket)):
+                    set_bit(seen, idx, False)
+                    entries.append(JOURNAL_ENTRY.pack(bucket[0], 0))
+        entries = b"".join(entries)
+        seen = zlib.compress(seen, 1)
+        flags = REPLACES_PREVIOUS if replaces else 0
+        record = RECORD.pack(JOURNAL_MAGIC, len(entries), len(seen), flags) + entries + seen
+        return record + xxh64(record)
+
+    def start_compaction(self):
+        """Start writing the state as of the last commit to a new base file, in the background"""
+        if self.compaction is not None:
+            return
+        stop = threading.Event()
+        thread = threading.Thread(target=self._compact, args=(stop,), name="files-cache-compaction", daemon=True)
+        self.compaction = thread, stop
+        thread.start()
+
+    def cancel_compaction(self):
+        if self.compaction is not None:
+            thread, stop = self.compaction
+            stop.set()
+            thread.join()
+            self.compaction = None
+            if self.compacted is not None:
+                os.unlink(self.path + ".compact")
+                self.compacted = None
+
+    def finish_compaction(self):
+        """Wait for the compaction, replace the base file with the compacted one and start a new journal"""
+        thread, stop = self.compaction
+        thread.join()
+        self.compaction = None
+        if self.compacted is None:
+            return {}
+        os.replace(self.path + ".compact", self.path)
+        files_cache_logger.debug("FILES-CACHE-COMPACT: %d journal records merged.", len(self.generations))
+        # the in-memory state (old base file, journal) is equivalent to the compacted base file and the latter
+        # has the same bucket layout, so the bitmaps of this backup apply to it.
+        self.journal_size = self.journal_end = 0
+        integrity_data, self.compacted = self.compacted, None
+        return {os.path.basename(self.path): integrity_data}
+
+    def _compact(self, stop):
+        try:
+            self.compacted = self._write_compacted(stop)
+        except CompactionAborted as exc:
+            files_cache_logger.debug("FILES-CACHE-COMPACT: aborted, %s.", exc)
+            if not stop.is_set():
+                self.rewrite = True
+        except Exception as exc:
+            logger.warning("Compacting the files cache failed: %s", exc)
+        else:
+            return
+        try:
+            os.unlink(self.path + ".compact")
+        except FileNotFoundError:
+            pass
+
+    def _write_compacted(self, stop):
+        """
+        Write the state as of the last commit to a new base file with the same bucket layout.
+
+        This only reads what does not change while the cache is in use: the base file, self.journal and
+        self.generations. The chunk ids of replaced entries stay in the chunk id array until the base file
+        gets rewritten.
+        """
+        index = self.index
+        if index.num_live_chunks < index.num_chunks // 2:
+            raise CompactionAborted("too many unused chunk ids")
+        # journal entries go to the bucket they had (maybe a deleted one) or to a free one
+        placed = {}
+        used = index.num_entries + index.num_deleted
+        for key, value in self.journal.items():
+            idx, bucket = index.find(key)
+            if idx < 0 and value:
+                idx = index.free_bucket(key, placed)
+                used += 1
+            if idx >= 0:
+                placed[idx] = key, value
+        if used >= index.num_buckets * 3 // 4:
+            raise CompactionAborted("base file is too full")
+        path = self.path + ".compact"
+        with IntegrityCheckedFile(path=path, write=True, filename=os.path.basename(self.path)) as fd:
+            fd.write(MAGIC)
+            for offset in range(len(MAGIC), index.buckets_offset, READ_SIZE):
+                if stop.is_set():
+                    raise CompactionAborted("cancelled")
+                fd.write(index.mm[offset : min(offset + READ_SIZE, index.buckets_offset)])
+            num_chunks = index.num_chunks
+            starts = {}
+            for idx, (key, value) in placed.items():
+                if value:
+                    starts[idx] = num_chunks
+                    fd.write(value[VALUE.size :])
+                    num_chunks += (len(value) - VALUE.size) // ID_SIZE
+            num_live_chunks = num_entries = num_deleted = 0
+            buckets = []
+            for idx, bucket in index.iter_buckets(all=True):
+                key, inode, size, cmtime, start, count, age = bucket
+                if idx in placed:
+                    key, value = placed[idx]
+                    if value:
+                        inode, size, cmtime, age = VALUE.unpack_from(value)
+                        start, count = starts[idx], (len(value) - VALUE.size) // ID_SIZE
+                    else:
+                        age = DELETED
+                elif key != EMPTY_KEY and age != DELETED:
+                    age = self._base_age(idx, age)
+                    if age >= self.ttl:
+                        age = DELETED
+                if key != EMPTY_KEY:
+                    if age == DELETED:
+                        inode = size = cmtime = start = count = 0
+                        num_deleted += 1
+                    else:
+                        num_live_chunks += count
+                        num_entries += 1
+                buckets.append(BUCKET.pack(key, inode, size, cmtime, start, count, age))
+                if len(buckets) * BUCKET.size >= READ_SIZE:
+                    if stop.is_set():
+                        raise CompactionAborted("cancelled")
+                    fd.write(b"".join(buckets))
+                    buckets = []
+            fd.write(b"".join(buckets))
+            fd.write(TRAILER.pack(num_chunks, num_live_chunks, index.num_buckets, num_entries, num_deleted, MAGIC))
+        files_cache_logger.debug("FILES-CACHE-COMPACT: finished, %d entries, %d deleted.", num_entries, num_deleted)
+        return fd.integrity_data
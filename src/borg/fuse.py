@@ -37,6 +37,7 @@ def async_wrapper(fn):
 from .crypto.low_level import blake2b_128
 from .archiver._common import build_matcher, build_filter
 from .archive import Archive, get_item_uid_gid
+from .constants import zeros
 from .hashindex import FuseVersionsIndex
 from .helpers import daemonize, daemonizing, signal_handler, format_file_size
 from .helpers import HardLinkManager
@@ -447,6 +448,8 @@ def __init__(self, manifest, args, decrypted_repository):
         logger.debug("mount data cache capacity: %d chunks", data_cache_capacity)
         self.data_cache = LRUCache(capacity=data_cache_capacity, dispose=lambda _: None)
         self._last_pos = LRUCache(capacity=FILES, dispose=lambda _: None)
+        # chunk lists with the holes merged in (see Item.chunks_with_holes)
+        self._chunk_lists = LRUCache(capacity=FILES, dispose=lambda _: None)
 
     def sig_info_handler(self, sig_no, stack):
         logger.debug(
@@ -664,7 +667,9 @@ def read(self, fh, offset, size):
             chunk_no, chunk_offset = (0, 0)
 
         offset -= chunk_offset
-        chunks = item.chunks
+        chunks = self._chunk_lists.get(fh)
+        if chunks is None:
+            chunks = self._chunk_lists[fh] = item.chunks_with_holes()
         # note: using index iteration to avoid frequently copying big (sub)lists by slicing
         for idx in range(chunk_no, len(chunks)):
             id, s = chunks[idx]
@@ -674,17 +679,21 @@ def read(self, fh, offset, size):
                 chunk_no += 1
                 continue
             n = min(size, s - offset)
-            if id in self.data_cache:
-                data = self.data_cache[id]
-                if offset + n == len(data):
-                    # evict fully read chunk from cache
-                    del self.data_cache[id]
+            if id is None:
+                # hole, see Item.chunks_with_holes
+                parts.append(zeros[:n])
             else:
-                _, data = self.repo_objs.parse(id, self.repository_uncached.get(id))
-                if offset + n < len(data):
-                    # chunk was only partially read, cache it
-                    self.data_cache[id] = data
-            parts.append(data[offset : offset + n])
+                if id in self.data_cache:
+                    data = self.data_cache[id]
+                    if offset + n == len(data):
+                        # evict fully read chunk from cache
+                        del self.data_cache[id]
+                else:
+                    _, data = self.repo_objs.parse(id, self.repository_uncached.get(id))
+                    if offset + n < len(data):
+                        # chunk was only partially read, cache it
+                        self.data_cache[id] = data
+                parts.append(data[offset : offset + n])
             offset = 0
             size -= n
             if not size:
@@ -1,3 +1,4 @@
+import mmap
 from collections import namedtuple
 
 cimport cython
@@ -6,30 +7,34 @@ from libc.string cimport memcpy
 from cpython.buffer cimport PyBUF_SIMPLE, PyObject_GetBuffer, PyBuffer_Release
 from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_CheckExact, PyBytes_GET_SIZE, PyBytes_AS_STRING
 
-API_VERSION = '1.2_01'
+API_VERSION = '1.2_02'
 
 
 cdef extern from "_hashindex.c":
     ctypedef struct HashIndex:
-        pass
+        # buckets backed by a Python buffer (index read from a file) if buf is not NULL
+        Py_buffer buckets_buffer
+        # buckets are a read-only mapping of the index file
+        int readonly
 
     ctypedef struct FuseVersionsElement:
         uint32_t version
         char hash[16]
 
-    HashIndex *hashindex_read(object file_py, int permit_compact, int legacy) except *
+    HashIndex *hashindex_read(object file_py, int permit_compact, int legacy, object mapping_py) except *
     HashIndex *hashindex_init(int capacity, int key_size, int value_size)
     void hashindex_free(HashIndex *index)
     int hashindex_len(HashIndex *index)
     int hashindex_size(HashIndex *index)
     void hashindex_write(HashIndex *index, object file_py, int legacy) except *
-    unsigned char *hashindex_get(HashIndex *index, unsigned char *key)
-    unsigned char *hashindex_next_key(HashIndex *index, unsigned char *key)
+    unsigned char *hashindex_get(HashIndex *index, unsigned char *key) nogil
+    unsigned char *hashindex_next_key(HashIndex *index, unsigned char *key) nogil
     int hashindex_delete(HashIndex *index, unsigned char *key)
-    int hashindex_set(HashIndex *index, unsigned char *key, void *value)
+    int hashindex_set(HashIndex *index, unsigned char *key, void *value) nogil
+    int hashindex_promote(HashIndex *index)
     uint64_t hashindex_compact(HashIndex *index)
-    uint32_t _htole32(uint32_t v)
-    uint32_t _le32toh(uint32_t v)
+    uint32_t _htole32(uint32_t v) nogil
+    uint32_t _le32toh(uint32_t v) nogil
 
     double HASH_MAX_LOAD
 
@@ -42,7 +47,7 @@ cdef extern from "cache_sync/cache_sync.c":
     const char *cache_sync_error(const CacheSyncCtx *ctx)
     uint64_t cache_sync_num_files_totals(const CacheSyncCtx *ctx)
     uint64_t cache_sync_size_totals(const CacheSyncCtx *ctx)
-    int cache_sync_feed(CacheSyncCtx *ctx, void *data, uint32_t length)
+    int cache_sync_feed(CacheSyncCtx *ctx, void *data, uint32_t length) nogil
     void cache_sync_free(CacheSyncCtx *ctx)
 
     uint32_t _MAX_VALUE
@@ -94,14 +99,14 @@ cdef class IndexBase:
     MAX_LOAD_FACTOR = HASH_MAX_LOAD
     MAX_VALUE = _MAX_VALUE
 
-    def __cinit__(self, capacity=0, path=None, permit_compact=False, usable=None):
+    def __cinit__(self, capacity=0, path=None, permit_compact=False, usable=None, mapped=False):
         self.key_size = self._key_size
         if path:
             if isinstance(path, (str, bytes)):
                 with open(path, 'rb') as fd:
-                    self.index = hashindex_read(fd, permit_compact, self.legacy)
+                    self.index = hashindex_read(fd, permit_compact, self.legacy, self._map(fd, mapped))
             else:
-                self.index = hashindex_read(path, permit_compact, self.legacy)
+                self.index = hashindex_read(path, permit_compact, self.legacy, self._map(path, mapped))
             assert self.index, 'hashindex_read() returned NULL with no exception set'
         else:
             if usable is not None:
@@ -114,9 +119,35 @@ cdef class IndexBase:
         if self.index:
             hashindex_free(self.index)
 
+    cdef _map(self, fd, mapped):
+        # the buckets of legacy indexes are not aligned, these are always read into memory
+        if not mapped or self.legacy:
+            return None
+        try:
+            fileno = fd.fileno()
+        except (AttributeError, OSError):
+            return None  # not backed by a file, e.g. BytesIO
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+    cdef _promote(self):
+        if not hashindex_promote(self.index):
+            raise Exception('hashindex_promote failed')
+
     @classmethod
-    def read(cls, path, permit_compact=False):
-        return cls(path=path, permit_compact=permit_compact)
+    def read(cls, path, permit_compact=False, mapped=False):
+        """
+        Read an index from *path* (a file name or a file-like object).
+
+        If *mapped* is true, the file is memory-mapped read-only rather than read into memory, which
+        is much cheaper for a big index if only a few lookups are done. The index gets copied into
+        memory when it is changed first.
+        """
+        return cls(path=path, permit_compact=permit_compact, mapped=mapped)
+
+    @property
+    def mapped(self):
+        """whether the index is (still) a read-only mapping of the file it was read from"""
+        return bool(self.index.readonly)
 
     def write(self, path):
         if isinstance(path, (str, bytes)):
@@ -170,6 +201,7 @@ cdef class IndexBase:
         return hashindex_size(self.index)
 
     def compact(self):
+        self._promote()
         return hashindex_compact(self.index)
 
 
@@ -259,6 +291,8 @@ cdef class NSIndex(IndexBase):
         """query and optionally set flags"""
         assert len(key) == self.key_size
         assert isinstance(mask, int)
+        if isinstance(value, int):
+            self._promote()
         data = <uint32_t *>hashindex_get(self.index, <unsigned char *>key)
         if not data:
             raise KeyError(key)
@@ -391,6 +425,31 @@ cdef class NSKeyIterator1:  # legacy borg 1.x
 ChunkIndexEntry = namedtuple('ChunkIndexEntry', 'refcount size')
 
 
+cdef int _merge(HashIndex *index, HashIndex *other, int key_size) nogil:
+    """like ChunkIndex._add for all entries of *other*, return -1 for invalid refcounts, -2 if hashindex_set fails"""
+    cdef unsigned char *key = NULL
+    cdef uint32_t *values
+    cdef uint32_t *data
+    cdef uint64_t refcount1, refcount2, result64
+
+    while True:
+        key = hashindex_next_key(other, key)
+        if not key:
+            return 0
+        data = <uint32_t*> (key + key_size)
+        values = <uint32_t*> hashindex_get(index, key)
+        if values:
+            refcount1 = _le32toh(values[0])
+            refcount2 = _le32toh(data[0])
+            if refcount1 > _MAX_VALUE or refcount2 > _MAX_VALUE:
+                return -1
+            result64 = refcount1 + refcount2
+            values[0] = _htole32(min(result64, _MAX_VALUE))
+            values[1] = data[1]
+        elif not hashindex_set(index, key, data):
+            return -2
+
+
 cdef class ChunkIndex(IndexBase):
     """
     Mapping of 32 byte keys to (refcount, size), which are all 32-bit unsigned.
@@ -439,6 +498,7 @@ cdef class ChunkIndex(IndexBase):
     def incref(self, key):
         """Increase refcount for 'key', return (refcount, size)"""
         assert len(key) == self.key_size
+        self._promote()
         data = <uint32_t *>hashindex_get(self.index, <unsigned char *>key)
         if not data:
             raise KeyError(key)
@@ -452,6 +512,7 @@ cdef class ChunkIndex(IndexBase):
     def decref(self, key):
         """Decrease refcount for 'key', return (refcount, size)"""
         assert len(key) == self.key_size
+        self._promote()
         data = <uint32_t *>hashindex_get(self.index, <unsigned char *>key)
         if not data:
             raise KeyError(key)
@@ -543,6 +604,7 @@ cdef class ChunkIndex(IndexBase):
 
     cdef _add(self, unsigned char *key, uint32_t *data):
         cdef uint64_t refcount1, refcount2, result64
+        self._promote()
         values = <uint32_t*> hashindex_get(self.index, key)
         if values:
             refcount1 = _le32toh(values[0])
@@ -558,6 +620,19 @@ cdef class ChunkIndex(IndexBase):
 
     def merge(self, ChunkIndex other):
         cdef unsigned char *key = NULL
+        cdef int rc
+
+        self._promote()
+        if self.index.buckets_buffer.buf == NULL:
+            # our buckets are not backed by a Python object (which growing the table would release),
+            # so other threads can run meanwhile. Neither index must be used by another thread, though.
+            with nogil:
+                rc = _merge(self.index, other.index, self.key_size)
+            if rc == -1:
+                raise AssertionError('invalid reference count')
+            elif rc == -2:
+                raise Exception('hashindex_set failed')
+            return
 
         while True:
             key = hashindex_next_key(other.index, key)
@@ -566,6 +641,7 @@ cdef class ChunkIndex(IndexBase):
             self._add(key, <uint32_t*> (key + self.key_size))
 
 
+
 cdef class ChunkKeyIterator:
     cdef ChunkIndex idx
     cdef HashIndex *index
@@ -606,6 +682,8 @@ cdef class CacheSynchronizer:
 
     def __cinit__(self, chunks):
         self.chunks = chunks
+        # the entries get changed in place
+        self.chunks._promote()
         self.sync = cache_sync_init(self.chunks.index)
         if not self.sync:
             raise Exception('cache_sync_init failed')
@@ -617,7 +695,12 @@ cdef class CacheSynchronizer:
     def feed(self, chunk):
         cdef Py_buffer chunk_buf = ro_buffer(chunk)
         cdef int rc
-        rc = cache_sync_feed(self.sync, chunk_buf.buf, chunk_buf.len)
+        if self.chunks.index.buckets_buffer.buf == NULL:
+            # see ChunkIndex.merge
+            with nogil:
+                rc = cache_sync_feed(self.sync, chunk_buf.buf, chunk_buf.len)
+        else:
+            rc = cache_sync_feed(self.sync, chunk_buf.buf, chunk_buf.len)
         PyBuffer_Release(&chunk_buf)
         if not rc:
             error = cache_sync_error(self.sync)
@@ -24,7 +24,7 @@ class ExtensionModuleError(Error):
 def check_extension_modules():
     from .. import platform, compress, crypto, item, chunker, hashindex
 
-    if hashindex.API_VERSION != "1.2_01":
+    if hashindex.API_VERSION != "1.2_02":
         raise ExtensionModuleError
     if chunker.API_VERSION != "1.2_01":
         raise ExtensionModuleError
@@ -4,6 +4,7 @@
 import os.path
 import re
 import stat
+import struct
 import subprocess
 import sys
 import textwrap
@@ -435,6 +436,91 @@ def os_stat(*, path=None, parent_fd=None, name=None, follow_symlinks=False):
     return os.stat(fname, dir_fd=parent_fd, follow_symlinks=follow_symlinks)
 
 
+# ioctls from linux/fs.h
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127F
+FICLONE = 0x40049409
+
+
+def blkdiscard(fd, offset, size, *, zeroout=False):
+    """
+    Discard (or, if *zeroout* is True, zero out) *size* bytes at *offset* of the block device open as *fd*.
+
+    Whether discarded ranges read back as zeros depends on the device (thin LVs do, unless the pool
+    ignores discards), while zeroed out ranges always do.
+    """
+    import fcntl
+
+    fcntl.ioctl(fd, BLKZEROOUT if zeroout else BLKDISCARD, struct.pack("QQ", offset, size))
+
+
+def data_ranges(fd, size):
+    """
+    Yield (begin, end) of the data (everything but the holes) in the first *size* bytes of the file open as *fd*.
+
+    Where holes can't be found (SEEK_DATA is not supported), all of it is data.
+    """
+    if not hasattr(os, "SEEK_DATA"):
+        if size:
+            yield 0, size
+        return
+    offset = 0
+    while offset < size:
+        try:
+            begin = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # only a hole left
+                return
+            if e.errno != errno.EINVAL:
+                raise
+            yield offset, size
+            return
+        if begin >= size:
+            return
+        end = min(os.lseek(fd, begin, os.SEEK_HOLE), size)
+        yield begin, end
+        offset = end
+
+
+def copy_range(src_fd, dst_fd, offset, size):
+    """Copy *size* bytes at *offset* of *src_fd* to the same offset of *dst_fd*, with copy_file_range if possible"""
+    end = offset + size
+    while offset < end:
+        try:
+            copied = os.copy_file_range(src_fd, dst_fd, end - offset, offset, offset)
+        except (AttributeError, OSError):
+            copied = 0
+        if not copied:
+            data = os.pread(src_fd, min(end - offset, 8 * 1024 * 1024), offset)
+            if not data:
+                raise OSError(errno.EIO, f"unexpected end of file at {offset}")
+            copied = os.pwrite(dst_fd, data, offset)
+        offset += copied
+
+
+def clone_file(src, dst):
+    """
+    Copy file *src* to *dst*, sharing the data blocks where the filesystem supports it.
+
+    Tries a reflink (FICLONE) first, then copies the data ranges with copy_range (copy_file_range may reflink
+    as well, e.g. on NFS or XFS), keeping the holes of *src*. Only the file contents are copied.
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if sys.platform.startswith("linux"):
+            import fcntl
+
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                pass
+        size = os.fstat(fsrc.fileno()).st_size
+        fdst.truncate(size)
+        for begin, end in data_ranges(fsrc.fileno(), size):
+            copy_range(fsrc.fileno(), fdst.fileno(), begin, end - begin)
+
+
 def umount(mountpoint):
     env = prepare_subprocess_env(system=True)
     try:
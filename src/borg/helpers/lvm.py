@@ -1,12 +1,16 @@
+from collections import defaultdict
 from contextlib import contextmanager
 from enum import Enum
 import json
+import threading
 import xml.etree.ElementTree
 import subprocess
 
+
 def get_size(info, k):
     return int(info[k][:-1])
 
+
 def get_lvs(spec=None, select=None, uuid=None):
     # it would be nice to use json_std (to get proper ints and arrays), but
     # older lvm tools don't support it
@@ -30,10 +34,12 @@ def get_lvs(spec=None, select=None, uuid=None):
     result.check_returncode()
     return json.loads(result.stdout)['report'][0]['lv']
 
+
 def reserve_meta_snapshot(path, activate=True):
     action = 'reserve' if activate else 'release'
     subprocess.check_call(['dmsetup', 'message', path, '0', f'{action}_metadata_snap'])
 
+
 @contextmanager
 def meta_snapshot(path):
     ret = reserve_meta_snapshot(path, activate=True)
@@ -42,22 +48,129 @@ def meta_snapshot(path):
     finally:
         reserve_meta_snapshot(path, activate=False)
 
+
 def create(name, *params):
     cmd = ['lvcreate', '-qq', '-n', name, '--addtag=borgthin']
     cmd += params
     subprocess.check_call(cmd)
 
+
 def rename(vg, old, new):
     subprocess.check_call(['lvrename', '-qq', vg, old, new])
 
+
 def remove(uuid):
     subprocess.check_call(['lvremove', '-qq', '-y', '--select', f'lv_uuid={uuid}'])
 
+
 def change(uuid, *params):
     cmd = ['lvchange', '-qq', '-y', '--select', f'lv_uuid={uuid}']
     cmd += params
     subprocess.check_call(cmd)
 
+
+class LvmInventory:
+    """
+    Index over a report of all LVs on the system, by full name, uuid, origin uuid and tag.
+
+    The full report is only taken once (on first use). Changes made through the inventory's own
+    create/remove/change are reflected by updating just the affected LVs, so there is no need to
+    go back to `lvs` for every lookup. Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._by_uuid = None
+        self._by_name = {}
+        self._by_origin_uuid = defaultdict(set)
+        self._by_tag = defaultdict(set)
+        # LVs changed by us, re-read on the next lookup
+        self._stale = set()
+
+    @staticmethod
+    def _tags(info):
+        return [t for t in info['lv_tags'].split(',') if t]
+
+    def _add(self, info):
+        uuid = info['lv_uuid']
+        if uuid in self._by_uuid:
+            # one row per segment, the first one is good enough (same as get_lvs(...)[0])
+            return
+        self._by_uuid[uuid] = info
+        self._by_name[info['lv_full_name']] = uuid
+        if info.get('origin_uuid'):
+            self._by_origin_uuid[info['origin_uuid']].add(uuid)
+        for tag in self._tags(info):
+            self._by_tag[tag].add(uuid)
+
+    def _drop(self, uuid):
+        info = self._by_uuid.pop(uuid, None)
+        if info is None:
+            return
+        if self._by_name.get(info['lv_full_name']) == uuid:
+            del self._by_name[info['lv_full_name']]
+        self._by_origin_uuid[info.get('origin_uuid')].discard(uuid)
+        for tag in self._tags(info):
+            self._by_tag[tag].discard(uuid)
+
+    def _load(self):
+        if self._by_uuid is None:
+            self._by_uuid = {}
+            for info in get_lvs():
+                self._add(info)
+        while self._stale:
+            uuid = self._stale.pop()
+            self._drop(uuid)
+            for info in get_lvs(uuid=uuid):
+                self._add(info)
+
+    def get(self, name):
+        """Info for the LV with full name (`vg/lv`) *name*, or None"""
+        with self._lock:
+            self._load()
+            uuid = self._by_name.get(name)
+            return None if uuid is None else self._by_uuid[uuid]
+
+    def get_uuid(self, uuid):
+        """Info for the LV with the given uuid, or None"""
+        with self._lock:
+            self._load()
+            return self._by_uuid.get(uuid)
+
+    def select(self, *, origin_uuid=None, tags=()):
+        """Info for all LVs with the given origin and all of the given tags"""
+        with self._lock:
+            self._load()
+            if origin_uuid is not None:
+                uuids = set(self._by_origin_uuid.get(origin_uuid, ()))
+            else:
+                uuids = set(self._by_uuid)
+            for tag in tags:
+                uuids &= self._by_tag.get(tag, set())
+            return sorted((self._by_uuid[uuid] for uuid in uuids), key=lambda info: info['lv_full_name'])
+
+    def create(self, vg, name, *params):
+        """Create LV *name* in *vg* (see create()), returning its info"""
+        create(name, *params)
+        lvs = get_lvs(f'{vg}/{name}')
+        with self._lock:
+            self._load()
+            for info in lvs:
+                self._add(info)
+        return lvs[0]
+
+    def remove(self, uuid):
+        remove(uuid)
+        with self._lock:
+            if self._by_uuid is not None:
+                self._drop(uuid)
+
+    def change(self, uuid, *params):
+        change(uuid, *params)
+        with self._lock:
+            self._stale.add(uuid)
+
+
 class Delta:
     Type = Enum('DeltaType', ['LEFT_ONLY', 'RIGHT_ONLY', 'DIFFERENT', 'SAME'])
 
@@ -79,21 +192,64 @@ def __init__(self, t, begin, length):
     def __repr__(self):
         return f'<{self.type} {self.begin} {self.length}>'
 
+
+def _iterparse_output(cmd):
+    """Run *cmd* and incrementally parse its XML output while it is being produced"""
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    finished = False
+    try:
+        try:
+            yield from xml.etree.ElementTree.iterparse(proc.stdout, events=('start', 'end'))
+        except xml.etree.ElementTree.ParseError:
+            # a tool failing part way through leaves broken XML behind, rather report the failure itself
+            if proc.wait() == 0:
+                raise
+        finished = True
+    finally:
+        if not finished:
+            # consumer gave up early (or parsing failed), no point in letting the tool carry on
+            proc.kill()
+        proc.stdout.close()
+        returncode = proc.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def _iter_mappings(cmd):
+    """
+    Yield (parent, element) for the elements nested in the top-level element of the output of *cmd*,
+    (e.g. superblock -> diff -> mapping). Elements are thrown away once processed so that memory use
+    stays flat, no matter how large the output is.
+    """
+    depth = 0
+    parent = None
+    for event, elem in _iterparse_output(cmd):
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                parent = elem
+            continue
+
+        depth -= 1
+        if depth == 2:
+            yield parent, elem
+            # the parent's attributes are needed (and available) from the start, so wipe everything
+            parent.clear()
+
+
 def thin_delta(meta_path, thin1, thin2):
     cmd = ['thin_delta', '--metadata-snap', '--thin1', str(thin1), '--thin2', str(thin2), meta_path]
-    output = subprocess.check_output(cmd)
-    superblock = xml.etree.ElementTree.fromstring(output)
-
-    assert int(superblock[0].attrib['left']) == thin1 and int(superblock[0].attrib['right']) == thin2
-    for info in superblock[0]:
+    checked = False
+    for diff, info in _iter_mappings(cmd):
+        if not checked:
+            assert int(diff.attrib['left']) == thin1 and int(diff.attrib['right']) == thin2
+            checked = True
         yield Delta(info.tag, int(info.attrib['begin']), int(info.attrib['length']))
 
+
 def thin_dump(meta_path, thin_id):
     cmd = ['thin_dump', '--metadata-snap', '--dev-id', str(thin_id), meta_path]
-    output = subprocess.check_output(cmd)
-    superblock = xml.etree.ElementTree.fromstring(output)
-
-    for info in superblock[0]:
+    for _, info in _iter_mappings(cmd):
         match info.tag:
             case 'single_mapping':
                 begin = int(info.attrib['origin_block'])
@@ -124,7 +124,7 @@ def read(self, nbytes):
 
 def open_item(archive, item):
     """Return file-like object for archived item (with chunks)."""
-    chunk_iterator = archive.pipeline.fetch_many([c.id for c in item.chunks])
+    chunk_iterator = archive.pipeline.fetch_item(item)
     return ChunkIteratorFileWrapper(chunk_iterator)
 
 
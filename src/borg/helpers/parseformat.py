@@ -110,6 +110,14 @@ def positive_int_validator(value):
     return int_value
 
 
+def non_negative_int_validator(value):
+    """argparse type for non-negative integers (e.g. where 0 turns something off)"""
+    int_value = int(value)
+    if int_value < 0:
+        raise argparse.ArgumentTypeError("A non-negative integer is required: %s" % value)
+    return int_value
+
+
 def interval(s):
     """Convert a string representing a valid interval to a number of hours."""
     multiplier = {"H": 1, "d": 24, "w": 24 * 7, "m": 24 * 31, "y": 24 * 365}
@@ -945,7 +953,7 @@ def hash_item(self, hash_function, item):
             hash = self.xxh64()
         elif hash_function in self.hash_algorithms:
             hash = hashlib.new(hash_function)
-        for data in self.archive.pipeline.fetch_many([c.id for c in item.chunks]):
+        for data in self.archive.pipeline.fetch_item(item):
             hash.update(data)
         return hash.hexdigest()
 
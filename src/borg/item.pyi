@@ -169,6 +169,11 @@ class Item(PropDict):
     @chunks_healthy.setter
     def chunks_healthy(self, val: List) -> None: ...
     @property
+    def holes(self) -> List: ...
+    @holes.setter
+    def holes(self, val: List) -> None: ...
+    def chunks_with_holes(self) -> List: ...
+    @property
     def deleted(self) -> bool: ...
     @deleted.setter
     def deleted(self, val: bool) -> None: ...
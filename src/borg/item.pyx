@@ -291,6 +291,8 @@ cdef class Item(PropDict):
 
     chunks = PropDictProperty(list, 'list')
     chunks_healthy = PropDictProperty(list, 'list')
+    # ranges of zeros not covered by chunks: [(offset, size), ...], see chunks_with_holes()
+    holes = PropDictProperty(list, 'list')
 
     xattrs = PropDictProperty(StableDict)
 
@@ -328,11 +330,39 @@ cdef class Item(PropDict):
                 size = sum(getattr(ChunkListEntry(*chunk), attr) for chunk in chunks if chunk.id in consider_ids)
             else:
                 size = sum(getattr(ChunkListEntry(*chunk), attr) for chunk in chunks)
+                size += sum(hole_size for _, hole_size in self.get('holes', []))
             # if requested, memorize the precomputed (c)size for items that have an own chunks list:
             if memorize:
                 setattr(self, attr, size)
         return size
 
+    def chunks_with_holes(self):
+        """
+        Return the chunk list, with the holes merged in as ChunkListEntry(id=None, size=...) in their place.
+
+        Holes past the end of the chunks are only included as far as they are contiguous (a part item may have
+        holes recorded ahead of the chunks which made it into the checkpoint).
+        """
+        holes = self.get('holes')
+        if not holes:
+            return self.get('chunks', [])
+        chunks = []
+        hole_iter = iter(holes)
+        hole = next(hole_iter, None)
+        offset = 0
+        for chunk in self.get('chunks', []):
+            while hole is not None and hole[0] == offset:
+                chunks.append(ChunkListEntry(None, hole[1]))
+                offset += hole[1]
+                hole = next(hole_iter, None)
+            chunks.append(chunk)
+            offset += chunk.size
+        while hole is not None and hole[0] == offset:
+            chunks.append(ChunkListEntry(None, hole[1]))
+            offset += hole[1]
+            hole = next(hole_iter, None)
+        return chunks
+
     def to_optr(self):
         """
         Return an "object pointer" (optr), an opaque bag of bytes.
@@ -390,6 +420,9 @@ cdef class Item(PropDict):
                 v = fix_str_value(d, k)
             if k in ('chunks', 'chunks_healthy'):
                 v = fix_list_of_chunkentries(v)
+            if k == 'holes':
+                # msgpack gives us a tuple
+                v = list(v)
             if k in ('atime', 'ctime', 'mtime', 'birthtime'):
                 v = fix_timestamp(v)
             if k in ('acl_access', 'acl_default', 'acl_extended', 'acl_nfs4'):
@@ -738,7 +771,8 @@ class ItemDiff:
 
     def _content_equal(self, chunk_iterator1, chunk_iterator2):
         if self._can_compare_chunk_ids:
-            return self._item1.chunks == self._item2.chunks
+            return (self._item1.chunks == self._item2.chunks
+                    and self._item1.get('holes', []) == self._item2.get('holes', []))
         if self._item1.get_size() != self._item2.get_size():
             return False
         return chunks_contents_equal(chunk_iterator1, chunk_iterator2)
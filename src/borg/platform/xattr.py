@@ -1,5 +1,6 @@
 import errno
 import os
+import threading
 
 from ..helpers import Buffer
 
@@ -13,6 +14,20 @@
 
 buffer = Buffer(bytearray, limit=2**24)
 
+# metadata may get looked up on multiple threads (see archive.MetadataPrefetcher), the
+# main thread uses the buffer above, every other thread gets its own one.
+thread_buffers = threading.local()
+
+
+def get_buffer():
+    if threading.current_thread() is threading.main_thread():
+        return buffer
+    try:
+        return thread_buffers.buffer
+    except AttributeError:
+        thread_buffers.buffer = Buffer(bytearray, limit=2**24)
+        return thread_buffers.buffer
+
 
 def split_string0(buf):
     """split a list of zero-terminated strings into python not-zero-terminated bytes"""
@@ -36,7 +51,7 @@ class BufferTooSmallError(Exception):
     """the buffer given to a xattr function was too small for the result."""
 
 
-def _check(rv, path=None, detect_buffer_too_small=False):
+def _check(rv, path=None, detect_buffer_too_small=False, buffer_size=0):
     from . import get_errno
 
     if rv < 0:
@@ -53,7 +68,7 @@ def _check(rv, path=None, detect_buffer_too_small=False):
             if isinstance(path, int):
                 path = "<FD %d>" % path
             raise OSError(e, msg, path)
-    if detect_buffer_too_small and rv >= len(buffer):
+    if detect_buffer_too_small and rv >= buffer_size:
         # freebsd does not error with ERANGE if the buffer is too small,
         # it just fills the buffer, truncates and returns.
         # so, we play safe and just assume that result is truncated if
@@ -64,11 +79,12 @@ def _check(rv, path=None, detect_buffer_too_small=False):
 
 def _listxattr_inner(func, path):
     assert isinstance(path, (bytes, int))
+    buffer = get_buffer()
     size = len(buffer)
     while True:
         buf = buffer.get(size)
         try:
-            n = _check(func(path, buf, size), path, detect_buffer_too_small=True)
+            n = _check(func(path, buf, size), path, detect_buffer_too_small=True, buffer_size=len(buf))
         except BufferTooSmallError:
             size *= 2
         else:
@@ -78,11 +94,12 @@ def _listxattr_inner(func, path):
 def _getxattr_inner(func, path, name):
     assert isinstance(path, (bytes, int))
     assert isinstance(name, bytes)
+    buffer = get_buffer()
     size = len(buffer)
     while True:
         buf = buffer.get(size)
         try:
-            n = _check(func(path, name, buf, size), path, detect_buffer_too_small=True)
+            n = _check(func(path, name, buf, size), path, detect_buffer_too_small=True, buffer_size=len(buf))
         except BufferTooSmallError:
             size *= 2
         else:
@@ -11,6 +11,7 @@
 import sys
 import tempfile
 import textwrap
+import threading
 import time
 import traceback
 from subprocess import Popen, PIPE
@@ -19,7 +20,7 @@
 from .compress import Compressor
 from .constants import *  # NOQA
 from .helpers import Error, IntegrityError
-from .helpers import bin_to_hex
+from .helpers import bin_to_hex, chunkit
 from .helpers import get_base_dir
 from .helpers import get_limited_unpacker
 from .helpers import replace_placeholders
@@ -161,6 +162,8 @@ class RepositoryServer:  # pragma: no cover
         "break_lock",
         "get_free_nonce",
         "commit_nonce_reservation",
+        "get_changes",
+        "add_cache_changes",
         "inject_exception",
     )
 
@@ -1036,6 +1039,14 @@ def commit_nonce_reservation(self, next_unreserved, start_nonce):
     def break_lock(self):
         """actual remoting is done via self.call in the @api decorator"""
 
+    @api(since=parse_version("2.0.0b5"))
+    def get_changes(self, transaction_id=None):
+        """actual remoting is done via self.call in the @api decorator"""
+
+    @api(since=parse_version("2.0.0b5"))
+    def add_cache_changes(self, transaction_id, base, data):
+        """actual remoting is done via self.call in the @api decorator"""
+
     def close(self):
         if self.p:
             self.p.stdin.close()
@@ -1330,3 +1341,37 @@ def transform(id_, data):
         return RepositoryCache(repository, pack, unpack, transform)
     else:
         return RepositoryNoCache(repository, transform)
+
+
+class SharedRepository:
+    """
+    Read objects from *repository* (e.g. a Repository(No)Cache) on several threads.
+
+    Like with cache_if_remote(repository, decrypted_cache=repo_objs), get and get_many return a tuple
+    (csize, plaintext). Only the repository access is serialized (get_many fetches *batch_size* objects
+    at a time), the objects are decrypted on the calling thread.
+    """
+
+    batch_size = 100
+
+    def __init__(self, repository, repo_objs):
+        self.repository = repository
+        self.repo_objs = repo_objs
+        self.lock = threading.Lock()
+
+    def transform(self, id_, data):
+        meta, decrypted = self.repo_objs.parse(id_, data)
+        csize = meta.get("csize", len(data))
+        return csize, decrypted
+
+    def get(self, key):
+        with self.lock:
+            data = self.repository.get(key)
+        return self.transform(key, data)
+
+    def get_many(self, keys):
+        for batch in chunkit(keys, self.batch_size):
+            with self.lock:
+                objects = list(self.repository.get_many(batch))
+            for key, data in zip(batch, objects):
+                yield self.transform(key, data)
@@ -107,6 +107,7 @@ class Repository:
     dir/data/<X // SEGMENTS_PER_DIR>/<X>
     dir/index.X
     dir/hints.X
+    dir/changes.X (the change log of the last CHANGES_KEEP transactions, see get_changes)
 
     File system interaction
     -----------------------
@@ -190,6 +191,9 @@ def __init__(
         # After the "DELETE A" in segment_x the shadow index will contain "A -> [n]".
         # .delete() is updating this index, it is persisted into "hints" file and is later used by .compact_segments().
         self.shadow_index = {}
+        # The changes of the current transaction: the transaction it is based on and the ids of the objects put and
+        # deleted. They are written to the change log by write_index, see get_changes.
+        self.changes = None
         self._active_txn = False
         self.lock_wait = lock_wait
         self.do_lock = lock
@@ -555,7 +559,9 @@ def open_index(self, transaction_id, auto_recover=True):
         try:
             with IntegrityCheckedFile(index_path, write=False, integrity_data=integrity_data) as fd:
                 if variant == 2:
-                    return NSIndex.read(fd)
+                    # without an exclusive lock, we are most likely only reading (e.g. borg serve for borg list
+                    # or extract), the index is copied into memory when it gets changed first.
+                    return NSIndex.read(fd, mapped=not self.exclusive)
                 if variant == 1:  # legacy
                     return NSIndex1.read(fd)
         except (ValueError, OSError, FileIntegrityError) as exc:
@@ -593,6 +599,7 @@ def prepare_txn(self, transaction_id, do_cleanup=True):
                 # the repository instance lives on - even if exceptions happened.
                 self._active_txn = False
                 raise
+        self.changes = dict(previous=transaction_id, put=set(), delete=set())
         if not self.index or transaction_id is None:
             try:
                 self.index = self.open_index(transaction_id, auto_recover=False)
@@ -708,6 +715,22 @@ def rename_tmp(file):
         rename_tmp(index_file)
         sync_dir(self.path)
 
+        # Write the change log of this transaction, if we know the changes (see get_changes)
+        if self.changes is not None:
+            put, delete = self.changes["put"], self.changes["delete"]
+            changes = {
+                "version": 1,
+                "transaction": transaction_id,
+                "previous": self.changes["previous"],
+                "put": sorted(put) if put is not None else None,
+                "delete": sorted(delete) if delete is not None else None,
+                "cache_base": None,
+                "cache": [],
+            }
+            with SaveFile(os.path.join(self.path, "changes.%d" % transaction_id), binary=True) as fd:
+                msgpack.pack(changes, fd)
+            self.changes = None
+
         # Remove old auxiliary files
         current = ".%d" % transaction_id
         for name in os.listdir(self.path):
@@ -716,6 +739,10 @@ def rename_tmp(file):
             if name.endswith(current):
                 continue
             os.unlink(os.path.join(self.path, name))
+        # Remove the change logs of old transactions (and of transactions which did not make it)
+        changes = sorted(int(fn[8:]) for fn in os.listdir(self.path) if fn.startswith("changes.") and fn[8:].isdigit())
+        for tid in changes[:-CHANGES_KEEP] + [tid for tid in changes if tid > transaction_id]:
+            os.unlink(os.path.join(self.path, "changes.%d" % tid))
         self.index = None
 
     def check_free_space(self):
@@ -946,6 +973,8 @@ def replay_segments(self, index_transaction_id, segments_transaction_id):
         remember_exclusive = self.exclusive
         self.exclusive = None
         self.prepare_txn(index_transaction_id, do_cleanup=False)
+        # the replayed changes are not logged, clients need to resync from the archives, see get_changes
+        self.changes = None
         try:
             segment_count = sum(1 for _ in self.io.segment_iterator())
             pi = ProgressIndicatorPercent(
@@ -1068,6 +1097,7 @@ def report_error(msg):
         logger.debug("Segment transaction is    %s", segments_transaction_id)
         logger.debug("Determined transaction is %s", transaction_id)
         self.prepare_txn(None)  # self.index, self.compact, self.segments, self.shadow_index all empty now!
+        self.changes = None  # a repaired transaction is not logged, see get_changes
         segment_count = sum(1 for _ in self.io.segment_iterator())
         logger.debug("Found %d segments", segment_count)
 
@@ -1186,6 +1216,7 @@ def _rollback(self, *, cleanup):
         if cleanup:
             self.io.cleanup(self.io.get_segments_transaction_id())
         self.index = None
+        self.changes = None
         self._active_txn = False
         self.transaction_doomed = None
 
@@ -1320,6 +1351,7 @@ def put(self, id, data, wait=True):
         self.segments.setdefault(segment, 0)
         self.segments[segment] += 1
         self.index[id] = NSIndexEntry(segment, offset, len(data))
+        self._log_change(id, deleted=False)
         if self.storage_quota and self.storage_quota_use > self.storage_quota:
             self.transaction_doomed = self.StorageQuotaExceeded(
                 format_file_size(self.storage_quota), format_file_size(self.storage_quota_use)
@@ -1343,6 +1375,67 @@ def delete(self, id, wait=True):
         # after the delete, the object is not in the repo index any more,
         # for the compaction code, we need to update the shadow_index in this case.
         self._delete(id, in_index.segment, in_index.offset, in_index.size, update_shadow_index=True)
+        self._log_change(id, deleted=True)
+
+    def _log_change(self, id, *, deleted):
+        if self.changes is None or self.changes["put"] is None:
+            return
+        put, delete = self.changes["put"], self.changes["delete"]
+        if deleted:
+            put.discard(id)
+            delete.add(id)
+        else:
+            delete.discard(id)
+            put.add(id)
+        if len(put) + len(delete) > CHANGES_LIMIT:
+            # too many to log, the clients need to resync from the archives
+            self.changes["put"] = self.changes["delete"] = None
+
+    def get_changes(self, transaction_id=None):
+        """Return the change log of transaction *transaction_id* (default: the current one).
+
+        The change log is a dict with the ids of the objects that were put and deleted in the transaction ("put",
+        "delete", both None if there were more than CHANGES_LIMIT changes), the "transaction" it was "previous"ly
+        based on and the "cache" data clients added with add_cache_changes (a list of parts, "cache_base" is the
+        transaction the data is relative to).
+
+        None is returned if the change log is not (or no longer) known, e.g. for a transaction replayed from the
+        segments or for one made by borg check --repair.
+        """
+        if transaction_id is None:
+            transaction_id = self.get_transaction_id()
+            if transaction_id is None:
+                return None
+        try:
+            with open(os.path.join(self.path, "changes.%d" % transaction_id), "rb") as fd:
+                return msgpack.unpack(fd)
+        except FileNotFoundError:
+            return None
+        except (msgpack.UnpackException, ValueError) as exc:
+            logger.warning("Change log of transaction %d is corrupted: %s", transaction_id, exc)
+            return None
+
+    def add_cache_changes(self, transaction_id, base, data):
+        """Add client *data* to the change log of the current transaction *transaction_id*.
+
+        The data is opaque to the repository, borg clients use it to publish how their chunks index changed since
+        transaction *base* (see LocalCache.sync). It can be added in several parts (with the same base).
+
+        Return whether the data was added, it is not if *transaction_id* is not the current transaction (any more),
+        if its change log is unknown or if the repository is not locked exclusively.
+        """
+        if self.do_lock and not self.lock.got_exclusive_lock():
+            return False
+        if transaction_id != self.get_transaction_id():
+            return False
+        changes = self.get_changes(transaction_id)
+        if changes is None or changes["cache_base"] not in (None, base):
+            return False
+        changes["cache_base"] = base
+        changes["cache"].append(data)
+        with SaveFile(os.path.join(self.path, "changes.%d" % transaction_id), binary=True) as fd:
+            msgpack.pack(changes, fd)
+        return True
 
     def _delete(self, id, segment, offset, size, *, update_shadow_index):
         # common code used by put and delete
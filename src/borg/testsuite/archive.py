@@ -10,7 +10,10 @@
 from . import BaseTestCase
 from ..crypto.key import PlaintextKey
 from ..archive import Archive, CacheChunkBuffer, RobustUnpacker, valid_msgpacked_dict, ITEM_KEYS, Statistics
-from ..archive import BackupOSError, backup_io, backup_io_iter, get_item_uid_gid
+from ..archive import BackupOSError, backup_io, backup_io_iter, get_item_uid_gid, BlockHashReader, ChunksProcessor
+from ..cache import ChunkListEntry
+from ..chunker import get_chunker, Chunk
+from ..constants import CH_DATA
 from ..helpers import msgpack
 from ..item import Item, ArchiveItem
 from ..manifest import Manifest
@@ -77,6 +80,22 @@ def test_stats_format(stats):
     assert repr(stats) == f"<Statistics object at {id(stats):#x} (20, 20)>"
 
 
+def test_stats_stages(stats):
+    stats.add_stage("read", 2.0, 1000)
+    stats.add_stage("cbt", 0.5)
+    other = Statistics()
+    other.add_stage("read", 2.0, 3000)
+    total = stats + other
+    assert total.stage_rate("read") == 1000
+    assert total.stage_rate("store") == 0
+    assert total.as_dict()["stages"] == {
+        "read": {"time": 4.0, "size": 4000, "throughput": 1000},
+        "cbt": {"time": 0.5, "size": 0, "throughput": 0},
+    }
+    assert total.stages_lines()[1] == "Time spent in cbt: 0.50 seconds"
+    assert "stages" not in Statistics().as_dict()
+
+
 def test_stats_progress_json(stats):
     stats.output_json = True
 
@@ -101,6 +120,77 @@ def test_stats_progress_json(stats):
     assert "nfiles" not in result
 
 
+def test_block_hash_reader(tmpdir):
+    bs = 16
+    path = str(tmpdir.join("file"))
+
+    def chunkify(data, old_hashes=b"", old_chunks=()):
+        with open(path, "wb") as f:
+            f.write(data)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            reader = BlockHashReader(fd, block_size=bs, old_hashes=old_hashes, old_chunks=old_chunks)
+            chunker = get_chunker("fixed", 24, sparse=False)
+            chunks = [c if isinstance(c, ChunkListEntry) else bytes(c.data) for c in reader.chunkify(chunker)]
+        finally:
+            os.close(fd)
+        return reader, chunks
+
+    data = bytes(range(100))  # 7 blocks, the last one is partial
+    reader, chunks = chunkify(data)
+    assert chunks == [data[0:24], data[24:48], data[48:72], data[72:96], data[96:100]]
+    assert (reader.read_pos, len(reader.hashes), reader.reused) == (100, 7 * 8, 0)
+    hashes = reader.hashes
+    old = [ChunkListEntry(bytes([i]), len(chunk)) for i, chunk in enumerate(chunks)]
+
+    reader, chunks = chunkify(data, hashes, old)
+    assert chunks == old
+    assert (reader.hashes, reader.reused) == (hashes, 100)
+
+    # block 2 changed, which is covered by the old chunk 1
+    changed = data[:40] + b"x" + data[41:]
+    reader, chunks = chunkify(changed, hashes, old)
+    assert chunks == [old[0], changed[24:48], old[2], old[3], old[4]]
+    assert reader.hashes == chunkify(changed)[0].hashes
+
+    # grown, the last block changed
+    grown = data + b"y" * 30
+    reader, chunks = chunkify(grown, hashes, old)
+    assert chunks == old[:4] + [grown[96:120], grown[120:130]]
+
+    # shrunk, the old chunks beyond the end are gone
+    shrunk = data[:50]
+    reader, chunks = chunkify(shrunk, hashes, old)
+    assert chunks == old[:2] + [shrunk[48:50]]
+    assert reader.read_pos == 50
+
+
+def test_packed_chunks():
+    key = Mock(id_hash=lambda data: b"id-" + bytes(data))
+    cache = Mock()
+    cache.seen_chunk.side_effect = lambda id, size: id == b"id-bbb"
+    cache.repo_objs.format.side_effect = lambda id, meta, data: b"c-" + bytes(data)
+    cp = ChunksProcessor(
+        key=key,
+        cache=cache,
+        add_item=None,
+        prepare_checkpoint=None,
+        write_checkpoint=None,
+        checkpoint_interval=0,
+        checkpoint_volume=0,
+        rechunkify=False,
+        workers=3,
+    )
+    old = ChunkListEntry(b"old", 3)
+    chunks = [Chunk(bytearray([c]) * 3, size=3, allocation=CH_DATA) for c in b"abcdefghijklmnopq"]
+    packed = list(cp.packed_chunks(chunks[:2] + [old] + chunks[2:]))
+    # in order, no matter which worker was done first
+    assert packed[2] is old
+    assert [p.id for p in packed if p is not old] == [b"id-" + bytes(c.data) for c in chunks]
+    assert [p.cdata for p in packed[:2]] == [b"c-aaa", None]
+    assert packed[3].size == 3 and packed[3].data == b"ccc"
+
+
 class MockCache:
     class MockRepo:
         def async_response(self, wait=True):
@@ -9,6 +9,7 @@
 from ...cache import Cache, LocalCache
 from ...constants import *  # NOQA
 from ...crypto.key import TAMRequiredError
+from ...hashindex import CacheSynchronizer
 from ...helpers import Location, get_security_dir
 from ...helpers import EXIT_ERROR
 from ...helpers import bin_to_hex
@@ -274,6 +275,52 @@ def test_check_cache(self):
         with pytest.raises(AssertionError):
             self.check_cache()
 
+    def test_check_cache_sync_workers(self):
+        self.cmd(f"--repo={self.repository_location}", "rcreate", RK_ENCRYPTION)
+        for i in range(5):
+            self.create_regular_file(f"file{i}", size=1024 * 80)
+            self.cmd(f"--repo={self.repository_location}", "create", f"test{i}", "input")
+        # rebuilding the chunks cache with archive indexes built and merged on several threads gives the same one
+        with environment_variable(BORG_CACHE_SYNC_WORKERS="3"):
+            self.check_cache()
+
+    def test_check_cache_change_log(self):
+        self.cmd(f"--repo={self.repository_location}", "rcreate", RK_ENCRYPTION)
+        self.create_regular_file("file1", size=1024 * 80)
+        self.cmd(f"--repo={self.repository_location}", "create", "test1", "input")
+        other_cache_path = os.path.join(self.tmpdir, "other_cache")
+        with environment_variable(BORG_CACHE_DIR=other_cache_path):
+            self.cmd(f"--repo={self.repository_location}", "rinfo")
+        self.create_regular_file("file2", size=1024 * 80)
+        self.cmd(f"--repo={self.repository_location}", "create", "test2", "input")
+        self.cmd(f"--repo={self.repository_location}", "delete", "-a", "test1")
+        # another client brings its chunks cache up to date with the change log instead of the archives
+        with environment_variable(BORG_CACHE_DIR=other_cache_path):
+            with patch("borg.cache.CacheSynchronizer", side_effect=AssertionError("archive index built")):
+                self.cmd(f"--repo={self.repository_location}", "rinfo")
+            self.check_cache()
+
+    def test_check_cache_change_log_no_cache_sync(self):
+        self.cmd(f"--repo={self.repository_location}", "rcreate", RK_ENCRYPTION)
+        self.create_regular_file("file1", size=1024 * 80)
+        self.cmd(f"--repo={self.repository_location}", "create", "test1", "input")
+        other_cache_path = os.path.join(self.tmpdir, "other_cache")
+        with environment_variable(BORG_CACHE_DIR=other_cache_path):
+            self.cmd(f"--repo={self.repository_location}", "rinfo")
+        # a client without a chunks cache only gets the ids put into the change log, not how the chunks index changed
+        self.create_regular_file("file2", size=1024 * 80)
+        with environment_variable(BORG_CACHE_DIR=os.path.join(self.tmpdir, "no_cache")):
+            output = self.cmd(
+                f"--repo={self.repository_location}", "--debug", "create", "--no-cache-sync", "test2", "input"
+            )
+        assert "choosing ad-hoc cache" in output
+        # the other client doesn't know the new chunks, so it has to rebuild its chunks cache from the archives
+        with environment_variable(BORG_CACHE_DIR=other_cache_path):
+            with patch("borg.cache.CacheSynchronizer", wraps=CacheSynchronizer) as synchronizer:
+                self.cmd(f"--repo={self.repository_location}", "rinfo")
+            assert synchronizer.called
+            self.check_cache()
+
 
 class ManifestAuthenticationTest(ArchiverTestCaseBase):
     def spoof_manifest(self, repository):
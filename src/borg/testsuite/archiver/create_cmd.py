@@ -12,6 +12,7 @@
 
 from ... import platform
 from ...constants import *  # NOQA
+from ...constants import BLOCK_HASH_SIZE, BLOCK_HASH_MIN_SIZE
 from ...manifest import Manifest
 from ...platform import is_cygwin, is_win32
 from ...repository import Repository
@@ -626,6 +627,42 @@ def test_file_status_cs_cache_mode(self):
         )
         self.assert_in("M input/file1", output)
 
+    def test_create_block_hashes(self):
+        size = BLOCK_HASH_MIN_SIZE
+        contents = bytearray(randbytes(size))
+        self.create_regular_file("image", contents=contents)
+        self.cmd(f"--repo={self.repository_location}", "rcreate", RK_ENCRYPTION)
+        args = ("create", "--block-hashes", "--chunker-params=fixed,1048576")
+        output = self.cmd(f"--repo={self.repository_location}", "--debug", *args, "test1", "input")
+        self.assert_in(f"input/image: 0 of {size} bytes unchanged", output)
+        # only the chunk covering the changed block gets chunked again
+        contents[5 * BLOCK_HASH_SIZE + 10] ^= 0xFF
+        self.create_regular_file("image", contents=contents)
+        output = self.cmd(f"--repo={self.repository_location}", "--debug", *args, "test2", "input")
+        self.assert_in(f"input/image: {size - BLOCK_HASH_SIZE} of {size} bytes unchanged", output)
+        with changedir("output"):
+            self.cmd(f"--repo={self.repository_location}", "extract", "test2")
+            with open("input/image", "rb") as fd:
+                assert fd.read() == contents
+
+    def test_create_prefetch(self):
+        self.create_test_files()
+        self.create_regular_file("dir2/excluded", size=10)
+        self.create_regular_file("dir2/file", size=10)
+        self.cmd(f"--repo={self.repository_location}", "rcreate", RK_ENCRYPTION)
+        args = ("create", "--list", "--exclude=input/dir2/excluded")
+        output1 = self.cmd(f"--repo={self.repository_location}", *args, "test1", "input")
+        output2 = self.cmd(f"--repo={self.repository_location}", *args, "--prefetch=3", "test2", "input")
+        # same items in the same order, just the status differs (e.g. unchanged files)
+        assert [line[2:] for line in output1.splitlines()] == [line[2:] for line in output2.splitlines()]
+        assert "- input/dir2/excluded" in output2
+        list_args = ("list", "--format={mode} {user} {size} {path}{NL}")
+        list1 = self.cmd(f"--repo={self.repository_location}", *list_args, "test1")
+        list2 = self.cmd(f"--repo={self.repository_location}", *list_args, "test2")
+        assert list1 == list2
+        # 0 is no extra threads, there is no negative number of them
+        self.cmd(f"--repo={self.repository_location}", *args, "--prefetch=-1", "test3", "input", fork=True, exit_code=2)
+
     def test_file_status_ms_cache_mode(self):
         """test that a chmod'ed file with no content changes does not get chunked again in mtime,size cache_mode"""
         self.create_regular_file("file1", size=10)
@@ -5,11 +5,14 @@
 import hashlib
 import random
 import fcntl
+import json
 import os
 import os.path
 import subprocess
 
-from ...helpers import lvm
+from ...archive import ThinObjectProcessors
+from ...cbt import CbtImage
+from ...helpers import lvm, msgpack
 from .. import changedir
 from . import (
     ArchiverTestCaseBase,
@@ -26,6 +29,14 @@ def ean(n):
     return base64.b64encode(n.encode('utf-8')).decode('utf-8')
 
 block_size = 4096
+
+
+def get_thin_metadata(archive):
+    """The thin metadata (see ThinObjectProcessors.Metadata) stored in *archive*"""
+    for item in archive.iter_items(filter=lambda i: i.path == ThinObjectProcessors.meta_path):
+        return msgpack.unpackb(b''.join(archive.pipeline.fetch_many([c.id for c in item.chunks])))
+
+
 def write_random_data(f, size=2 * 1024 * 1024, keep=False):
     assert size % block_size == 0
 
@@ -199,6 +210,150 @@ def test_content(self):
 
             self.check_backup_sum(thin, 'third', whole_sum3)
 
+    def test_parallel(self):
+        self.cmd(f'--repo={self.repository_location}', 'rcreate', RK_ENCRYPTION)
+
+        with self.make_vg() as vg:
+            pool = self.make_tpool(vg)
+            thins = [self.make_thin(vg, pool, size='16M') for _ in range(3)]
+
+            # 1: back up several LVs from scratch at the same time
+            sums = []
+            for thin in thins:
+                with open(thin['lv_path'], 'r+b') as v:
+                    v.seek(4 * 1024 * 1024)
+                    write_random_data(v)
+
+                    v.seek(0)
+                    sums.append(get_sum(v))
+
+            names = [thin['lv_full_name'] for thin in thins]
+            output = self.cmd(f'--repo={self.repository_location}', 'tcreate', '--parallel-lvs', '2', 'first', *names)
+            assert len(lvm.get_lvs(select=f'tags={{"borgarch-{ean("first")}" && "borgthin-last"}}')) == 3
+
+            # items must be in the order the LVs were given
+            output = self.cmd(f'--repo={self.repository_location}', 'list', '--short', 'first')
+            assert [line for line in output.splitlines() if line in names] == names
+            # and so must their thin metadata
+            archive, repository = self.open_archive('first')
+            with repository:
+                assert list(get_thin_metadata(archive)['lvs']) == [thin['lv_uuid'] for thin in thins]
+
+            for thin, sum_ in zip(thins, sums):
+                self.check_backup_sum(thin, 'first', sum_)
+
+            # 2: incremental backup of several LVs at the same time
+            sums2 = []
+            for thin in thins:
+                with open(thin['lv_path'], 'r+b') as v:
+                    v.seek(4 * 1024 * 1024 + 2048)
+                    v.write(b'blahblahblah')
+
+                    v.seek(0)
+                    sums2.append(get_sum(v))
+
+            output = self.cmd(
+                f'--repo={self.repository_location}', '--debug', 'tcreate', '--parallel-lvs', '3', 'second', *names)
+            assert 'backing up from scratch' not in output
+            assert len(lvm.get_lvs(select=f'tags={{"borgarch-{ean("second")}" && "borgthin-last"}}')) == 3
+            assert not lvm.get_lvs(select=f'tags="borgarch-{ean("first")}"')
+
+            for thin, sum_ in zip(thins, sums2):
+                self.check_backup_sum(thin, 'second', sum_)
+
+    def test_align_chunks(self):
+        self.cmd(f'--repo={self.repository_location}', 'rcreate', RK_ENCRYPTION)
+
+        with self.make_vg() as vg:
+            pool = self.make_tpool(vg)
+            thin = self.make_thin(vg, pool)
+            lv_qual = thin['lv_full_name']
+
+            def check_aligned(arch):
+                archive, repository = self.open_archive(arch)
+                with repository:
+                    for item in archive.iter_items(filter=lambda i: i.path == lv_qual):
+                        assert all(c.size % self.chunk_size == 0 for c in item.chunks)
+                        break
+                    else:
+                        self.fail(f'{lv_qual} not found in {arch}')
+
+            # 1: initial backup, all chunks end on pool chunks
+            with open(thin['lv_path'], 'r+b') as v:
+                v.seek(8 * 1024 * 1024)
+                write_random_data(v, size=16 * 1024 * 1024)
+                v.seek(0)
+                sum1 = get_sum(v)
+
+            self.cmd(f'--repo={self.repository_location}', 'tcreate', '--align-chunks', 'first', lv_qual)
+            check_aligned('first')
+            self.check_backup_sum(thin, 'first', sum1)
+
+            # 2: small changes in the middle of chunks, the rest of which is read from the snapshot again
+            with open(thin['lv_path'], 'r+b') as v:
+                for offset in (8 * 1024 * 1024 + 1000, 13 * 1024 * 1024 + 70000, 20 * 1024 * 1024 + 3):
+                    v.seek(offset)
+                    v.write(b'blahblahblah')
+                v.seek(0)
+                sum2 = get_sum(v)
+
+            output = self.cmd(
+                f'--repo={self.repository_location}', '--debug', 'tcreate', '--align-chunks', 'second', lv_qual)
+            assert 'backing up from scratch' not in output
+            check_aligned('second')
+            self.check_backup_sum(thin, 'second', sum2)
+
+    def test_textract(self):
+        self.cmd(f'--repo={self.repository_location}', 'rcreate', RK_ENCRYPTION)
+
+        with self.make_vg() as vg:
+            pool = self.make_tpool(vg)
+            thin = self.make_thin(vg, pool, size='32M')
+            target = self.make_thin(vg, pool, size='32M')
+
+            with open(thin['lv_path'], 'r+b') as v:
+                v.seek(4 * 1024 * 1024)
+                write_random_data(v)
+                v.seek(0)
+                sum1 = get_sum(v)
+            self.cmd(f'--repo={self.repository_location}', 'tcreate', 'first', thin['lv_full_name'])
+
+            with open(thin['lv_path'], 'r+b') as v:
+                v.seek(4 * 1024 * 1024 + 2048)
+                v.write(b'blahblahblah')
+                discard_chunk(v.fileno(), 5 * 1024 * 1024, self.chunk_size)
+                v.seek(20 * 1024 * 1024)
+                write_random_data(v, size=self.chunk_size)
+                v.seek(0)
+                sum2 = get_sum(v)
+            self.cmd(f'--repo={self.repository_location}', 'tcreate', 'second', thin['lv_full_name'])
+
+            def check_sum(lv, sum_):
+                with open(lv['lv_path'], 'rb') as f:
+                    assert get_sum(f) == sum_
+
+            # 1: full restore onto another LV
+            output = self.cmd(
+                f'--repo={self.repository_location}', 'textract', '--stats',
+                '--to-device', target['lv_path'], 'second', thin['lv_full_name'])
+            assert 'Written:' in output
+            check_sum(target, sum2)
+
+            # 2: roll it back, only writing what changed
+            output = self.cmd(
+                f'--repo={self.repository_location}', 'textract', '--json', '--reference', 'second',
+                '--to-device', target['lv_path'], 'first', thin['lv_full_name'])
+            stats = json.loads(output)['restore']
+            assert 0 < stats['written_size'] <= 2 * 1024 * 1024
+            assert stats['discarded_size'] == self.chunk_size
+            check_sum(target, sum1)
+
+            # 3: restore the LV itself
+            self.cmd(
+                f'--repo={self.repository_location}', 'textract', '--reference', 'second', 'first',
+                thin['lv_full_name'])
+            check_sum(thin, sum1)
+
     def test_resize(self):
         self.cmd(f'--repo={self.repository_location}', 'rcreate', RK_ENCRYPTION)
 
@@ -258,3 +413,204 @@ def hook(f):
             assert 'backing up from scratch' not in output
 
             self.check_backup_sum(thin, 'third', whole_sum3, hook=check_size(28 * 1024 * 1024))
+
+
+class FileCbtTestCase(ArchiverTestCaseBase):
+    def test_file_cbt(self):
+        self.cmd(f'--repo={self.repository_location}', 'rcreate', RK_ENCRYPTION)
+        image_path = os.path.join(self.input_path, 'disk.img')
+        item_path = image_path.lstrip('/')
+
+        def check_backup(arch, expected):
+            with changedir(self.output_path):
+                self.cmd(f'--repo={self.repository_location}', 'extract', '--sparse', arch)
+                with open(item_path, 'rb') as f:
+                    assert f.read() == expected
+                os.unlink(item_path)
+
+        # 1: the image is tracked from the first backup on
+        with CbtImage(image_path, block_size=block_size, create_size=32 * 1024 * 1024) as image:
+            image.write(4 * 1024 * 1024, os.urandom(2 * 1024 * 1024))
+        with open(image_path, 'rb') as f:
+            data1 = f.read()
+
+        output = self.cmd(
+            f'--repo={self.repository_location}', '--debug', 'tcreate', '--cbt', 'file', 'first', image_path)
+        assert 'backing up from scratch' in output
+        check_backup('first', data1)
+
+        # 2: incremental backup of the tracked changes
+        with CbtImage(image_path) as image:
+            image.write(4 * 1024 * 1024 + 2048, b'blahblahblah')
+            image.discard(5 * 1024 * 1024, 4 * block_size)
+            image.write(20 * 1024 * 1024, os.urandom(block_size))
+        with open(image_path, 'rb') as f:
+            data2 = f.read()
+
+        output = self.cmd(
+            f'--repo={self.repository_location}', '--debug', 'tcreate', '--cbt', 'file', 'second', image_path)
+        assert 'backing up from scratch' not in output
+        check_backup('second', data2)
+
+        # 3: roll back to the first backup
+        self.cmd(f'--repo={self.repository_location}', 'textract', '--reference', 'second', 'first', image_path)
+        with open(image_path, 'rb') as f:
+            assert f.read() == data1
+
+    def test_parallel_lvs(self):
+        self.cmd(f'--repo={self.repository_location}', 'rcreate', RK_ENCRYPTION)
+        # the first image takes the longest, so it is done last
+        image_paths = []
+        for i, size in enumerate((16, 1, 1)):
+            image_path = os.path.join(self.input_path, f'disk{i}.img')
+            with CbtImage(image_path, block_size=block_size, create_size=32 * 1024 * 1024) as image:
+                image.write(0, os.urandom(size * 1024 * 1024))
+            image_paths.append(image_path)
+
+        self.cmd(
+            f'--repo={self.repository_location}', 'tcreate', '--cbt', 'file', '--parallel-lvs', '3', 'first',
+            *image_paths)
+
+        # items and thin metadata are in the order the images were given, whichever was done first
+        item_paths = [image_path.lstrip('/') for image_path in image_paths]
+        output = self.cmd(f'--repo={self.repository_location}', 'list', '--short', 'first')
+        assert [line for line in output.splitlines() if line in item_paths] == item_paths
+        uuids = []
+        for image_path in image_paths:
+            with CbtImage(image_path) as image:
+                uuids.append(image.uuid)
+        archive, repository = self.open_archive('first')
+        with repository:
+            assert list(get_thin_metadata(archive)['lvs']) == uuids
+
+    def test_stats_stages(self):
+        self.cmd(f'--repo={self.repository_location}', 'rcreate', RK_ENCRYPTION)
+        image_path = os.path.join(self.input_path, 'disk.img')
+        data = os.urandom(1024 * 1024)
+
+        def create(name):
+            output = self.cmd(
+                f'--repo={self.repository_location}', 'tcreate', '--cbt', 'file', '--chunker-params', 'fixed,65536',
+                '--json', name, image_path)
+            [volume] = json.loads(output)['volumes']
+            return volume['stages']
+
+        # the first backup is from scratch (with warnings in the output), of an empty image
+        CbtImage(image_path, block_size=block_size, create_size=32 * 1024 * 1024).close()
+        self.cmd(f'--repo={self.repository_location}', 'tcreate', '--cbt', 'file', 'empty', image_path)
+
+        with CbtImage(image_path) as image:
+            image.write(0, data)
+        stages = create('first')
+        assert stages['pack']['size'] == stages['store']['size'] == len(data)
+        # the repository is local, the chunks are written as they are put
+        assert stages['put']['size'] > 0
+
+        # the same data again: only known chunks, which are neither packed nor put
+        with CbtImage(image_path) as image:
+            image.write(8 * 1024 * 1024, data)
+        stages = create('second')
+        # the old chunks and the ones of the new data
+        assert stages['store']['size'] == 2 * len(data)
+        assert 'pack' not in stages and 'put' not in stages
+
+    def test_estimate(self):
+        self.cmd(f'--repo={self.repository_location}', 'rcreate', RK_ENCRYPTION)
+        image_path = os.path.join(self.input_path, 'disk.img')
+        state_dir = image_path + '.cbt'
+
+        with CbtImage(image_path, block_size=block_size, create_size=32 * 1024 * 1024) as image:
+            image.write(4 * 1024 * 1024, os.urandom(2 * 1024 * 1024))
+        # fixed chunks (not on blocks), so the old chunk around the first change always needs to be fetched
+        self.cmd(
+            f'--repo={self.repository_location}', 'tcreate', '--cbt', 'file', '--chunker-params', 'fixed,200000',
+            'first', image_path)
+
+        with CbtImage(image_path) as image:
+            image.write(4 * 1024 * 1024 + 2048, b'blahblahblah')
+            image.write(20 * 1024 * 1024, os.urandom(block_size))
+
+        output = self.cmd(
+            f'--repo={self.repository_location}', 'tcreate', '--cbt', 'file', '--estimate', '--json', 'second',
+            image_path)
+        [estimate] = json.loads(output)['volumes']
+        assert estimate['size'] == 32 * 1024 * 1024
+        assert estimate['new_size'] == 2 * block_size
+        assert estimate['old_size'] == 2 * 1024 * 1024 - block_size
+        assert estimate['hole_size'] == estimate['size'] - estimate['new_size'] - estimate['old_size']
+        assert estimate['refetch_chunks'] == 1
+        assert estimate['refetch_size'] == 200000
+
+        # nothing was stored, and the last snapshot is still there
+        assert 'second' not in self.cmd(f'--repo={self.repository_location}', 'rlist')
+        assert len([name for name in os.listdir(state_dir) if name.endswith('.img')]) == 1
+        output = self.cmd(
+            f'--repo={self.repository_location}', '--debug', 'tcreate', '--cbt', 'file', 'second', image_path)
+        assert 'backing up from scratch' not in output
+
+    def test_estimate_not_aligned(self):
+        self.cmd(f'--repo={self.repository_location}', 'rcreate', RK_ENCRYPTION)
+        image_path = os.path.join(self.input_path, 'disk.img')
+
+        def change_and_estimate(offset):
+            with CbtImage(image_path) as image:
+                image.write(offset, b'blahblahblah')
+                image.write(20 * 1024 * 1024, os.urandom(block_size))
+            output = self.cmd(
+                f'--repo={self.repository_location}', 'tcreate', '--cbt', 'file', '--estimate', '--json', 'next',
+                image_path)
+            [estimate] = json.loads(output)['volumes']
+            return estimate
+
+        # all chunks are on blocks, but the archive wasn't made with --align-chunks
+        with CbtImage(image_path, block_size=block_size, create_size=32 * 1024 * 1024) as image:
+            image.write(4 * 1024 * 1024, os.urandom(2 * 1024 * 1024))
+        self.cmd(
+            f'--repo={self.repository_location}', 'tcreate', '--cbt', 'file', '--chunker-params', 'fixed,262144',
+            'first', image_path)
+        estimate = change_and_estimate(4 * 1024 * 1024 + 2048)
+        assert estimate['new_size'] == 2 * block_size
+        assert estimate['refetch_chunks'] == 1
+        assert estimate['refetch_size'] == 262144
+
+        # with --align-chunks, the rest of a changed chunk is re-read instead
+        self.cmd(
+            f'--repo={self.repository_location}', 'tcreate', '--cbt', 'file', '--chunker-params', 'fixed,262144',
+            '--align-chunks', 'second', image_path)
+        estimate = change_and_estimate(4 * 1024 * 1024 + 2 * 262144 + 2048)
+        assert estimate['new_size'] == 262144 + block_size
+        assert estimate['refetch_chunks'] == 0
+
+    def test_tdiff(self):
+        self.cmd(f'--repo={self.repository_location}', 'rcreate', RK_ENCRYPTION)
+        image_path = os.path.join(self.input_path, 'disk.img')
+
+        with CbtImage(image_path, block_size=block_size, create_size=32 * 1024 * 1024) as image:
+            image.write(4 * 1024 * 1024, os.urandom(2 * 1024 * 1024))
+        # fixed chunks, so the chunk around the first change is never as big as all of the data
+        chunker_params = ('--chunker-params', 'fixed,200000')
+        self.cmd(
+            f'--repo={self.repository_location}', 'tcreate', '--cbt', 'file', *chunker_params, 'first', image_path)
+        with CbtImage(image_path) as image:
+            image.write(4 * 1024 * 1024 + 2048, b'blahblahblah')
+            image.write(20 * 1024 * 1024, os.urandom(block_size))
+        self.cmd(
+            f'--repo={self.repository_location}', 'tcreate', '--cbt', 'file', *chunker_params, 'second', image_path)
+
+        def ranges(*args):
+            output = self.cmd(
+                f'--repo={self.repository_location}', 'tdiff', '--json-lines', *args, 'first', 'second', image_path)
+            return [json.loads(line) for line in output.splitlines() if line.startswith('{')]
+
+        def check(changed):
+            for offset in (4 * 1024 * 1024 + 2048, 20 * 1024 * 1024):
+                assert any(r['offset'] <= offset < r['offset'] + r['size'] for r in changed)
+            assert sum(r['size'] for r in changed) < 2 * 1024 * 1024
+
+        # by chunks, the changes are somewhere within the listed ranges
+        check(ranges())
+        # comparing the content where chunks don't line up leaves nothing unknown
+        changed = ranges('--content')
+        check(changed)
+        assert {r['status'] for r in changed} == {'changed'}
+        assert {'offset': 20 * 1024 * 1024, 'size': block_size, 'status': 'changed'} in changed
@@ -211,6 +211,7 @@ def test_files_cache(self, cache):
         assert cache.file_known_and_unchanged(b"foo", bytes(32), None) == (False, None)
         assert cache.cache_mode == "d"
         assert cache.files is None
+        assert cache.known_block_hashes(b"foo", bytes(32)) is None
 
     def test_txn(self, cache):
         assert not cache._txn_active
@@ -0,0 +1,189 @@
+import os
+from contextlib import contextmanager
+from unittest.mock import patch
+
+import pytest
+
+from ..cbt import CbtImage, FileCbt, LvmCbt, CbtError, Volume, Snapshot
+from ..helpers import lvm
+
+bs = 4096
+
+
+def deltas(provider, volume, last, snap):
+    with provider.delta(volume, last, snap) as delta:
+        return [(d.type, d.begin, d.length) for d in delta]
+
+
+def test_image_tracking(tmpdir):
+    path = str(tmpdir.join('disk.img'))
+    with open(path, 'wb') as f:
+        f.seek(2 * bs)
+        f.write(b'x' * bs)
+        f.truncate(8 * bs)
+
+    with CbtImage(path, block_size=bs) as image:
+        # existing data is in the first generation
+        assert list(image.map) == [0, 0, 1, 0, 0, 0, 0, 0]
+        image.write(5 * bs + 10, b'y' * bs)
+        assert list(image.map) == [0, 0, 1, 0, 0, 1, 1, 0]
+        image.discard(2 * bs - 1, bs + 2)
+        assert list(image.map) == [0, 0, 0, 0, 0, 1, 1, 0]
+        image.snapshot('s1')
+        # grows in whole blocks
+        image.write(9 * bs, b'z')
+        assert list(image.map) == [0, 0, 0, 0, 0, 1, 1, 0, 0, 2]
+        assert os.path.getsize(path) == 10 * bs
+
+    with CbtImage(path) as image:
+        assert image.block_size == bs
+        assert list(image.map) == [0, 0, 0, 0, 0, 1, 1, 0, 0, 2]
+        with pytest.raises(CbtError):
+            CbtImage(path)
+
+    with open(os.path.join(path + '.cbt', 'snap-s1.img'), 'rb') as f:
+        snap = f.read()
+    assert snap == bytes(5 * bs + 10) + b'y' * bs + bytes(2 * bs - 10)
+
+
+def test_image_size(tmpdir):
+    path = str(tmpdir.join('disk.img'))
+    with open(path, 'wb') as f:
+        f.truncate(bs + 1)
+    with pytest.raises(CbtError):
+        CbtImage(path, block_size=bs)
+
+
+def test_file_cbt(tmpdir):
+    path = str(tmpdir.join('disk.img'))
+    with CbtImage(path, block_size=bs, create_size=8 * bs) as image:
+        image.write(0, b'a' * 3 * bs)
+
+    cbt = FileCbt()
+    volume = cbt.get_volume(path)
+    assert volume.block_size == bs
+    assert cbt.last_snapshot(volume, repo_id='r') is None
+
+    snap1 = cbt.create_snapshot(volume, repo_id='r', archive_name='first')
+    assert snap1.size == 8 * bs
+    assert deltas(cbt, volume, None, snap1) == [(lvm.Delta.Type.RIGHT_ONLY, 0, 3)]
+    cbt.commit_snapshot(snap1)
+    last = cbt.last_snapshot(volume, repo_id='r')
+    assert (last.uuid, last.archive_name) == (snap1.uuid, 'first')
+    assert cbt.last_snapshot(volume, repo_id='other') is None
+
+    with CbtImage(path) as image:
+        image.write(bs, b'b' * bs)
+        image.discard(2 * bs, bs)
+        image.write(6 * bs, b'c' * bs)
+
+    snap2 = cbt.create_snapshot(volume, repo_id='r', archive_name='second')
+    assert deltas(cbt, volume, last, snap2) == [
+        (lvm.Delta.Type.SAME, 0, 1),
+        (lvm.Delta.Type.DIFFERENT, 1, 1),
+        (lvm.Delta.Type.LEFT_ONLY, 2, 1),
+        (lvm.Delta.Type.RIGHT_ONLY, 6, 1),
+    ]
+    fd = cbt.open_snapshot(snap2)
+    try:
+        assert os.pread(fd, 3 * bs, 0) == b'a' * bs + b'b' * bs + bytes(bs)
+    finally:
+        os.close(fd)
+
+    cbt.commit_snapshot(snap2)
+    with pytest.raises(CbtError):
+        cbt.last_snapshot(volume, repo_id='r')
+    cbt.release_snapshot(last)
+    assert cbt.last_snapshot(volume, repo_id='r').uuid == snap2.uuid
+    assert not os.path.exists(last.path)
+
+
+def test_file_cbt_partial(tmpdir):
+    path = str(tmpdir.join('disk.img'))
+    with CbtImage(path, block_size=bs, create_size=8 * bs) as image:
+        image.write(0, b'a' * bs)
+
+    cbt = FileCbt()
+    volume = cbt.get_volume(path)
+    snap = cbt.create_snapshot(volume, repo_id='r', archive_name='first')
+    assert cbt.partial_snapshot(volume, repo_id='r') is None
+    cbt.mark_partial(snap, archive_name='first')
+    partial = cbt.partial_snapshot(volume, repo_id='r')
+    assert (partial.uuid, partial.archive_name) == (snap.uuid, 'first')
+    assert cbt.partial_snapshot(volume, repo_id='other') is None
+    assert cbt.last_snapshot(volume, repo_id='r') is None
+
+    # resumed by a backup to another archive
+    cbt.commit_snapshot(partial, archive_name='second')
+    assert cbt.partial_snapshot(volume, repo_id='r') is None
+    last = cbt.last_snapshot(volume, repo_id='r')
+    assert (last.uuid, last.archive_name) == (snap.uuid, 'second')
+
+
+def test_lvm_partial():
+    lvs = lvm.LvmInventory()
+    info = {'lv_full_name': 'vg/lv_1', 'lv_uuid': 'u', 'lv_path': '/dev/vg/lv_1', 'lv_size': '0B',
+            'lv_tags': 'borgthin,borgrepo-r,' + LvmCbt._archive_tag('first')}
+    with patch.object(lvs, 'change') as change:
+        cbt = LvmCbt()
+        cbt.lvs = lvs
+        snap = cbt._snapshot(info, 'first')
+        cbt.mark_partial(snap, archive_name='first')
+        change.assert_called_with('u', '--addtag', 'borgthin-partial')
+
+        snap = cbt._snapshot(dict(info, lv_tags=info['lv_tags'] + ',borgthin-partial'), 'first')
+        cbt.commit_snapshot(snap, archive_name='second')
+        change.assert_called_with(
+            'u', '--addtag', 'borgthin-last', '--addtag', LvmCbt._archive_tag('second'),
+            '--deltag', LvmCbt._archive_tag('first'), '--deltag', 'borgthin-partial')
+
+
+def test_lvm_deltas():
+    calls = []
+
+    @contextmanager
+    def meta_snapshot(path):
+        calls.append(('reserve', path))
+        yield
+        calls.append(('release', path))
+
+    def thin_dump(meta_path, thin_id):
+        calls.append(('dump', meta_path, thin_id))
+        return iter(())
+
+    def thin_delta(meta_path, thin1, thin2):
+        calls.append(('delta', meta_path, thin1, thin2))
+        return iter(())
+
+    def volume(name, pool):
+        pool_info = {'lv_uuid': pool, 'lv_dm_path': f'/dev/mapper/{pool}'}
+        meta_info = {'lv_dm_path': f'/dev/mapper/{pool}_tmeta'}
+        return Volume(name=name, uuid=name, block_size=bs, data=({}, pool_info, meta_info))
+
+    def snap(thin_id):
+        return Snapshot(
+            name=str(thin_id), uuid=str(thin_id), path=None, size=0, archive_name=None, data={'thin_id': thin_id})
+
+    requests = [
+        (volume('vg/a', 'p1'), snap(1), snap(2)),
+        (volume('vg/b', 'p2'), None, snap(3)),
+        (volume('vg/c', 'p1'), None, snap(4)),
+    ]
+    with patch.multiple(lvm, meta_snapshot=meta_snapshot, thin_dump=thin_dump, thin_delta=thin_delta):
+        cbt = LvmCbt()
+        with cbt.deltas() as get_delta:
+            for request in requests:
+                with get_delta(*request) as delta:
+                    assert list(delta) == []
+            calls.append('done')
+    # one metadata snapshot per pool, held until all deltas are done
+    assert calls == [
+        ('reserve', '/dev/mapper/p1-tpool'),
+        ('delta', '/dev/mapper/p1_tmeta', 1, 2),
+        ('reserve', '/dev/mapper/p2-tpool'),
+        ('dump', '/dev/mapper/p2_tmeta', 3),
+        ('dump', '/dev/mapper/p1_tmeta', 4),
+        'done',
+        ('release', '/dev/mapper/p2-tpool'),
+        ('release', '/dev/mapper/p1-tpool'),
+    ]
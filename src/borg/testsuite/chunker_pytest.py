@@ -5,7 +5,7 @@
 import pytest
 
 from .chunker import cf
-from ..chunker import ChunkerFixed, sparsemap, has_seek_hole, ChunkerFailing
+from ..chunker import ChunkerFixed, ChunkerAligned, Chunker, sparsemap, has_seek_hole, ChunkerFailing
 from ..constants import *  # NOQA
 
 BS = 4096  # fs block size
@@ -151,3 +151,23 @@ def test_chunker_failing():
         assert c1.data == data[:SIZE]
         assert c2.data == data[SIZE : 2 * SIZE]
         assert c3.data == data[2 * SIZE :]
+
+
+@pytest.mark.parametrize("align", [512, 4096, 65536])
+def test_chunker_aligned(align):
+    data = os.urandom(300000) + bytes(200000) + os.urandom(100000)
+    chunker = ChunkerAligned(Chunker(0, 10, 16, 12, 4095), align)
+    with BytesIO(data) as fd:
+        parts = cf(chunker.chunkify(fd))
+    sizes = [p if isinstance(p, int) else len(p) for p in parts]
+    assert sum(sizes) == len(data)
+    # all cutting places are on the grid, only the end of the data is not
+    assert all(size % align == 0 for size in sizes[:-1])
+    assert b"".join(bytes(p) if isinstance(p, int) else p for p in parts) == data
+
+
+def test_chunker_aligned_passthrough():
+    data = os.urandom(5 * 4096 + 100)
+    with BytesIO(data) as fd:
+        parts = cf(ChunkerAligned(ChunkerFixed(4096), 1024).chunkify(fd))
+    assert parts == [data[i : i + 4096] for i in range(0, len(data), 4096)]
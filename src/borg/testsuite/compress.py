@@ -1,5 +1,6 @@
 import os
 import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import lzma
@@ -56,6 +57,20 @@ def test_lz4_buffer_allocation(monkeypatch):
     assert data == c.decompress(meta, cdata)[1]
 
 
+@pytest.mark.parametrize("name", ["lz4", "zstd"])
+def test_threads(name):
+    # the compressors do not hold the GIL while working, every thread must use its own buffer
+    c = get_compressor(name=name)
+    datas = [os.urandom(1000) + bytes(100000 + i) for i in range(32)]
+
+    def roundtrip(data):
+        meta, cdata = c.compress({}, data)
+        return c.decompress(meta, cdata)[1]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert list(executor.map(roundtrip, datas)) == datas
+
+
 def test_zlib():
     c = get_compressor(name="zlib")
     meta, cdata = c.compress({}, data)
@@ -0,0 +1,274 @@
+import os
+
+import pytest
+
+from .hashindex import H
+from ..crypto.file_integrity import IntegrityCheckedFile, FileIntegrityError
+from ..filescache import FileCacheEntry, FilesCache
+from ..helpers import msgpack
+from ..helpers.msgpack import int_to_timestamp
+
+
+def entry(n, age=0, chunks=2):
+    chunk_ids = [H(n * 100 + i) for i in range(chunks)]
+    return FileCacheEntry(age=age, inode=n, size=n * 1000, cmtime=n * 10**9, chunk_ids=chunk_ids)
+
+
+def write(files, path, keep=None):
+    # like LocalCache.commit, path may still be mapped
+    with IntegrityCheckedFile(path=path + ".tmp", write=True, filename=os.path.basename(path)) as fd:
+        count = files.write(fd, tmp_dir=os.path.dirname(path), keep=keep)
+    os.replace(path + ".tmp", path)
+    return count, fd.integrity_data
+
+
+def test_empty(tmpdir):
+    path = str(tmpdir.join("files"))
+    open(path, "wb").close()
+    files = FilesCache.read(path)
+    assert len(files) == 0
+    assert files.get(H(1)) is None
+    count, integrity_data = write(files, path)
+    assert count == 0
+    files = FilesCache.read(path, integrity_data)
+    assert len(files) == 0
+    assert list(files.items()) == []
+    files.close()
+
+
+def test_roundtrip(tmpdir):
+    path = str(tmpdir.join("files"))
+    files = FilesCache()
+    for n in range(1, 2001):
+        files[H(n)] = entry(n, chunks=n % 4)
+    assert len(files) == 2000
+    count, integrity_data = write(files, path)
+    assert count == 2000
+
+    files = FilesCache.read(path, integrity_data)
+    assert files.index is not None and not files.changed
+    assert len(files) == 2000
+    # entries of the last backup get one older
+    for n in range(1, 2001):
+        assert files.get(H(n)) == entry(n, age=1, chunks=n % 4)
+    assert files.get(H(2001)) is None
+    assert sorted(files.items()) == sorted((H(n), entry(n, age=1, chunks=n % 4)) for n in range(1, 2001))
+    files.close()
+
+
+def test_changes(tmpdir):
+    path = str(tmpdir.join("files"))
+    files = FilesCache()
+    for n in range(1, 11):
+        files[H(n)] = entry(n)
+    count, integrity_data = write(files, path)
+
+    files = FilesCache.read(path, integrity_data)
+    files.touch(H(1), 1)  # seen again
+    files.touch(H(2), 222)  # seen again, with another inode number
+    files[H(3)] = entry(33)  # changed
+    files[H(11)] = entry(11)  # added
+    assert len(files) == 11
+    assert files.get(H(1)) == entry(1)
+    assert files.get(H(2)) == entry(2)._replace(inode=222)
+    assert files.get(H(3)) == entry(33)
+    assert files.get(H(4)) == entry(4, age=1)
+    assert files.get(H(11)) == entry(11)
+
+    # drop everything not seen in this backup
+    count, integrity_data = write(files, path, keep=lambda entry: entry.age == 0)
+    files.close()
+    assert count == 4
+    files = FilesCache.read(path, integrity_data)
+    assert sorted(files.items()) == sorted(
+        [
+            (H(1), entry(1, age=1)),
+            (H(2), entry(2, age=1)._replace(inode=222)),
+            (H(3), entry(33, age=1)),
+            (H(11), entry(11, age=1)),
+        ]
+    )
+    files.close()
+
+
+def test_corrupted(tmpdir):
+    path = str(tmpdir.join("files"))
+    files = FilesCache()
+    files[H(1)] = entry(1)
+    count, integrity_data = write(files, path)
+    with open(path, "r+b") as fd:
+        fd.seek(100)
+        fd.write(b"X")
+    with pytest.raises(FileIntegrityError):
+        FilesCache.read(path, integrity_data)
+
+
+def test_legacy(tmpdir):
+    path = str(tmpdir.join("files"))
+    with IntegrityCheckedFile(path=path, write=True) as fd:
+        for n in range(1, 4):
+            e = entry(n)
+            msgpack.pack((H(n), e._replace(cmtime=int_to_timestamp(e.cmtime))), fd)
+    files = FilesCache.read(path, fd.integrity_data)
+    assert len(files) == 3
+    assert files.get(H(2)) == entry(2, age=1)
+
+
+class Cache:
+    """the files cache part of LocalCache"""
+
+    def __init__(self, path, ttl=20):
+        self.path = str(path.join("files"))
+        self.journal_path = str(path.join("filesjournal"))
+        self.ttl = ttl
+        self.integrity = {}
+        open(self.path, "wb").close()
+
+    def open(self):
+        return FilesCache.read(
+            self.path,
+            self.integrity.get("files"),
+            journal_path=self.journal_path,
+            journal_integrity_data=self.integrity.get("filesjournal"),
+            ttl=self.ttl,
+        )
+
+    def commit(self, files, newest_cmtime=2**63 - 1):
+        def keep(entry):
+            return entry.age == 0 and entry.cmtime < newest_cmtime or 0 < entry.age < self.ttl
+
+        self.integrity.update(files.commit(keep))
+
+
+def test_journal(tmpdir):
+    cache = Cache(tmpdir)
+    files = cache.open()
+    for n in range(1, 101):
+        files[H(n)] = entry(n)
+    cache.commit(files)
+    files.close()
+    assert files.journal_size == 0 and cache.integrity["filesjournal"] == "0"
+    base = os.stat(cache.path)
+
+    files = cache.open()
+    for n in range(1, 51):
+        files.touch(H(n), n)
+    files.touch(H(51), 5151)
+    files[H(52)] = entry(5252)
+    files[H(101)] = entry(101)
+    cache.commit(files)
+    # the base file was not touched
+    assert (os.stat(cache.path).st_ino, os.stat(cache.path).st_mtime_ns) == (base.st_ino, base.st_mtime_ns)
+    assert int(cache.integrity["filesjournal"]) == os.path.getsize(cache.journal_path) > 0
+    files.close()
+
+    files = cache.open()
+    assert len(files) == 101
+    assert len(files.generations) == 1 and len(files.journal) == 3
+    for n in range(1, 51):
+        assert files.get(H(n)) == entry(n, age=1)
+    assert files.get(H(51)) == entry(51, age=1)._replace(inode=5151)
+    assert files.get(H(52)) == entry(5252, age=1)
+    for n in range(53, 101):
+        assert files.get(H(n)) == entry(n, age=2)
+    assert files.get(H(101)) == entry(101, age=1)
+    assert len(list(files.items())) == 101
+    files.close()
+
+
+def test_journal_checkpoints(tmpdir):
+    cache = Cache(tmpdir)
+    files = cache.open()
+    files[H(1)] = entry(1)
+    cache.commit(files)
+    files.close()
+    files = cache.open()
+    files[H(2)] = entry(2)
+    cache.commit(files)
+    files[H(3)] = entry(3)
+    cache.commit(files)
+    files.close()
+    # the second commit replaced the journal record of the first one
+    files = cache.open()
+    assert len(files.generations) == 1
+    assert [files.get(H(n)).age for n in (1, 2, 3)] == [2, 1, 1]
+    files.close()
+
+
+def test_journal_snapshot(tmpdir):
+    cache = Cache(tmpdir)
+    files = cache.open()
+    files[H(1)] = entry(1)
+    cache.commit(files)
+    files.close()
+    files = cache.open()
+    files[H(2)] = entry(2)
+    cache.commit(files)
+    # like LocalCache.begin_txn after a checkpoint
+    snapshot = str(tmpdir.join("snapshot"))
+    os.link(cache.journal_path, snapshot)
+    integrity = dict(cache.integrity)
+    files[H(3)] = entry(3)
+    cache.commit(files)
+    files.close()
+    # the journal was appended to, the snapshot still has the state of the checkpoint
+    files = FilesCache.read(
+        cache.path, integrity["files"], journal_path=snapshot, journal_integrity_data=integrity["filesjournal"]
+    )
+    assert len(files.generations) == 1
+    assert files.get(H(2)) == entry(2, age=1) and files.get(H(3)) is None
+    files.close()
+
+
+def test_journal_drops(tmpdir):
+    cache = Cache(tmpdir, ttl=3)
+    files = cache.open()
+    for n in range(1, 5):
+        files[H(n)] = entry(n)
+    cache.commit(files)
+    files.close()
+    for i in range(3):
+        files = cache.open()
+        files.touch(H(1), 1)
+        if i == 0:
+            files[H(5)] = entry(5)
+            # seen, but not older than the newest cmtime of this backup
+            files.touch(H(2), 2, recheck=True)
+        cache.commit(files, newest_cmtime=2 * 10**9)
+        files.close()
+    files = cache.open()
+    assert files.get(H(1)) == entry(1, age=1)
+    assert files.get(H(2)) is None
+    assert files.get(H(3)) is None  # not seen in 3 backups
+    assert files.get(H(5)) is None  # added, but newer than the newest cmtime
+    assert [key for key, entry in files.items()] == [H(1)]
+    files.close()
+
+
+def test_compaction(tmpdir):
+    cache = Cache(tmpdir, ttl=4)
+    files = cache.open()
+    for n in range(1, 101):
+        files[H(n)] = entry(n)
+    cache.commit(files)
+    files.close()
+    for i in range(3):
+        files = cache.open()
+        files.touch(H(i + 1), i + 1)
+        files[H(200 + i)] = entry(200 + i)
+        cache.commit(files)
+        files.close()
+    files = cache.open()
+    state = sorted(files.items())
+    files.start_compaction()
+    files.touch(H(50), 50)
+    cache.commit(files)
+    files.close()
+
+    files = cache.open()
+    assert len(files.generations) == 1 and not files.journal
+    assert len(files.index) == 103
+    assert files.get(H(4)) is None  # not seen in 4 backups
+    expected = [(key, entry._replace(age=1 if key == H(50) else entry.age + 1)) for key, entry in state]
+    assert sorted(files.items()) == [(key, entry) for key, entry in expected if entry.age <= 4]
+    files.close()
@@ -437,6 +437,100 @@ def test_integrity_checked_file(self):
                 with IntegrityCheckedFile(path=file, write=False, integrity_data=integrity_data) as fd:
                     ChunkIndex.read(fd)
 
+    def test_integrity_checked_file_mapped(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            file, integrity_data = self.write_integrity_checked_index(tempdir)
+            with IntegrityCheckedFile(path=file, write=False, integrity_data=integrity_data) as fd:
+                idx = ChunkIndex.read(fd, mapped=True)
+            assert idx.mapped
+            assert len(idx) == len(self._deserialize_hashindex(self.HASHINDEX))
+            with open(file, "r+b") as fd:
+                fd.seek(-3, io.SEEK_END)
+                fd.write(b"Foo")
+            with self.assert_raises(FileIntegrityError):
+                with IntegrityCheckedFile(path=file, write=False, integrity_data=integrity_data) as fd:
+                    ChunkIndex.read(fd, mapped=True)
+
+
+class HashIndexMappedTestCase(BaseTestCase):
+    def write_index(self, filepath):
+        idx = ChunkIndex()
+        for x in range(2000):
+            idx[H2(x)] = x, x
+        for x in range(0, 2000, 3):
+            del idx[H2(x)]  # leaves tombstones, lookups must not move entries in the mapping
+        idx.write(filepath)
+        with open(filepath, "rb") as fd:
+            return fd.read()
+
+    def read_mapped(self, filepath):
+        idx = ChunkIndex.read(filepath, mapped=True)
+        assert idx.mapped
+        return idx
+
+    def test_read(self):
+        with unopened_tempfile() as filepath:
+            data = self.write_index(filepath)
+            idx = self.read_mapped(filepath)
+            assert len(idx) == 2000 - 667
+            for x in range(2000):
+                assert idx.get(H2(x)) == (None if x % 3 == 0 else (x, x))
+            assert sorted(value.size for _, value in idx.iteritems()) == [x for x in range(2000) if x % 3]
+            assert idx.summarize() == ChunkIndex.read(filepath).summarize()
+            assert idx.mapped
+            idx.write(filepath + ".copy")
+            with open(filepath + ".copy", "rb") as fd:
+                assert fd.read() == data
+            os.unlink(filepath + ".copy")
+
+    def test_copy_on_write(self):
+        other = ChunkIndex()
+        other[H2(1)] = 1, 1
+        other[H2(3)] = 3, 3
+        changes = [
+            (lambda idx: idx.__setitem__(H2(1), (5, 1)), H2(1), (5, 1)),
+            (lambda idx: idx.__setitem__(H2(3), (5, 3)), H2(3), (5, 3)),
+            (lambda idx: idx.__delitem__(H2(1)), H2(1), None),
+            (lambda idx: idx.incref(H2(1)), H2(1), (2, 1)),
+            (lambda idx: idx.decref(H2(1)), H2(1), (0, 1)),
+            (lambda idx: idx.add(H2(1), 1, 1), H2(1), (2, 1)),
+            (lambda idx: idx.merge(other), H2(3), (3, 3)),
+            (lambda idx: idx.compact(), H2(1), (1, 1)),
+        ]
+        with unopened_tempfile() as filepath:
+            data = self.write_index(filepath)
+            for change, key, value in changes:
+                idx = self.read_mapped(filepath)
+                change(idx)
+                assert not idx.mapped
+                assert idx.get(key) == value
+                assert idx.get(H2(2)) == (2, 2)
+                del idx
+            with open(filepath, "rb") as fd:
+                assert fd.read() == data
+
+    def test_nsindex_flags(self):
+        with unopened_tempfile() as filepath:
+            idx = NSIndex()
+            for x in range(100):
+                idx[H(x)] = x, x, x
+            idx.write(filepath)
+            idx = NSIndex.read(filepath, mapped=True)
+            assert idx.flags(H(1)) == 0
+            assert idx.mapped
+            idx.flags(H(1), mask=1, value=1)
+            assert not idx.mapped
+            assert idx.flags(H(1)) == 1
+            assert NSIndex.read(filepath).flags(H(1)) == 0
+
+    def test_not_a_file(self):
+        with unopened_tempfile() as filepath:
+            self.write_index(filepath)
+            with open(filepath, "rb") as fd:
+                idx = ChunkIndex.read(io.BytesIO(fd.read()), mapped=True)
+        assert not idx.mapped
+        assert idx.get(H2(1)) == (1, 1)
+
 
 class HashIndexCompactTestCase(HashIndexDataTestCase):
     def index(self, num_entries, num_buckets, num_empty):
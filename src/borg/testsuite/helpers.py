@@ -42,7 +42,7 @@
 from ..helpers import dash_open
 from ..helpers import iter_separated
 from ..helpers import eval_escapes
-from ..helpers import safe_unlink
+from ..helpers import safe_unlink, clone_file
 from ..helpers import text_to_json, binary_to_json
 from ..helpers.passphrase import Passphrase, PasswordRetriesExceeded
 from ..platform import is_cygwin, is_win32, is_darwin
@@ -1275,6 +1275,37 @@ def os_unlink(_):
     assert victim.read_binary() == contents
 
 
+def test_clone_file(tmpdir):
+    contents = os.urandom(100000)
+    src = tmpdir / "src"
+    src.write_binary(contents)
+    dst = tmpdir / "dst"
+    dst.write_binary(b"x" * 200000)
+    clone_file(str(src), str(dst))
+    assert dst.read_binary() == contents
+    # a copy, not a link
+    dst.write_binary(b"changed")
+    assert src.read_binary() == contents
+
+
+def test_clone_file_sparse(tmpdir):
+    contents = os.urandom(100000)
+    src = tmpdir / "src"
+    with open(src, "wb") as f:
+        f.write(contents)
+        f.seek(64 * 1024 * 1024)
+        f.write(contents)
+        f.truncate(128 * 1024 * 1024)
+    dst = tmpdir / "dst"
+    clone_file(str(src), str(dst))
+    with open(dst, "rb") as f:
+        assert f.read(len(contents)) == contents
+        f.seek(64 * 1024 * 1024)
+        assert f.read() == contents + bytes(64 * 1024 * 1024 - len(contents))
+    # the holes are kept (if the filesystem supports them)
+    assert os.stat(dst).st_blocks <= os.stat(src).st_blocks
+
+
 class TestPassphrase:
     def test_passphrase_new_verification(self, capsys, monkeypatch):
         monkeypatch.setattr(getpass, "getpass", lambda prompt: "12aöäü")
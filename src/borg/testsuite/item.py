@@ -153,6 +153,23 @@ def test_item_file_size_no_chunks():
     assert item.get_size() == 0
 
 
+def test_item_holes():
+    chunks = [ChunkListEntry(id=b"1", size=1000), ChunkListEntry(id=b"2", size=2000)]
+    item = Item(mode=0o100666, chunks=chunks, holes=[(0, 500), (1500, 100), (3600, 400)])
+    assert item.get_size() == 4000
+    assert item.chunks_with_holes() == [
+        ChunkListEntry(id=None, size=500),
+        chunks[0],
+        ChunkListEntry(id=None, size=100),
+        chunks[1],
+        ChunkListEntry(id=None, size=400),
+    ]
+    assert Item(mode=0o100666, chunks=chunks).chunks_with_holes() == chunks
+    # holes recorded ahead of the chunks (part items) are left out
+    item = Item(mode=0o100666, chunks=chunks[:1], holes=[(0, 500), (3600, 400)])
+    assert item.chunks_with_holes() == [ChunkListEntry(id=None, size=500), chunks[0]]
+
+
 def test_item_optr():
     item = Item()
     assert Item.from_optr(item.to_optr()) is item
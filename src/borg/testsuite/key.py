@@ -1,6 +1,8 @@
+import os
 import re
 import tempfile
 from binascii import hexlify, unhexlify, a2b_base64
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import MagicMock
 
 import pytest
@@ -232,6 +234,21 @@ def test_roundtrip(self, key):
         decrypted = loaded_key.decrypt(id, encrypted)
         assert decrypted == plaintext
 
+    def test_encrypt_threads(self, key):
+        # the encryption may run on multiple threads, but every message must get its own iv (range)
+        plaintexts = [os.urandom(1000) for _ in range(100)]
+        ids = [key.id_hash(plaintext) for plaintext in plaintexts]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            encrypted = list(executor.map(key.encrypt, ids, plaintexts))
+        assert [key.decrypt(id, data) for id, data in zip(ids, encrypted)] == plaintexts
+        if isinstance(key, AEADKeyBase):
+            ivs = [int.from_bytes(data[2:8], "big") for data in encrypted]
+            assert len(set(ivs)) == len(ivs)
+        elif key.logically_encrypted:
+            ivs = sorted(key.cipher.extract_iv(data) for data in encrypted)
+            blocks = key.cipher.block_count(len(plaintexts[0]))
+            assert all(iv2 - iv1 >= blocks for iv1, iv2 in zip(ivs, ivs[1:]))
+
     def test_assert_id(self, key):
         plaintext = b"123456789"
         id = key.id_hash(plaintext)
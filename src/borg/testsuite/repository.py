@@ -285,6 +285,30 @@ def test_flags_persistence(self):
             self.assert_equal(self.repository.flags(H(0), mask=0xFFFFFFFF), 0x00000000)
             self.assert_equal(self.repository.flags(H(1), mask=0xFFFFFFFF), 0x00000006)
 
+    def test_changes(self):
+        assert self.repository.get_changes() is None
+        self.repository.put(H(0), fchunk(b"foo"))
+        self.repository.put(H(1), fchunk(b"bar"))
+        self.repository.commit(compact=False)
+        first = self.repository.get_changes()
+        assert first["previous"] is None
+        assert set(first["put"]) == {H(0), H(1)} and not first["delete"]
+        self.repository.delete(H(0))
+        self.repository.put(H(2), fchunk(b"baz"))
+        self.repository.put(H(3), fchunk(b"baz"))
+        self.repository.delete(H(3))
+        self.repository.commit(compact=False)
+        second = self.repository.get_changes()
+        assert second["previous"] == first["transaction"]
+        assert set(second["put"]) == {H(2)} and set(second["delete"]) == {H(0), H(3)}
+        assert self.repository.get_changes(first["transaction"]) == first
+        # clients can only add data to the change log of the current transaction
+        assert not self.repository.add_cache_changes(first["transaction"], None, b"data")
+        assert self.repository.add_cache_changes(second["transaction"], first["transaction"], b"data1")
+        assert self.repository.add_cache_changes(second["transaction"], first["transaction"], b"data2")
+        second = self.repository.get_changes()
+        assert second["cache_base"] == first["transaction"] and list(second["cache"]) == [b"data1", b"data2"]
+
 
 class LocalRepositoryTestCase(RepositoryTestCaseBase):
     # test case that doesn't work with remote repositories
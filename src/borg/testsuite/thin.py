@@ -1,13 +1,20 @@
 import struct
 import os
+import subprocess
 import tempfile
+import threading
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
 
 from . import BaseTestCase
-from ..archive import ThinObjectProcessors
+from ..archive import ThinObjectProcessors, ThinDeviceRestorer, ThinItemDiff
 from ..cache import ChunkListEntry
 from ..chunker import Chunk
-from ..constants import *
+from ..constants import CH_DATA, CH_HOLE, CH_ALLOC
 from ..helpers import lvm
+from ..item import Item
 
 def zeros(n):
     return b'\0'*n
@@ -59,15 +66,19 @@ def check_alignment(segmap, t, chunks):
 class MockedFetcher:
     def __init__(self, fetch):
         self.fetch = fetch
+        self.repo_lock = threading.RLock()
+        self.preloaded = []
 
     def __getattr__(self, n):
         match n:
-            case 'archive' | 'pipeline':
+            case 'archive' | 'pipeline' | 'repository':
                 return self
             case 'fetch_many':
                 return self.fetch
+            case 'preload':
+                return self.preloaded.extend
             case _:
-                raise AttributeError(n)
+                return getattr(ThinObjectProcessors, n)
 
 def unpack_data(data):
     return struct.unpack('>' + 'I'*(len(data)//4), data)
@@ -178,6 +189,115 @@ def test_segmap(self):
             (9, 2, 'hole'),
         ]
 
+    def test_segmap_merge(self):
+        # fragmented thin_dump output: one mapping per block
+        delta = make_deltas(*[('right_only', i, 1) for i in range(2, 6)], ('right_only', 7, 1), ('right_only', 8, 2))
+        segmap = ThinObjectProcessors._segmap_for_delta(total_blocks=14, delta=delta)
+        expected = [
+            (0, 2, 'hole'),
+            (2, 4, 'new'),
+            (6, 1, 'hole'),
+            (7, 3, 'new'),
+            (10, 4, 'hole'),
+        ]
+        assert list(ThinObjectProcessors._merge_segments(segmap)) == expected
+
+        compact = ThinObjectProcessors.CompactSegmap(expected)
+        assert len(compact) == 5
+        assert list(compact) == expected
+        # can be iterated more than once
+        assert list(compact) == expected
+
+    def test_segmap_splitter(self):
+        segmap = gen_smap(('h', 5), ('n', 3), ('o', 2), ('n', 8), ('h', 4))
+        pulled = []
+
+        def source():
+            for seg in segmap:
+                pulled.append(seg)
+                yield seg
+
+        splitter = ThinObjectProcessors.SegmapSplitter(source())
+        everything = splitter.view('hole', 'new', 'old')
+        new = splitter.view('new')
+        old = splitter.view('old')
+
+        # segments are only pulled from the source when needed
+        assert next(new) == segmap[1]
+        assert pulled == segmap[:2]
+        assert next(everything) == segmap[0]
+        assert list(old) == [segmap[2]]
+        assert list(new) == [segmap[3]]
+        assert list(everything) == segmap[1:]
+        assert pulled == segmap
+
+    def test_parse_mappings(self):
+        with tempfile.NamedTemporaryFile(prefix='borgthin', mode='w') as f:
+            f.write(
+                '<superblock uuid="" time="1" transaction="2" data_block_size="128" nr_data_blocks="0">'
+                '<diff left="1" right="2">'
+                '<same begin="0" length="4"/><right_only begin="4" length="2"/><different begin="8" length="1"/>'
+                '</diff></superblock>')
+            f.flush()
+            mappings = lvm._iter_mappings(['cat', f.name])
+            diff, info = next(mappings)
+            assert diff.tag == 'diff' and diff.attrib == {'left': '1', 'right': '2'}
+            parsed = [(info.tag, dict(info.attrib))] + [(info.tag, dict(info.attrib)) for _, info in mappings]
+            assert parsed == [
+                ('same', {'begin': '0', 'length': '4'}),
+                ('right_only', {'begin': '4', 'length': '2'}),
+                ('different', {'begin': '8', 'length': '1'}),
+            ]
+
+        # a failing tool is reported as such, even if it left broken output behind
+        with pytest.raises(subprocess.CalledProcessError):
+            list(lvm._iter_mappings(['sh', '-c', 'echo "<superblock><diff><same"; exit 1']))
+
+    def test_lvm_inventory(self):
+        lvs = [
+            {'lv_uuid': 'p', 'lv_full_name': 'vg/pool', 'origin_uuid': '', 'lv_tags': ''},
+            {'lv_uuid': 'a', 'lv_full_name': 'vg/a', 'origin_uuid': '', 'lv_tags': 'foo'},
+            {'lv_uuid': 's1', 'lv_full_name': 'vg/a_1', 'origin_uuid': 'a', 'lv_tags': 'borgrepo-x,borgthin-last'},
+            {'lv_uuid': 's2', 'lv_full_name': 'vg/a_2', 'origin_uuid': 'a', 'lv_tags': 'borgrepo-y,borgthin-last'},
+        ]
+        reports = []
+
+        def get_lvs(spec=None, select=None, uuid=None):
+            reports.append((spec, uuid))
+            return [dict(i) for i in lvs if spec in (None, i['lv_full_name']) and uuid in (None, i['lv_uuid'])]
+
+        def create(name, *params):
+            lvs.append({'lv_uuid': 's3', 'lv_full_name': f'vg/{name}', 'origin_uuid': 'a', 'lv_tags': 'borgrepo-x'})
+
+        def remove(uuid):
+            lvs[:] = [i for i in lvs if i['lv_uuid'] != uuid]
+
+        def change(uuid, *params):
+            for i in lvs:
+                if i['lv_uuid'] == uuid:
+                    i['lv_tags'] += ',borgthin-last'
+
+        with patch.object(lvm, 'get_lvs', get_lvs), patch.object(lvm, 'create', create), \
+                patch.object(lvm, 'remove', remove), patch.object(lvm, 'change', change):
+            inv = lvm.LvmInventory()
+            assert not reports
+            assert inv.get('vg/a')['lv_uuid'] == 'a'
+            assert inv.get('vg/nope') is None
+            assert inv.get_uuid('p')['lv_full_name'] == 'vg/pool'
+            assert [i['lv_uuid'] for i in inv.select(origin_uuid='a')] == ['s1', 's2']
+            assert [i['lv_uuid'] for i in inv.select(origin_uuid='a', tags=('borgrepo-x', 'borgthin-last'))] == ['s1']
+            assert [i['lv_uuid'] for i in inv.select(tags=('foo', ))] == ['a']
+            # one report for all of the above
+            assert reports == [(None, None)]
+
+            assert inv.create('vg', 'a_3')['lv_uuid'] == 's3'
+            inv.remove('s1')
+            assert [i['lv_uuid'] for i in inv.select(origin_uuid='a', tags=('borgrepo-x', ))] == ['s3']
+            inv.change('s3', '--addtag', 'borgthin-last')
+            assert [i['lv_uuid'] for i in inv.select(origin_uuid='a', tags=('borgrepo-x', 'borgthin-last'))] == ['s3']
+            # only the changed LVs were looked at again
+            assert reports == [(None, None), ('vg/a_3', None), (None, 's3')]
+
     def test_dense_delta(self):
         with tempfile.TemporaryFile(prefix='borgthin', mode='w+b', buffering=0) as f:
             segmap = gen_smap(('h', 5), ('n', 3), ('o', 2), ('n', 8), ('h', 4))
@@ -187,6 +307,7 @@ def test_dense_delta(self):
             ddf = ThinObjectProcessors.DenseDeltaFile(segmap=segmap, block_size=4, fd=f.fileno())
 
             self.i = 1
+
             def compare(n, ex):
                 assert unpack_data(ddf.read(n*4)) == unpack_data(ex)
 
@@ -201,6 +322,22 @@ def compare(n, ex):
 
             assert not ddf.read(4)
 
+    def test_dense_delta_ranges(self):
+        segmap = gen_smap(('h', 5), ('n', 3), ('n', 2), ('o', 2), ('n', 8), ('h', 4), ('n', 1))
+        ranges = list(ThinObjectProcessors.DenseDeltaFile._coalesce(segmap, 4, 6*4))
+        # adjacent segments are merged, long ranges are split
+        assert ranges == [(5*4, 5*4), (12*4, 6*4), (18*4, 2*4), (24*4, 1*4)]
+
+        with tempfile.TemporaryFile(prefix='borgthin', mode='w+b', buffering=0) as f:
+            # lots of tiny segments, all read at once
+            segmap = gen_smap(*[('n', 1), ('o', 1)]*2000)
+            ex_in = self.gen_data(4000)
+            f.write(ex_in)
+            ddf = ThinObjectProcessors.DenseDeltaFile(segmap=segmap, block_size=4, fd=f.fileno())
+            data = ddf.read(8000*4)
+            assert unpack_data(data) == tuple(range(1, 4001, 2))
+            assert not ddf.read(4)
+
     def test_new_chunks(self):
         ex = self.gen_data(100)
 
@@ -247,3 +384,225 @@ def test_old_chunks(self):
         result = list(ThinObjectProcessors._old_chunks_filter_and_align(self.m_fetcher, segmap=segmap, block_size=4, chunks=chunks))
         check_alignment(segmap, 'old', result)
         self.compare(result, ex)
+
+    def test_old_chunks_holes(self):
+        ex_in = self.gen_data(6)
+        self.i = 1
+        ex = zns(2) + self.gen_data(3)
+
+        # holes of the old item (see Item.chunks_with_holes) come back as holes
+        segmap = gen_smap(('o', 2), ('h', 1), ('o', 3))
+        chunks = [ChunkListEntry(None, 3*4)] + self.gen_cles(ex_in, 6)
+        result = list(ThinObjectProcessors._old_chunks_filter_and_align(
+            self.m_fetcher, segmap=segmap, block_size=4, chunks=chunks))
+        check_alignment(segmap, 'old', result)
+        assert result[0].meta == {'size': 2*4, 'allocation': CH_HOLE}
+        self.compare(result, ex)
+
+    def test_old_chunks_window(self):
+        ex_in = self.gen_data(6*10)
+        self.i = 1
+        ex = self.gen_data(6*10)
+
+        # all but the first and last chunk straddle a segment boundary, so they need to be fetched
+        segmap = gen_smap(*[('o', 2)]*30)
+        chunks = self.gen_cles(ex_in, 1, *[2]*29, 1)
+        fetched = []
+
+        def fetch(ids, is_preloaded):
+            assert is_preloaded
+            for i in ids:
+                assert self.m_fetcher.preloaded.pop(0) == i
+                fetched.append(i)
+            yield from self.fetch_cles(ids)
+        self.m_fetcher.fetch = fetch
+        self.m_fetcher.preload_window = 3
+
+        it = ThinObjectProcessors._old_chunks_filter_and_align(
+            self.m_fetcher, segmap=segmap, block_size=4, chunks=chunks)
+        result = [next(it)]
+        # only the first few chunks are on their way
+        assert not fetched and self.m_fetcher.preloaded == [1, 2, 3]
+        result += list(it)
+        check_alignment(segmap, 'old', result)
+        self.compare(result, ex)
+        assert fetched == list(range(1, 30)) and not self.m_fetcher.preloaded
+
+        # preloaded chunks are retrieved when stopping early
+        it = ThinObjectProcessors._old_chunks_filter_and_align(
+            self.m_fetcher, segmap=segmap, block_size=4, chunks=chunks)
+        next(it)
+        it.close()
+        assert not self.m_fetcher.preloaded
+
+    def test_reread_partial_old(self):
+        segmap = gen_smap(('h', 2), ('o', 6), ('n', 2), ('o', 5), ('h', 3))
+        # old chunks on block boundaries: 0-2, 2-5, 5-9, 9-15, 15-18
+        chunks = [ChunkListEntry(i, n*4) for i, n in enumerate((2, 3, 4, 6, 3))]
+        result = list(ThinObjectProcessors._reread_partial_old(segmap=segmap, block_size=4, chunks=chunks))
+        assert result == [
+            (0, 2, 'hole'),
+            (2, 3, 'old'),
+            # partially unchanged old chunks are read again
+            (5, 3, 'new'),
+            (8, 2, 'new'),
+            (10, 5, 'new'),
+            (15, 3, 'hole'),
+        ]
+
+        # whatever is left maps onto whole old chunks
+        def fetch(ids, is_preloaded):
+            assert not list(ids), 'no chunks should be fetched'
+            return iter(())
+        fetcher = MockedFetcher(fetch)
+        old = list(ThinObjectProcessors._old_chunks_filter_and_align(
+            fetcher, segmap=result, block_size=4, chunks=chunks))
+        assert old == [chunks[1], None]
+
+    def test_record_holes(self):
+        item = Item(path='vg/lv')
+        chunks = [
+            Chunk(None, size=8, allocation=CH_HOLE),
+            Chunk(b'abcd', size=4, allocation=CH_DATA),
+            ChunkListEntry(b'x', 4),
+            Chunk(None, size=12, allocation=CH_HOLE),
+            Chunk(None, size=4, allocation=CH_HOLE),
+            Chunk(None, size=4, allocation=CH_ALLOC),
+            Chunk(None, size=8, allocation=CH_HOLE),
+        ]
+        result = list(ThinObjectProcessors._record_holes(item, chunks))
+        assert result == [chunks[1], chunks[2], chunks[5]]
+        # adjacent holes are merged
+        assert item.holes == [(0, 8), (16, 16), (36, 8)]
+
+        # items without holes don't get any
+        item = Item(path='vg/lv')
+        assert list(ThinObjectProcessors._record_holes(item, chunks[1:3])) == chunks[1:3]
+        assert 'holes' not in item
+
+    def test_estimate(self):
+        cle = ChunkListEntry
+        segmap = gen_smap(('o', 2), ('n', 1), ('o', 3), ('h', 2))
+        chunks = [cle(b'0', 6), cle(b'1', 10), cle(b'2', 8), cle(b'3', 8)]
+        estimate = ThinObjectProcessors.estimate_lv(size=8*4, block_size=4, segmap=segmap, old_chunks=chunks)
+        # chunk 1 is split by both old segments, but only fetched once
+        assert estimate == {
+            'size': 32, 'new_size': 4, 'old_size': 20, 'hole_size': 8, 'refetch_chunks': 1, 'refetch_size': 10,
+        }
+
+        # old chunks on block boundaries are re-read instead of fetched
+        segmap = gen_smap(('o', 1), ('n', 1), ('o', 2))
+        chunks = [cle(b'0', 8), cle(b'1', 8)]
+        estimate = ThinObjectProcessors.estimate_lv(
+            size=4*4, block_size=4, segmap=segmap, old_chunks=chunks, aligned=True)
+        assert estimate == {
+            'size': 16, 'new_size': 8, 'old_size': 8, 'hole_size': 0, 'refetch_chunks': 0, 'refetch_size': 0,
+        }
+        # unless they weren't cut on blocks on purpose, then the chunk is fetched (even if its size matches)
+        estimate = ThinObjectProcessors.estimate_lv(size=4*4, block_size=4, segmap=segmap, old_chunks=chunks)
+        assert estimate == {
+            'size': 16, 'new_size': 4, 'old_size': 12, 'hole_size': 0, 'refetch_chunks': 1, 'refetch_size': 8,
+        }
+
+    def test_resume_plan(self):
+        cle = ChunkListEntry
+        segmap = gen_smap(('o', 2), ('n', 1), ('o', 3), ('h', 2))
+        old_chunks = [cle(b'0', 6), cle(b'1', 10), cle(b'2', 8), cle(b'3', 8)]
+        # the part item ends within block 2, the next old chunk boundary is at the end of block 3
+        done_chunks = [cle(b'a', 5), cle(b'b', 5)]
+        segmap, chunks = ThinObjectProcessors._resume_plan(
+            segmap=segmap, block_size=4, done_chunks=done_chunks, old_chunks=old_chunks)
+        segmap = list(segmap)
+        assert segmap == gen_smap(('o', 2), ('n', 2), ('o', 2), ('h', 2))
+        assert chunks == done_chunks + [cle(None, 6)] + old_chunks[2:]
+
+        plan = list(ThinObjectProcessors._old_chunks_plan(segmap=segmap, block_size=4, chunks=chunks))
+        assert plan == [
+            done_chunks[0], ThinObjectProcessors.ModChunkInfo(id=b'b', start=0, end=3), None,
+            old_chunks[2], None,
+        ]
+
+        # from scratch (no old chunks), the part item just goes in front
+        segmap, chunks = ThinObjectProcessors._resume_plan(
+            segmap=gen_smap(('n', 6), ('h', 2)), block_size=4, done_chunks=[cle(b'a', 12)], old_chunks=[])
+        assert list(segmap) == gen_smap(('o', 3), ('n', 3), ('h', 2))
+        assert chunks == [cle(b'a', 12)]
+
+    def test_restore_plan(self):
+        cle = ChunkListEntry
+        chunks = [cle(b'a', 4), cle(None, 8), cle(b'b', 4), cle(None, 12), cle(b'c', 8)]
+
+        # without a reference, everything needs to be written or discarded
+        plan = list(ThinDeviceRestorer._plan(chunks, []))
+        assert plan == [(0, chunks[0]), (4, chunks[1]), (12, chunks[2]), (16, chunks[3]), (28, chunks[4])]
+
+        # nothing to do if the reference is the same
+        assert list(ThinDeviceRestorer._plan(chunks, chunks)) == []
+
+        ref = [cle(b'a', 4), cle(b'x', 4), cle(None, 4), cle(b'b', 4), cle(None, 4), cle(b'y', 4), cle(b'z', 8)]
+        plan = list(ThinDeviceRestorer._plan(chunks, ref))
+        assert plan == [
+            # data in the reference within holes is discarded
+            (4, cle(None, 4)),
+            (20, cle(None, 8)),
+            # same chunk at a different offset or of a different size than in the reference
+            (28, chunks[4]),
+        ]
+
+        # data beyond the end of the reference
+        plan = list(ThinDeviceRestorer._plan(chunks, chunks[:2] + [cle(None, 10)]))
+        assert plan == [(12, chunks[2]), (22, cle(None, 6)), (28, chunks[4])]
+
+    def test_restore(self):
+        data = [b'a' * 4, b'b' * 4, b'c' * 8]
+        chunks = [ChunkListEntry(0, 4), ChunkListEntry(1, 4), ChunkListEntry(2, 8)]
+        item = Item(path='vg/lv', size=24, chunks=chunks, holes=[(4, 4), (12, 4)])
+        ref_item = Item(path='vg/lv', size=28, chunks=[chunks[0], ChunkListEntry(3, 8), chunks[2]], holes=[(20, 8)])
+        fetched = []
+
+        def fetch(ids, **kwargs):
+            for i in ids:
+                fetched.append(i)
+                yield data[i]
+
+        restorer = ThinDeviceRestorer(archive=MockedFetcher(fetch))
+        with tempfile.TemporaryFile() as f:
+            # the contents of ref_item
+            f.write(b'a' * 4 + b'd' * 8 + b'c' * 8 + zeros(8))
+            f.flush()
+            restorer.restore(item, f.fileno(), ref_item=ref_item)
+            f.seek(0)
+            assert f.read() == b'a' * 4 + zeros(4) + b'b' * 4 + zeros(4) + b'c' * 8
+        assert fetched == [1, 2]
+        assert (restorer.written, restorer.discarded, restorer.skipped) == (12, 8, 4)
+
+    def test_item_diff(self):
+        cle = ChunkListEntry
+        data = {b'a': b'a' * 8, b'b': b'b' * 8, b'c': b'c' * 8, b'd': b'd' * 8, b'e': b'c' * 4, b'f': b'ccxxyyyy'}
+        item1 = Item(path='vg/lv', size=32, chunks=[cle(b'a', 8), cle(b'b', 8), cle(b'c', 8)], holes=[(8, 8)])
+        # the zeros are a chunk in item2, which counts as the same as the hole in item1
+        item2 = Item(path='vg/lv', size=36, chunks=[
+            cle(b'a', 8), cle(b'Z8', 8), cle(b'd', 8), cle(b'e', 4), cle(b'f', 8)])
+        fetched = []
+
+        def fetch(ids, **kwargs):
+            for i in ids:
+                fetched.append(i)
+                yield data[i]
+
+        archive = SimpleNamespace(
+            key=SimpleNamespace(id_hash=lambda d: b'Z%d' % len(d) if not any(d) else None),
+            pipeline=SimpleNamespace(fetch_many=fetch))
+
+        differ = ThinItemDiff(archive=archive)
+        assert list(differ.diff(item1, item2)) == [(16, 8, 'changed'), (24, 8, 'unknown'), (32, 4, 'changed')]
+        assert (differ.changed, differ.unknown) == (12, 8)
+        assert fetched == []
+
+        differ = ThinItemDiff(archive=archive, compare_content=True, granularity=4)
+        assert list(differ.diff(item1, item2)) == [(16, 8, 'changed'), (28, 8, 'changed')]
+        assert (differ.changed, differ.unknown) == (16, 0)
+        # item1's chunk is fetched once for both pieces
+        assert fetched == [b'c', b'e', b'f']
+
+        assert list(ThinItemDiff(archive=archive).diff(item2, item2)) == []